@@ -0,0 +1,20 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from apps.filestore.visibility import rebuild_visibility
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the file visibility table from guardian permissions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only rebuild these users.')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        count = rebuild_visibility(users)
+        self.stdout.write(self.style.SUCCESS('Rebuilt visibility of {} users'.format(count)))
@@ -78,3 +78,16 @@ class ShareLink(BaseModel):
         if self.created_at + datetime.timedelta(days=self.valid_days) >= now:
             return False
         return True
+
+
+class FileVisibility(models.Model):
+    """Private files a user can see through a file or tag download permission."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='+')
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='visibility')
+
+    class Meta:
+        db_table = 'filestore_file_visibility'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'file'], name='unique_file_visibility'),
+        ]
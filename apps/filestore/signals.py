@@ -1,10 +1,50 @@
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
 from django.dispatch import receiver
 
-from .models import File
+from utils.perm_cache import user_perms_changed
+from utils.response_cache import bump_version
+
+from .models import Tag, File
+from .visibility import refresh_user_visibility, refresh_file_visibility
 
 
 @receiver(pre_delete, sender=File)
 def handle_file_deleted(instance: File, **kwargs):
     instance.file.delete(save=False)
     instance.icon.delete(save=False)
+
+
+@receiver(post_init, sender=File)
+def handle_file_loaded(instance: File, **kwargs):
+    instance._visibility_state = (instance.is_public, instance.tag_id)
+
+
+@receiver(post_save, sender=File)
+def handle_file_saved(instance: File, created, **kwargs):
+    state = (instance.is_public, instance.tag_id)
+    if created or state != instance._visibility_state:
+        refresh_file_visibility(instance)
+    instance._visibility_state = state
+
+
+@receiver(pre_delete, sender=Tag)
+def handle_tag_deleting(instance: Tag, **kwargs):
+    instance._file_ids = list(instance.files.filter(is_public=False).values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def handle_tag_deleted(instance: Tag, **kwargs):
+    for file in File.objects.filter(id__in=instance._file_ids):
+        refresh_file_visibility(file)
+
+
+@receiver(user_perms_changed)
+def handle_user_perms_changed(user_ids, **kwargs):
+    for user_id in user_ids:
+        refresh_user_visibility(user_id)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def handle_tag_changed(sender, **kwargs):
+    bump_version(sender)
@@ -1,3 +1,309 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from guardian.models import UserObjectPermission
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.test import APITestCase
+
+from apps.system.perms import sync_user_object_perms
+from apps.system.serializers import UserSerializer
+from utils import perm_cache
+from utils.delivery import content_disposition, internal_uri, offload
+from utils.query_plan import get_query_plan
+from utils.renderers import ORJSONRenderer
+from utils.response_cache import VERSION_KEY
+
+from .models import File, FileVisibility, Tag, fs
+from .serializers import FileListSerializer, ShareLinkSerializer, TagSerializer
+from .views import TagViewSet
+
+User = get_user_model()
+
+
+def make_file(**kwargs):
+    kwargs.setdefault('name', 'file')
+    kwargs.setdefault('file', 'file.bin')
+    return File.objects.create(md5sum='0' * 32, **kwargs)
+
+
+class PermCacheTestMixin:
+    def setUp(self):
+        # Sets cached by earlier tests under the same user ids are dropped.
+        perm_cache.local.clear()
+        perm_cache._bump([perm_cache.GLOBAL_VERSION_KEY])
+        super().setUp()
+
+
+# Sizes are read from storage, the rows here have no file behind them.
+@mock.patch.object(FileListSerializer, 'get_size', return_value=0)
+class FileVisibilityTests(PermCacheTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'password')
+        self.client.force_authenticate(self.user)
+        self.tag = Tag.objects.create(name='docs')
+        self.public = make_file()
+        self.private = make_file(is_public=False)
+        self.tagged = make_file(is_public=False, tag=self.tag)
+
+    def list_ids(self):
+        response = self.client.get('/api/filestore/files/', {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        return {x['id'] for x in response.json()['results']}
+
+    def grant(self, perm, ids):
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_user_object_perms(perm, self.user, ids)
+
+    def test_private_files_need_a_permission(self, _):
+        self.assertEqual(self.list_ids(), {self.public.id})
+
+    def test_file_permission(self, _):
+        self.grant('filestore.download_file', [self.private.id])
+        self.assertEqual(self.list_ids(), {self.public.id, self.private.id})
+        self.grant('filestore.download_file', [])
+        self.assertEqual(self.list_ids(), {self.public.id})
+
+    def test_tag_permission_follows_the_file(self, _):
+        self.grant('filestore.download_tag', [self.tag.id])
+        self.assertEqual(self.list_ids(), {self.public.id, self.tagged.id})
+
+        self.private.tag = self.tag
+        self.private.save()
+        self.tagged.tag = None
+        self.tagged.save()
+        self.assertEqual(self.list_ids(), {self.public.id, self.private.id})
+
+    def test_public_files_have_no_rows(self, _):
+        self.grant('filestore.download_file', [self.private.id])
+        self.private.is_public = True
+        self.private.save()
+        self.assertFalse(FileVisibility.objects.exists())
+        self.assertEqual(self.list_ids(), {self.public.id, self.private.id})
+
+    def test_rebuild_command(self, _):
+        self.grant('filestore.download_file', [self.private.id])
+        FileVisibility.objects.all().delete()
+        call_command('rebuild_file_visibility', stdout=mock.Mock())
+        self.assertEqual(self.list_ids(), {self.public.id, self.private.id})
+
+
+class DownloadPermSyncTests(PermCacheTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_authenticate(admin)
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'password')
+        self.files = [make_file(is_public=False) for i in range(6)]
+
+    def sync(self, files):
+        return self.client.post('/api/filestore/files/update_user_download_perm/',
+                                {'username': 'alice', 'file_list': [x.id for x in files]},
+                                format='json')
+
+    def granted(self):
+        return set(UserObjectPermission.objects.filter(user=self.user).values_list('object_pk', flat=True))
+
+    def test_sync_to_exact_set(self):
+        self.assertEqual(self.sync(self.files[:4]).status_code, 200)
+        self.assertEqual(self.granted(), {str(x.id) for x in self.files[:4]})
+        self.assertEqual(self.sync(self.files[2:]).status_code, 200)
+        self.assertEqual(self.granted(), {str(x.id) for x in self.files[2:]})
+        self.sync([])
+        self.assertEqual(self.granted(), set())
+
+    def test_unknown_ids_change_nothing(self):
+        self.sync(self.files[:2])
+        response = self.client.post('/api/filestore/files/update_user_download_perm/',
+                                    {'username': 'alice', 'file_list': [self.files[3].id, 999999]},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['unknown_ids'], ['999999'])
+        self.assertEqual(self.granted(), {str(x.id) for x in self.files[:2]})
+
+    def test_queries_do_not_grow_with_the_set(self):
+        self.sync(self.files[:1])
+        with self.assertNumQueries(7):
+            sync_user_object_perms('filestore.download_file', self.user, [x.id for x in self.files[1:3]])
+        self.sync(self.files[:1])
+        with self.assertNumQueries(7):
+            sync_user_object_perms('filestore.download_file', self.user, [x.id for x in self.files[1:]])
+
+
+class QueryPlanTests(TestCase):
+    def test_nested_serializers_are_selected(self):
+        plan = get_query_plan(ShareLinkSerializer)
+        self.assertEqual(set(plan.select), {'created_by', 'updated_by', 'file',
+                                            'file__created_by', 'file__updated_by'})
+        self.assertEqual(plan.prefetch, [])
+        # Method fields read what they like, nothing is deferred.
+        self.assertIsNone(plan.only)
+
+    def test_many_relations_are_prefetched(self):
+        plan = get_query_plan(UserSerializer)
+        self.assertEqual(plan.select, [])
+        self.assertEqual(plan.prefetch, ['groups'])
+        self.assertIn('username', plan.only)
+        self.assertNotIn('password', plan.only)
+
+    def test_only_reads_every_serialized_field(self):
+        Tag.objects.create(name='docs')
+        queryset = get_query_plan(TagSerializer).apply(Tag.objects.all(), only=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(TagSerializer(queryset, many=True).data[0]['name'], 'docs')
+
+
+@mock.patch.object(FileListSerializer, 'get_size', return_value=0)
+class FileListQueriesTests(PermCacheTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_authenticate(admin)
+        self.tag = Tag.objects.create(name='docs')
+
+    def list_queries(self, count):
+        for i in range(count):
+            user = User.objects.create_user('user{}'.format(File.objects.count()))
+            make_file(created_by=user, updated_by=user, tag=self.tag)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/filestore/files/', {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_queries_do_not_grow_with_the_page(self, _):
+        self.assertEqual(self.list_queries(2), self.list_queries(8))
+
+
+class TagListCacheTests(APITestCase):
+    def setUp(self):
+        Tag.objects.create(name='docs')
+        # Entries cached by earlier tests are keyed on the old version.
+        cache.delete(VERSION_KEY.format('filestore.tag'))
+
+    def list(self, **headers):
+        return self.client.get('/api/filestore/tags/', **headers)
+
+    def test_cached_list_skips_the_database(self):
+        first = self.list()
+        with self.assertNumQueries(0):
+            second = self.list()
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.list()['ETag']
+        self.assertEqual(self.list(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.list(HTTP_IF_NONE_MATCH='W/' + etag).status_code, 304)
+        self.assertEqual(self.list(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_saved_row_invalidates(self):
+        etag = self.list()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='videos')
+        response = self.list(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('videos', [x['name'] for x in response.json()['results']])
+
+    def test_held_lock_is_waited_for_once(self):
+        add = cache.add
+
+        def held(key, *args, **kwargs):
+            return False if key.endswith('.lock') else add(key, *args, **kwargs)
+        with mock.patch('utils.response_cache.cache.add', side_effect=held), \
+                mock.patch('utils.response_cache.time.sleep') as sleep:
+            response = self.list()
+        self.assertEqual(response.status_code, 200)
+        sleep.assert_called_once_with(TagViewSet.cache_lock_wait)
+
+    @mock.patch.object(TagViewSet, 'renderer_classes', [ORJSONRenderer, BrowsableAPIRenderer])
+    def test_etag_matches_the_negotiated_body(self):
+        response = self.list(HTTP_ACCEPT='application/json')
+        self.assertEqual(response['ETag'], '"{}"'.format(hashlib.md5(response.content).hexdigest()))
+        self.assertIn('Accept', response['Vary'])
+
+        html = self.list(HTTP_ACCEPT='text/html')
+        self.assertEqual(html.status_code, 200)
+        self.assertIn('text/html', html['Content-Type'])
+        self.assertFalse(html.has_header('ETag'))
+        self.assertEqual(self.list(HTTP_ACCEPT='text/html', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+class DeliveryTests(TestCase):
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(FILE_DELIVERY_LOCATIONS={self.root: '/protected/storage/'})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.path = os.path.join(self.root, 'docs', 'a b.pdf')
+
+    def test_internal_uri(self):
+        self.assertEqual(internal_uri(self.path), '/protected/storage/docs/a%20b.pdf')
+        self.assertIsNone(internal_uri(os.path.join(self.root, '..', 'other.pdf')))
+        self.assertIsNone(internal_uri(self.root + '-other/a.pdf'))
+
+    def test_offload_modes(self):
+        with override_settings(FILE_DELIVERY='stream'):
+            self.assertIsNone(offload(self.path))
+        with override_settings(FILE_DELIVERY='x-accel'):
+            resp = offload(self.path)
+            self.assertEqual(resp['X-Accel-Redirect'], '/protected/storage/docs/a%20b.pdf')
+            self.assertEqual(resp['Content-Type'], 'application/pdf')
+            self.assertIsNone(offload('/elsewhere/a.pdf'))
+        with override_settings(FILE_DELIVERY='x-sendfile'):
+            self.assertEqual(offload(self.path)['X-Sendfile'], self.path)
+            self.assertIsNone(offload(os.path.join(self.root, '文件.pdf')))
+        with override_settings(FILE_DELIVERY='nginx'), self.assertRaises(ImproperlyConfigured):
+            offload(self.path)
+
+    def test_content_disposition(self):
+        self.assertEqual(content_disposition('a "b".pdf', True), r'attachment; filename="a \"b\".pdf"')
+        self.assertEqual(content_disposition('文件.pdf'), "inline; filename*=utf-8''%E6%96%87%E4%BB%B6.pdf")
+
+
+class FileDownloadTests(PermCacheTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        root = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        for attr in ('base_location', 'location'):
+            patcher = mock.patch.object(fs, attr, root)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        settings_override = override_settings(FILE_DELIVERY_LOCATIONS={root: '/protected/storage/filestore/'})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        fs.save('report.txt', io.BytesIO(b'report'))
+        self.file = make_file(name='report', file='report.txt')
+        self.client.force_authenticate(User.objects.create_user('alice', 'alice@example.com', 'password'))
+
+    def download(self):
+        return self.client.post('/api/filestore/files/{}/download/'.format(self.file.id))
+
+    @override_settings(FILE_DELIVERY='stream')
+    def test_stream(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'report')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="report.txt"')
+
+    @override_settings(FILE_DELIVERY='x-accel')
+    def test_offloaded(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/storage/filestore/report.txt')
+        self.assertEqual(response.content, b'')
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.download_count, 1)
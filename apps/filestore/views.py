@@ -2,20 +2,23 @@ import os
 
 from django.contrib.auth import get_user_model
 from django.db.models import Q
-from django.http import FileResponse
 from django.shortcuts import get_object_or_404
-from guardian.shortcuts import get_objects_for_user, assign_perm, remove_perm
 from rest_framework import permissions, mixins, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 
-from apps.system.perms import perm_request
+from apps.system.perms import perm_request, sync_user_object_perms
+from utils.delivery import serve_file
+from utils.pagination import CursorOptInPagination
+from utils.perm_cache import has_perms
 from utils.permissions import ActionModelPermissions, ActionObjectPermissions
+from utils.query_plan import QueryPlanMixin
+from utils.response_cache import CachedListMixin
 
 from .filters import TagFilter, FileFilter
-from .models import Tag, File, ShareLink
+from .models import Tag, File, ShareLink, FileVisibility
 from .serializers import (
     TagSerializer,
     FileCreateSerializer,
@@ -29,7 +32,7 @@ from .serializers import (
 User = get_user_model()
 
 
-class TagViewSet(ModelViewSet):
+class TagViewSet(CachedListMixin, ModelViewSet):
     queryset = Tag.objects.order_by('-id')
     serializer_class = TagSerializer
     permission_classes = [permissions.DjangoModelPermissionsOrAnonReadOnly]
@@ -40,24 +43,18 @@ class TagViewSet(ModelViewSet):
         serializer = TagPermUpdateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = get_object_or_404(User, username=serializer.validated_data['username'])
-        old_list = get_objects_for_user(user, 'filestore.download_tag', Tag)
-        for instance in old_list:
-            if instance.id not in serializer.validated_data['tag_list']:
-                remove_perm('filestore.download_tag', user, instance)
-        old_list = [x.id for x in old_list]
-        for instance_id in serializer.validated_data['tag_list']:
-            if instance_id not in old_list:
-                instance = get_object_or_404(Tag, id=instance_id)
-                assign_perm('filestore.download_tag', user, instance)
+        sync_user_object_perms('filestore.download_tag', user,
+                               serializer.validated_data['tag_list'])
         return Response()
 
 
-class FileViewSet(ModelViewSet):
+class FileViewSet(QueryPlanMixin, ModelViewSet):
     queryset = File.objects.order_by('-id')
     serializer_class = FileListSerializer
     permission_classes = [ActionObjectPermissions]
     filterset_class = FileFilter
     search_fields = ['name', 'desc']
+    query_budgets = {'list': (4, 300), 'retrieve': (3, 200)}
     action_model_perms_map = {
         'download': [],
     }
@@ -66,17 +63,16 @@ class FileViewSet(ModelViewSet):
     }
 
     def get_queryset(self):
-        categories = get_objects_for_user(
-            self.request.user,
-            'filestore.download_tag',
-            Tag
-        )
-        queryset = get_objects_for_user(
-            self.request.user,
-            'filestore.download_file',
-            self.queryset
-        )
-        return queryset | File.objects.filter(Q(is_public=True) | Q(Tag__in=categories))
+        queryset = super().get_queryset()
+        user = self.request.user
+        if has_perms(user, ['filestore.download_file']):
+            return queryset
+        visible = Q(is_public=True)
+        if user.is_authenticated:
+            visible |= Q(id__in=FileVisibility.objects.filter(user=user).values('file_id'))
+        if has_perms(user, ['filestore.download_tag']):
+            visible |= Q(tag__isnull=False)
+        return queryset.filter(visible)
 
     def get_serializer_class(self):
         if self.action in ('create', 'update', 'partial_update'):
@@ -98,14 +94,12 @@ class FileViewSet(ModelViewSet):
     def download(self, request, *args, **kwargs):
         instance = get_object_or_404(File, id=kwargs["pk"])
         if not instance.is_public and \
-                not request.user.has_perm('filestore.download_tag', instance.Tag):
+                not has_perms(request.user, ['filestore.download_tag'], instance.tag):
             instance = self.get_object()
         instance.download_count += 1
         instance.save()
-        resp = FileResponse(instance.file)
-        if not resp.headers.get("Content-Length", None):
-            resp.headers["Content-Length"] = instance.file.size
-        return resp
+        return serve_file(request, instance.file.path,
+                          filename=os.path.basename(instance.file.name))
 
     @action(detail=True, methods=['POST'], permission_classes=[permissions.IsAuthenticated])
     def download_request(self, request, *args, **kwargs):
@@ -118,25 +112,20 @@ class FileViewSet(ModelViewSet):
         serializer = FilePermUpdateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = get_object_or_404(User, username=serializer.validated_data['username'])
-        old_list = get_objects_for_user(user, 'filestore.download_file', File)
-        for instance in old_list:
-            if instance.id not in serializer.validated_data['file_list']:
-                remove_perm('filestore.download_file', user, instance)
-        old_list = [x.id for x in old_list]
-        for instance_id in serializer.validated_data['file_list']:
-            if instance_id not in old_list:
-                instance = get_object_or_404(File, id=instance_id)
-                assign_perm('filestore.download_file', user, instance)
+        sync_user_object_perms('filestore.download_file', user,
+                               serializer.validated_data['file_list'])
         return Response()
 
 
-class ShareLinkViewSet(mixins.CreateModelMixin,
+class ShareLinkViewSet(QueryPlanMixin,
+                       mixins.CreateModelMixin,
                        mixins.RetrieveModelMixin,
                        mixins.DestroyModelMixin,
                        GenericViewSet):
     queryset = ShareLink.objects.order_by('-created_at')
     serializer_class = ShareLinkSerializer
     permission_classes = [permissions.DjangoModelPermissionsOrAnonReadOnly]
+    pagination_class = CursorOptInPagination
     search_fields = ['link',]
 
     def get_serializer_class(self):
@@ -155,10 +144,8 @@ class ShareLinkViewSet(mixins.CreateModelMixin,
         instance = sharelink.file
         instance.download_count += 1
         instance.save()
-        resp = FileResponse(instance.file)
-        if not resp.headers.get("Content-Length", None):
-            resp.headers["Content-Length"] = instance.file.size
-        return resp
+        return serve_file(request, instance.file.path,
+                          filename=os.path.basename(instance.file.name))
 
     @action(detail=False, methods=['GET'], permission_classes=[permissions.IsAdminUser])
     def fetch_all(self, request, *args, **kwargs):
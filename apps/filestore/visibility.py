@@ -0,0 +1,59 @@
+from django.contrib.auth import get_user_model
+from guardian.shortcuts import get_objects_for_user, get_users_with_perms
+
+from .models import Tag, File, FileVisibility
+
+User = get_user_model()
+
+
+def visible_file_ids(user):
+    """Private files ``user`` can download through object permissions."""
+    files = File.objects.filter(is_public=False)
+    by_file = get_objects_for_user(user, 'filestore.download_file', files,
+                                   accept_global_perms=False)
+    tags = get_objects_for_user(user, 'filestore.download_tag', Tag,
+                                accept_global_perms=False)
+    return set(by_file.values_list('id', flat=True)) | \
+        set(files.filter(tag__in=tags).values_list('id', flat=True))
+
+
+def visible_user_ids(file):
+    if file.is_public:
+        return set()
+    users = set(get_users_with_perms(
+        file, with_group_users=True, only_with_perms_in=['download_file']
+    ).values_list('id', flat=True))
+    if file.tag_id:
+        users |= set(get_users_with_perms(
+            file.tag, with_group_users=True, only_with_perms_in=['download_tag']
+        ).values_list('id', flat=True))
+    return users
+
+
+def refresh_user_visibility(user):
+    if not isinstance(user, User):
+        user = User.objects.filter(pk=user).first()
+        if user is None:
+            return
+    new = visible_file_ids(user)
+    old = set(FileVisibility.objects.filter(user=user).values_list('file_id', flat=True))
+    FileVisibility.objects.filter(user=user, file_id__in=old - new).delete()
+    FileVisibility.objects.bulk_create(
+        [FileVisibility(user=user, file_id=x) for x in new - old], ignore_conflicts=True)
+
+
+def rebuild_visibility(users):
+    """``refresh_user_visibility`` for each of ``users``, return their count."""
+    count = 0
+    for user in users.iterator():
+        refresh_user_visibility(user)
+        count += 1
+    return count
+
+
+def refresh_file_visibility(file):
+    new = visible_user_ids(file)
+    old = set(FileVisibility.objects.filter(file=file).values_list('user_id', flat=True))
+    FileVisibility.objects.filter(file=file, user_id__in=old - new).delete()
+    FileVisibility.objects.bulk_create(
+        [FileVisibility(user_id=x, file=file) for x in new - old], ignore_conflicts=True)
@@ -0,0 +1,137 @@
+import datetime
+import io
+import json
+import os
+from pathlib import Path
+
+import zstandard
+from django.conf import settings
+
+from .models import OperationLog, RollupWatermark
+from .rollup import WATERMARK, path_template
+
+ARCHIVE_FIELDS = ['id', 'action_time', 'operator', 'ip', 'path',
+                  'method', 'content', 'latency', 'status_code']
+INDEX_FIELDS = ['operator', 'ip', 'path']
+
+
+def archive_root():
+    return Path(settings.OPERATION_LOG_ARCHIVE_ROOT)
+
+
+def day_indexes(day):
+    """Index dicts of every archive part of ``day``."""
+    indexes = []
+    for path in sorted(archive_root().glob('{:%Y}/{:%Y-%m-%d}.*.idx.json'.format(day, day))):
+        with open(path) as f:
+            indexes.append(json.load(f))
+    return indexes
+
+
+def write_day(day, queryset):
+    """Write ``queryset`` to the next free part of ``day``, return its index or None if empty."""
+    directory = archive_root().joinpath('{:%Y}'.format(day))
+    directory.mkdir(parents=True, exist_ok=True)
+    part = len(day_indexes(day))
+    name = '{:%Y-%m-%d}.{}'.format(day, part)
+    data_path = directory.joinpath(name + '.jsonl.zst')
+    tmp_path = directory.joinpath(name + '.jsonl.zst.tmp')
+
+    index = {'day': day.isoformat(), 'file': data_path.name, 'rows': 0,
+             'min_id': None, 'max_id': None}
+    values = {k: set() for k in INDEX_FIELDS}
+    cctx = zstandard.ZstdCompressor(level=settings.OPERATION_LOG_ARCHIVE_LEVEL)
+    with open(tmp_path, 'wb') as f, cctx.stream_writer(f) as writer:
+        for row in queryset.order_by('id').values(*ARCHIVE_FIELDS).iterator(chunk_size=2000):
+            row['action_time'] = row['action_time'].isoformat()
+            writer.write((json.dumps(row, ensure_ascii=False) + '\n').encode())
+            index['rows'] += 1
+            index['min_id'] = index['min_id'] or row['id']
+            index['max_id'] = row['id']
+            values['operator'].add(row['operator'])
+            values['ip'].add(row['ip'])
+            values['path'].add(path_template(row['path']))
+    if not index['rows']:
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, data_path)
+    index.update({k: sorted(v) for k, v in values.items()})
+    with open(directory.joinpath(name + '.idx.json'), 'w') as f:
+        json.dump(index, f, ensure_ascii=False)
+    return index
+
+
+def delete_batched(queryset, batch_size):
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += OperationLog.objects.filter(id__in=ids).delete()[0]
+
+
+def archive_operation_logs(days=None, batch_size=None):
+    """Move whole days older than ``days`` days into compressed archives.
+
+    Only rows already folded into the rollups are moved. Rows of a day that
+    an earlier, interrupted run already archived are deleted instead of
+    being written twice. Returns ``{day: rows archived}``.
+    """
+    days = settings.OPERATION_LOG_ARCHIVE_DAYS if days is None else days
+    batch_size = batch_size or settings.OPERATION_LOG_ARCHIVE_BATCH_SIZE
+    today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+    cutoff = datetime.datetime.combine(today - datetime.timedelta(days=days),
+                                       datetime.time(), tzinfo=datetime.timezone.utc)
+    watermark = RollupWatermark.objects.filter(name=WATERMARK).first()
+    last_id = watermark.last_id if watermark else 0
+
+    queryset = OperationLog.objects.filter(action_time__lt=cutoff, id__lte=last_id)
+    result = {}
+    while True:
+        first = queryset.order_by('action_time').values_list('action_time', flat=True).first()
+        if first is None:
+            return result
+        day = first.astimezone(datetime.timezone.utc).date()
+        start = datetime.datetime.combine(day, datetime.time(), tzinfo=datetime.timezone.utc)
+        rows = queryset.filter(action_time__gte=start, action_time__lt=start + datetime.timedelta(days=1))
+
+        archived = max([x['max_id'] for x in day_indexes(day)], default=None)
+        if archived is not None:
+            delete_batched(rows.filter(id__lte=archived), batch_size)
+            rows = rows.filter(id__gt=archived)
+        index = write_day(day, rows)
+        if index is not None:
+            delete_batched(rows.filter(id__lte=index['max_id']), batch_size)
+            result[day.isoformat()] = index['rows']
+
+
+def search_archive(start, end, operator=None, ip=None, path=None, method=None, status_code=None):
+    """Yield archived rows with ``start <= action_time < end`` matching the filters.
+
+    Parts whose index cannot contain a match are skipped without being read.
+    """
+    dctx = zstandard.ZstdDecompressor()
+    day = start.astimezone(datetime.timezone.utc).date()
+    while day <= end.astimezone(datetime.timezone.utc).date():
+        for index in day_indexes(day):
+            if operator is not None and operator not in index['operator']:
+                continue
+            if ip is not None and ip not in index['ip']:
+                continue
+            if path is not None and path_template(path) not in index['path']:
+                continue
+            data_path = archive_root().joinpath('{:%Y}'.format(day), index['file'])
+            with open(data_path, 'rb') as f, dctx.stream_reader(f) as reader:
+                for line in io.TextIOWrapper(reader, encoding='utf-8'):
+                    row = json.loads(line)
+                    action_time = datetime.datetime.fromisoformat(row['action_time'])
+                    if not start <= action_time < end:
+                        continue
+                    if (operator is not None and row['operator'] != operator) or \
+                            (ip is not None and row['ip'] != ip) or \
+                            (path is not None and row['path'] != path) or \
+                            (method is not None and row['method'] != method) or \
+                            (status_code is not None and row['status_code'] != status_code):
+                        continue
+                    yield row
+        day += datetime.timedelta(days=1)
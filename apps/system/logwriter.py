@@ -0,0 +1,149 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import OperationLog
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop', 'sample', 'block')
+
+
+class OperationLogWriter:
+    """Buffer OperationLog rows and write them in batches off the request path.
+
+    A daemon thread flushes the buffer with one ``bulk_create`` every
+    ``batch_size`` rows or ``flush_interval`` milliseconds, whichever comes
+    first. At interpreter exit the buffer is flushed once more and the
+    batch held by the thread is waited for, at most ``shutdown_timeout``
+    seconds.
+
+    When the buffer is full, ``overflow`` decides what happens to a new row:
+    ``drop`` discards it, ``sample`` waits for room for a ``sample_rate``
+    fraction of rows and discards the rest, ``block`` always waits for room
+    (at most ``block_timeout`` seconds).
+    """
+
+    def __init__(self, buffer_size, batch_size, flush_interval,
+                 overflow='drop', sample_rate=0.1, block_timeout=5, shutdown_timeout=10):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s (is %r)' % (OVERFLOW_POLICIES, overflow))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval / 1000
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.block_timeout = block_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def put(self, log):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(log)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == 'block' or \
+                (self.overflow == 'sample' and random.random() < self.sample_rate):
+            try:
+                self._queue.put(log, timeout=self.block_timeout)
+                return
+            except queue.Full:
+                pass
+        self.count(dropped=1)
+
+    def flush(self):
+        """Write the buffered rows, then wait for the batch held by the thread."""
+        close_old_connections()
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                self.done(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+            self.done(batch)
+        if self._pid == os.getpid() and self._thread.is_alive():
+            with self._queue.all_tasks_done:
+                self._queue.all_tasks_done.wait_for(
+                    lambda: not self._queue.unfinished_tasks, self.shutdown_timeout)
+
+    def write(self, batch):
+        try:
+            OperationLog.objects.bulk_create(batch)
+            self.count(written=len(batch))
+        except Exception:
+            self.count(dropped=len(batch))
+            logger.exception('Failed to write %d operation logs', len(batch))
+
+    def count(self, written=0, dropped=0):
+        with self._counter_lock:
+            self.written += written
+            self.dropped += dropped
+
+    def done(self, batch):
+        for _ in batch:
+            self._queue.task_done()
+
+    def stats(self):
+        return {
+            'buffered': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+    def _ensure_started(self):
+        # Restart the flusher in a forked child, the parent's thread is gone.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='operation-log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            close_old_connections()
+            self.write(batch)
+            self.done(batch)
+
+
+writer = OperationLogWriter(
+    buffer_size=settings.OPERATION_LOG_BUFFER_SIZE,
+    batch_size=settings.OPERATION_LOG_BATCH_SIZE,
+    flush_interval=settings.OPERATION_LOG_FLUSH_INTERVAL,
+    overflow=settings.OPERATION_LOG_OVERFLOW,
+    sample_rate=settings.OPERATION_LOG_SAMPLE_RATE,
+)
+atexit.register(writer.flush)
@@ -0,0 +1,115 @@
+import json
+import logging
+import smtplib
+
+import redis
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+from utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_KEY = 'mail.outbox'
+SCHEDULED_KEY = 'mail.outbox.scheduled'
+DEAD_KEY = 'mail.outbox.dead'
+PROCESSING_KEY = 'mail.outbox.processing'
+LOCK_KEY = 'mail.outbox.lock'
+# Seconds a drain holds the lock per batch, a worker killed mid-batch
+# blocks the next drain at most this long.
+LOCK_TIMEOUT = 300
+
+# Refusals of one message, the connection stays usable for the next one.
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def queue_email(subject, message, recipient_list):
+    """Put a message on the Redis outbox, it is sent by ``flush_email_outbox``.
+
+    The first message of every ``EMAIL_OUTBOX_DELAY`` window schedules a
+    flush, so a burst of messages goes out over one SMTP connection.
+    """
+    from .tasks import flush_email_outbox, send_email
+
+    try:
+        client = get_redis()
+        client.rpush(OUTBOX_KEY, json.dumps([subject, message, recipient_list], ensure_ascii=False))
+        if client.set(SCHEDULED_KEY, 1, nx=True, ex=settings.EMAIL_OUTBOX_DELAY):
+            flush_email_outbox.apply_async(countdown=settings.EMAIL_OUTBOX_DELAY)
+    except redis.RedisError:
+        logger.warning('Email outbox unavailable, sending directly', exc_info=True)
+        send_email.delay(subject, message, recipient_list)
+
+
+def drain_outbox(batch_size):
+    """Send queued messages one by one over a single SMTP connection.
+
+    A batch is moved to ``PROCESSING_KEY`` and every message is removed
+    from there once sent, so messages of a worker killed mid-batch are
+    put back at the head of the outbox by the next run. Only one run
+    drains at a time, others return right away.
+
+    A message the server refuses is put back at the tail of the outbox for
+    the next run, and moved to ``DEAD_KEY`` once refused
+    ``EMAIL_OUTBOX_MAX_ATTEMPTS`` times, so it never holds up the messages
+    behind it. On any other error the unsent messages go back to the head
+    of the outbox before the error propagates. Returns the number of
+    messages sent.
+    """
+    client = get_redis()
+    lock = client.lock(LOCK_KEY, timeout=LOCK_TIMEOUT, blocking_timeout=0)
+    if not lock.acquire():
+        return 0
+    connection = None
+    sent = 0
+    try:
+        requeue(client)
+        # Messages queued or put back meanwhile wait for the next run.
+        remaining = client.llen(OUTBOX_KEY)
+        while remaining > 0:
+            lock.reacquire()
+            pipe = client.pipeline()
+            for _ in range(min(batch_size, remaining)):
+                pipe.lmove(OUTBOX_KEY, PROCESSING_KEY, 'LEFT', 'RIGHT')
+            batch = [raw for raw in pipe.execute() if raw is not None]
+            if not batch:
+                break
+            remaining -= len(batch)
+            for raw in batch:
+                subject, message, recipient_list, *attempts = json.loads(raw)
+                attempts = attempts[0] + 1 if attempts else 1
+                try:
+                    if connection is None:
+                        connection = get_connection()
+                        connection.open()
+                    connection.send_messages([EmailMessage(
+                        subject, message, settings.EMAIL_HOST_USER, recipient_list)])
+                except MESSAGE_ERRORS as e:
+                    logger.warning('Email to %s refused (attempt %d): %r', recipient_list, attempts, e)
+                    entry = json.dumps([subject, message, recipient_list, attempts], ensure_ascii=False)
+                    if attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                        logger.error('Moved refused email to %s to %s', recipient_list, DEAD_KEY)
+                    pipe = client.pipeline()
+                    pipe.lrem(PROCESSING_KEY, 1, raw)
+                    pipe.rpush(DEAD_KEY if attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS else OUTBOX_KEY, entry)
+                    pipe.execute()
+                    continue
+                except Exception:
+                    requeue(client)
+                    raise
+                client.lrem(PROCESSING_KEY, 1, raw)
+                sent += 1
+        return sent
+    finally:
+        if connection is not None:
+            connection.close()
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            logger.warning('Email outbox lock expired during the drain')
+
+
+def requeue(client):
+    """Put the messages left in ``PROCESSING_KEY`` back at the head of the outbox, in order."""
+    while client.lmove(PROCESSING_KEY, OUTBOX_KEY, 'RIGHT', 'LEFT') is not None:
+        pass
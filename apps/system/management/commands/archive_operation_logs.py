@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.system.archive import archive_operation_logs
+
+
+class Command(BaseCommand):
+    help = 'Move old OperationLog rows into compressed day archives.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.OPERATION_LOG_ARCHIVE_DAYS,
+                            help='Archive whole days older than this many days.')
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.OPERATION_LOG_ARCHIVE_BATCH_SIZE,
+                            help='Rows deleted per DELETE statement.')
+
+    def handle(self, *args, **options):
+        result = archive_operation_logs(days=options['days'], batch_size=options['batch_size'])
+        for day, rows in result.items():
+            self.stdout.write('{}: {} rows'.format(day, rows))
+        self.stdout.write(self.style.SUCCESS('Archived {} rows'.format(sum(result.values()))))
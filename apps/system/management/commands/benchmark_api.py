@@ -0,0 +1,215 @@
+import asyncio
+import binascii
+import json
+import os
+import platform
+import random
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from apps.filestore.models import File
+from apps.system.models import User
+from apps.video.models import Video
+from utils.streaming import ASGIHandler
+from utils.tokens import get_token_backend
+
+ENDPOINTS = ('file_list', 'file_download', 'video_list', 'video_range', 'auth_login',
+             'operationlog_list', 'perm_review_list')
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def call(app, host, method, path, query='', headers=None, body=b''):
+    """Send one request through the ASGI ``app``, return (status, headers, body size)."""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', host.encode())] +
+                   [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        'client': ('127.0.0.1', 50000),
+        'server': (host, 80),
+    }
+    received = False
+    response = {'status': None, 'headers': {}, 'size': 0}
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # The client never disconnects first.
+        await asyncio.Future()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {k.decode().lower(): v.decode() for k, v in message['headers']}
+        elif message['type'] == 'http.response.body':
+            response['size'] += len(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return response
+
+
+class Command(BaseCommand):
+    help = ('Drive the hot API endpoints through the in-process ASGI application '
+            'and report throughput, latency percentiles and query counts as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                            help='Comma separated subset of: ' + ', '.join(ENDPOINTS))
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Measured requests per endpoint.')
+        parser.add_argument('--warmup', type=int, default=20,
+                            help='Unmeasured requests per endpoint sent first.')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--username', default='seed_admin',
+                            help='User whose token authenticates the requests.')
+        parser.add_argument('--login-username', default='seed_user_0')
+        parser.add_argument('--login-password', default='seed_user')
+        parser.add_argument('--range-size', type=int, default=1024 * 1024,
+                            help='Bytes read per video range request.')
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        endpoints = [e for e in options['endpoints'].split(',') if e]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError('Unknown endpoints: ' + ', '.join(sorted(unknown)))
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('User {} not found, run generate_data first'.format(options['username']))
+
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.auth = {'authorization': 'Bearer ' + get_token_backend().issue(user)}
+        self.file_ids = list(File.objects.filter(is_public=True).values_list('id', flat=True)[:1000])
+        self.video_ids = list(Video.objects.exclude(video='').values_list('id', flat=True)[:1000])
+        self.video_size = Video.objects.get(id=self.video_ids[0]).video.size if self.video_ids else 0
+        # Tokens ``study`` would hand out, set directly so the benchmark
+        # measures streaming only.
+        self.video_tokens = {}
+        for pk in self.video_ids:
+            token = binascii.hexlify(os.urandom(20)).decode()
+            cache.set('video.token.' + token, pk, 3600)
+            self.video_tokens[pk] = token
+
+        app = ASGIHandler()
+        results = {}
+        # Query counts are read from the X-DB-Query-Count header.
+        with override_settings(QUERY_COUNT_HEADERS=True):
+            for name in endpoints:
+                results[name] = asyncio.run(self.run(app, name))
+                self.stderr.write('{}: {:.1f} req/s, p99 {} ms'.format(
+                    name, results[name]['throughput'], results[name]['latency_ms']['p99']))
+
+        report = json.dumps({
+            'meta': {
+                'time': datetime.now(tz=timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'concurrency': options['concurrency'],
+                'requests': options['requests'],
+                'seed': options['seed'],
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        self.stdout.write(report)
+
+    def build(self, name):
+        """(method, path, query, headers, body) of one request to ``name``."""
+        if name == 'file_list':
+            return 'GET', reverse('file-list'), '', self.auth, b''
+        if name == 'file_download':
+            path = reverse('file-download', args=[self.rng.choice(self.file_ids)])
+            return 'POST', path, '', self.auth, b''
+        if name == 'video_list':
+            return 'GET', reverse('video-list'), '', self.auth, b''
+        if name == 'video_range':
+            pk = self.rng.choice(self.video_ids)
+            first = self.rng.randrange(max(self.video_size - self.options['range_size'], 1))
+            headers = {'range': 'bytes={}-{}'.format(first, first + self.options['range_size'] - 1)}
+            query = urlencode({'token': self.video_tokens[pk]})
+            return 'GET', reverse('video-video', args=[pk]), query, headers, b''
+        if name == 'auth_login':
+            body = json.dumps({'username': self.options['login_username'],
+                               'password': self.options['login_password']}).encode()
+            return 'POST', reverse('auth-login'), '', {'content-type': 'application/json'}, body
+        if name == 'operationlog_list':
+            return 'GET', reverse('operationlog-list'), '', self.auth, b''
+        if name == 'perm_review_list':
+            return 'GET', reverse('permreview-list'), '', self.auth, b''
+
+    async def run(self, app, name):
+        if name == 'file_download' and not self.file_ids or \
+                name == 'video_range' and not self.video_ids:
+            raise CommandError('No rows to request for {}, run generate_data first'.format(name))
+        host = self.options['host']
+        for _ in range(self.options['warmup']):
+            await call(app, host, *self.build(name))
+
+        queue = asyncio.Queue()
+        for _ in range(self.options['requests']):
+            queue.put_nowait(self.build(name))
+        latencies, queries, errors, size = [], [], 0, 0
+
+        async def worker():
+            nonlocal errors, size
+            while not queue.empty():
+                request = queue.get_nowait()
+                start = time.perf_counter()
+                response = await call(app, host, *request)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if response['status'] >= 400:
+                    errors += 1
+                size += response['size']
+                if 'x-db-query-count' in response['headers']:
+                    queries.append(int(response['headers']['x-db-query-count']))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(self.options['concurrency'])])
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'throughput': round(len(latencies) / elapsed, 2),
+            'bytes': size,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies), 2),
+                'p50': round(percentile(latencies, 0.5), 2),
+                'p90': round(percentile(latencies, 0.9), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+                'max': round(latencies[-1], 2),
+            },
+            'queries': {
+                'mean': round(sum(queries) / len(queries), 2),
+                'max': max(queries),
+            } if queries else None,
+        }
@@ -0,0 +1,74 @@
+import io
+import timeit
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from apps.filestore.models import File, ShareLink
+from apps.filestore.serializers import FileListSerializer, ShareLinkSerializer
+from apps.system.models import OperationLog
+from apps.system.serializers import OperationLogSerializer
+from utils import renderers
+
+DATASETS = (
+    ('operationlog', OperationLog.objects.order_by('-id'), OperationLogSerializer),
+    ('files', File.objects.select_related('created_by', 'updated_by').order_by('-id'),
+     FileListSerializer),
+    ('sharelinks', ShareLink.objects.select_related(
+        'file__created_by', 'file__updated_by', 'created_by', 'updated_by').order_by('-created_at'),
+     ShareLinkSerializer),
+)
+
+
+def measure(func, number, repeat):
+    """Best time per call in ms and peak bytes allocated by one call."""
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1000
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+class Command(BaseCommand):
+    help = ('Compare JSONRenderer/JSONParser with the orjson backed pair on '
+            'serializer output of existing rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000,
+                            help='Rows serialized per dataset.')
+        parser.add_argument('--number', type=int, default=20,
+                            help='Calls per timing run.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timing runs, the best one is reported.')
+
+    def handle(self, *args, **options):
+        if renderers.orjson is None:
+            raise CommandError('orjson is not installed')
+        pairs = (
+            ('json', JSONRenderer(), JSONParser()),
+            ('orjson', renderers.ORJSONRenderer(), renderers.ORJSONParser()),
+        )
+        self.stdout.write('{:<14}{:<8}{:>10}{:>12}{:>12}{:>12}{:>12}'.format(
+            'dataset', 'impl', 'bytes', 'encode ms', 'encode peak', 'decode ms', 'decode peak'))
+        for name, queryset, serializer_class in DATASETS:
+            data = serializer_class(queryset[:options['rows']], many=True).data
+            if not data:
+                self.stdout.write('{:<14}no rows'.format(name))
+                continue
+            baseline = None
+            for impl, renderer, parser in pairs:
+                body = renderer.render(data)
+                encode, encode_peak = measure(lambda: renderer.render(data),
+                                              options['number'], options['repeat'])
+                decode, decode_peak = measure(lambda: parser.parse(io.BytesIO(body)),
+                                              options['number'], options['repeat'])
+                line = '{:<14}{:<8}{:>10}{:>12.2f}{:>12}{:>12.2f}{:>12}'.format(
+                    name, impl, len(body), encode, encode_peak, decode, decode_peak)
+                if baseline is None:
+                    baseline = encode
+                else:
+                    line += '  x{:.1f} encode'.format(baseline / encode)
+                self.stdout.write(line)
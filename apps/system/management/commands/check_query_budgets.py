@@ -0,0 +1,105 @@
+import random
+import time
+from importlib import import_module
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import NoReverseMatch, reverse
+from rest_framework.test import APIClient
+
+from apps.system.seed import seed
+from utils.querylog import QueryRecorder
+
+
+def routes():
+    """(name, viewset, action, url) of every GET endpoint of the app routers."""
+    for config in apps.get_app_configs():
+        if not config.name.startswith('apps.'):
+            continue
+        try:
+            router = import_module(config.name + '.urls').router
+        except (ImportError, AttributeError):
+            continue
+        for prefix, viewset, basename in router.registry:
+            obj = None
+            queryset = getattr(viewset, 'queryset', None)
+            if queryset is not None:
+                obj = queryset.model._default_manager.order_by('pk').first()
+            actions = []
+            if hasattr(viewset, 'list'):
+                actions.append(('list', basename + '-list', ()))
+            if hasattr(viewset, 'retrieve') and obj is not None:
+                actions.append(('retrieve', basename + '-detail',
+                                (getattr(obj, viewset.lookup_field or 'pk'),)))
+            for extra in viewset.get_extra_actions():
+                if not extra.detail and 'get' in extra.mapping:
+                    actions.append((extra.__name__, '{}-{}'.format(basename, extra.url_name), ()))
+            for action, name, args in actions:
+                try:
+                    url = reverse(name, args=args)
+                except NoReverseMatch:
+                    continue
+                yield '{}.{}'.format(prefix, action), viewset, action, url
+
+
+class Command(BaseCommand):
+    help = ('Seed a test database, request every GET endpoint and fail when an '
+            'endpoint exceeds its query or latency budget.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50,
+                            help='Rows seeded per model.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            failures = self.check(options['rows'], options['seed'])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        if failures:
+            raise CommandError('{} endpoint(s) over budget:\n{}'.format(
+                len(failures), '\n'.join(failures)))
+        self.stdout.write(self.style.SUCCESS('All endpoints within budget'))
+
+    def check(self, rows, seed_value):
+        admin = seed(rows, random.Random(seed_value))
+        client = APIClient()
+        client.force_authenticate(admin)
+        failures = []
+        for name, viewset, action, url in routes():
+            max_queries, max_ms = getattr(viewset, 'query_budgets', {}).get(
+                action, settings.QUERY_BUDGET_DEFAULT)
+            # The first request warms per-process caches (content types,
+            # query plans), only the second one is measured.
+            client.get(url)
+            recorder = QueryRecorder()
+            start = time.perf_counter()
+            with recorder.record():
+                response = client.get(url)
+            elapsed = (time.perf_counter() - start) * 1000
+
+            problems = []
+            if response.status_code >= 500:
+                problems.append('status {}'.format(response.status_code))
+            if recorder.count > max_queries:
+                problems.append('{} queries > {}'.format(recorder.count, max_queries))
+            if elapsed > max_ms:
+                problems.append('{:.0f}ms > {}ms'.format(elapsed, max_ms))
+            duplicates = recorder.duplicates()
+            line = '{:<40} {:>3} {:>4} queries {:>7.1f}ms {:>2} duplicated'.format(
+                name, response.status_code, recorder.count, elapsed, len(duplicates))
+            if problems:
+                failures.append('{}: {}'.format(name, ', '.join(problems)))
+                for sql, n in list(duplicates.items())[:3]:
+                    failures.append('    {}x {}'.format(n, sql[:200]))
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        return failures
@@ -0,0 +1,58 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.system import seed
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with generated users, files, videos, permissions and logs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--files', type=int, default=200000)
+        parser.add_argument('--videos', type=int, default=100000)
+        parser.add_argument('--object-perms', type=int, default=500000,
+                            help='Guardian per-file download permissions.')
+        parser.add_argument('--perm-reviews', type=int, default=100000)
+        parser.add_argument('--logs', type=int, default=2000000,
+                            help='OperationLog rows, spread over --days.')
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--file-size', type=int, default=1024 * 1024,
+                            help='Size in bytes of the file every File row points to.')
+        parser.add_argument('--video-size', type=int, default=64 * 1024 * 1024,
+                            help='Size in bytes of the file every Video row points to.')
+        parser.add_argument('--password', default='seed_user',
+                            help='Password of the generated users.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed, equal seeds generate equal data.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        seed.seed_admin(options['password'])
+
+        user_ids = self.step('users', seed.seed_users, options['users'], options['password'],
+                             batch_size=batch_size)
+        file_ids = self.step('files', seed.seed_files, options['files'], user_ids, rng,
+                             size=options['file_size'], batch_size=batch_size)
+        self.step('videos', seed.seed_videos, options['videos'], user_ids, rng,
+                  size=options['video_size'], batch_size=batch_size)
+        self.step('object perms', seed.seed_object_perms, options['object_perms'],
+                  user_ids, file_ids, rng, batch_size=batch_size)
+        self.step('perm reviews', seed.seed_perm_reviews, options['perm_reviews'],
+                  user_ids, file_ids, rng, batch_size=batch_size)
+        self.step('operation logs', seed.seed_operation_logs, options['logs'], user_ids, rng,
+                  days=options['days'], batch_size=batch_size)
+        self.step('file visibility', seed.seed_visibility)
+        self.stdout.write(self.style.SUCCESS('Done, superuser seed_admin and users {}<n> '
+                                             'use password "{}"'.format(seed.USER_PREFIX,
+                                                                        options['password'])))
+
+    def step(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.stdout.write('{}: {:.1f}s'.format(name, time.perf_counter() - start))
+        return result
@@ -0,0 +1,119 @@
+import json
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What each kind of process imports before serving its first request or task.
+TARGETS = {
+    'setup': 'import django; django.setup()',
+    'asgi': ('from django_project.asgi import application\n'
+             'from django.urls import get_resolver\n'
+             'get_resolver().url_patterns'),
+    'celery': ('from django_project.celery import app\n'
+               'app.loader.import_default_modules()'),
+}
+
+# Records the RSS at the start of every import, the growth until the next
+# import is attributed to the module being imported.
+CHILD = '''
+import json, os, sys
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+samples = []
+
+def hook(event, args):
+    if event == 'import':
+        samples.append((args[0], rss()))
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
+start = rss()
+sys.addaudithook(hook)
+{code}
+samples.append((None, rss()))
+print(json.dumps({{'start': start, 'samples': samples}}))
+'''
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse_importtime(stderr):
+    """{module: (self_us, cumulative_us)} from ``-X importtime`` output."""
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return modules
+
+
+def rss_by_module(samples):
+    rss = defaultdict(int)
+    for (name, before), (_, after) in zip(samples, samples[1:]):
+        rss[name] += max(after - before, 0)
+    return rss
+
+
+class Command(BaseCommand):
+    help = ('Import the project in a fresh interpreter and report import time '
+            'and resident memory per package.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=sorted(TARGETS), default='asgi',
+                            help='Startup path to profile.')
+        parser.add_argument('--limit', type=int, default=25,
+                            help='Rows shown per table.')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+
+    def handle(self, *args, **options):
+        if not sys.platform.startswith('linux'):
+            raise CommandError('RSS is read from /proc, Linux only')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', CHILD.format(code=TARGETS[options['target']])],
+            cwd=settings.BASE_DIR, capture_output=True, text=True)
+        if result.returncode:
+            raise CommandError(result.stderr[-2000:])
+
+        times = parse_importtime(result.stderr)
+        memory = json.loads(result.stdout.splitlines()[-1])
+        rss = rss_by_module(memory['samples'])
+        packages = defaultdict(lambda: [0, 0])
+        for name, (self_us, _) in times.items():
+            packages[name.split('.')[0]][0] += self_us
+        for name, size in rss.items():
+            if name:
+                packages[name.split('.')[0]][1] += size
+
+        limit = options['limit']
+        report = {
+            'target': options['target'],
+            'total_ms': round(sum(t[0] for t in times.values()) / 1000, 1),
+            'total_rss_mb': round((memory['samples'][-1][1] - memory['start']) / 2 ** 20, 1),
+            'packages': [
+                {'package': name, 'self_ms': round(us / 1000, 1), 'rss_mb': round(size / 2 ** 20, 1)}
+                for name, (us, size) in sorted(packages.items(), key=lambda x: -x[1][0])[:limit]
+            ],
+            'modules': [
+                {'module': name, 'cumulative_ms': round(cumulative / 1000, 1),
+                 'rss_mb': round(rss.get(name, 0) / 2 ** 20, 1)}
+                for name, (_, cumulative) in sorted(times.items(), key=lambda x: -x[1][1])[:limit]
+            ],
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write('{}: {} ms, {} MiB'.format(
+            report['target'], report['total_ms'], report['total_rss_mb']))
+        self.stdout.write('\n{:<40}{:>10}{:>10}'.format('package', 'self ms', 'rss MiB'))
+        for row in report['packages']:
+            self.stdout.write('{:<40}{:>10}{:>10}'.format(row['package'], row['self_ms'], row['rss_mb']))
+        self.stdout.write('\n{:<60}{:>10}{:>10}'.format('module', 'cum ms', 'rss MiB'))
+        for row in report['modules']:
+            self.stdout.write('{:<60}{:>10}{:>10}'.format(row['module'], row['cumulative_ms'], row['rss_mb']))
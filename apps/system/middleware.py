@@ -1,22 +1,61 @@
 from datetime import datetime, timezone
 import json
+import logging
 import time
 
+from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
 
+from utils import get_client_ip
+from utils.querylog import QueryRecorder
+
+from .logwriter import writer
 from .models import OperationLog
 
 
-class OperationLogMiddleware(MiddlewareMixin):
+logger = logging.getLogger(__name__)
 
-    exclude_urls = []
+
+class QueryCountMiddleware:
+    """Record query count, DB time and repeated query shapes per request.
+
+    Reported in ``X-DB-*`` response headers when ``QUERY_COUNT_HEADERS`` is
+    on, and logged per route when ``DEBUG`` is off.
+    """
 
     def __init__(self, get_response):
-        super().__init__(get_response)
-        self.action_time = None
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with recorder.record():
+            response = self.get_response(request)
+        elapsed = (time.perf_counter() - start) * 1000
+        duplicates = recorder.duplicates()
+
+        if settings.QUERY_COUNT_HEADERS:
+            response['X-DB-Query-Count'] = str(recorder.count)
+            response['X-DB-Time'] = '%.1f' % (recorder.time * 1000)
+            response['X-DB-Duplicate-Queries'] = str(len(duplicates))
+        if not settings.DEBUG:
+            match = request.resolver_match
+            route = match.route if match else request.path
+            level = logging.WARNING if duplicates else logging.INFO
+            logger.log(level, '%s %s queries=%d db_ms=%.1f total_ms=%.1f duplicates=%s',
+                       request.method, route, recorder.count, recorder.time * 1000,
+                       elapsed, list(duplicates.items())[:3])
+        return response
+
+
+class OperationLogMiddleware(MiddlewareMixin):
+    """Record mutating requests, rows are written in batches by ``writer``,
+    or right away with ``OPERATION_LOG_SYNC``."""
+
+    exclude_urls = []
 
     def process_request(self, request):
-        self.action_time = time.time()
+        request.action_time = time.time()
 
     def process_response(self, request, response):
         if request.method in ('GET', 'HEAD', 'OPTIONS'):
@@ -26,11 +65,10 @@ class OperationLogMiddleware(MiddlewareMixin):
             if url in request.path:
                 return response
 
-        latency = round((time.time() - self.action_time)*1000)
+        action_time = getattr(request, 'action_time', None) or time.time()
+        latency = round((time.time() - action_time)*1000)
 
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        ip = x_forwarded_for.split(",")[0] if x_forwarded_for \
-                else request.META.get('REMOTE_ADDR')
+        ip = get_client_ip(request)
 
         content = ""
         if request.POST:
@@ -45,8 +83,8 @@ class OperationLogMiddleware(MiddlewareMixin):
             except:
                 pass
 
-        OperationLog.objects.create(
-            action_time=datetime.fromtimestamp(self.action_time, tz=timezone.utc),
+        log = OperationLog(
+            action_time=datetime.fromtimestamp(action_time, tz=timezone.utc),
             operator=request.user.username,
             ip=ip,
             path=request.path,
@@ -55,6 +93,10 @@ class OperationLogMiddleware(MiddlewareMixin):
             latency=latency,
             status_code=response.status_code
         )
+        if settings.OPERATION_LOG_SYNC:
+            writer.write([log])
+        else:
+            writer.put(log)
         return response
 
     def clean_secret(self, data):
@@ -1,6 +1,3 @@
-import datetime
-import random
-
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser, Permission
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -14,6 +11,11 @@ GENDERS = (
     ('female', 'Female'),
 )
 
+GRANULARITIES = (
+    ('minute', 'Minute'),
+    ('hour', 'Hour'),
+)
+
 STATUS_CHOICES = (
     (0, 'Pending'),
     (1, 'Approve'),
@@ -30,39 +32,52 @@ class OperationLog(models.Model):
     content = models.TextField(null=True)
     latency = models.IntegerField(verbose_name='响应耗时/ms')
     status_code = models.IntegerField()
+    # Insert time, rows are buffered after the request, see rollup_operation_logs
+    created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = 'system_operation_log'
 
 
-class Profile(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
-    full_name = models.CharField(max_length=64)
-    gender = models.CharField(choices=GENDERS, max_length=8, null=True, blank=True)
-    avatar = models.CharField(max_length=256, null=True, blank=True)
-    mobile = models.CharField(max_length=15, unique=True, null=True, blank=True)
+class OperationLogRollup(models.Model):
+    granularity = models.CharField(choices=GRANULARITIES, max_length=8)
+    bucket = models.DateTimeField()
+    path = models.CharField(max_length=255)
+    method = models.CharField(max_length=11)
+    status_class = models.IntegerField()
+    count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    latency_sum = models.BigIntegerField(default=0)
+    latency_max = models.IntegerField(default=0)
+    histogram = models.JSONField(default=list)
 
+    class Meta:
+        db_table = 'system_operation_log_rollup'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket', 'path', 'method', 'status_class'],
+                name='unique_operation_log_rollup',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket']),
+        ]
 
-class VerificationCode(models.Model):
-    code = models.CharField(max_length=6)
-    created_at = models.DateTimeField(auto_now_add=True)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='codes')
+
+class RollupWatermark(models.Model):
+    name = models.CharField(max_length=64, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
 
     class Meta:
-        db_table = 'system_verification_code'
+        db_table = 'system_rollup_watermark'
 
-    def save(self, *args, **kwargs):
-        if not self.code:
-            self.code = '{:0>6}'.format(random.randint(0, 999999))
-        return super().save(*args, **kwargs)
 
-    def is_expired(self):
-        if not self.created_at:
-            return False
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
-        if self.created_at + datetime.timedelta(hours=1) >= now:
-            return False
-        return True
+class Profile(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    full_name = models.CharField(max_length=64)
+    gender = models.CharField(choices=GENDERS, max_length=8, null=True, blank=True)
+    avatar = models.CharField(max_length=256, null=True, blank=True)
+    mobile = models.CharField(max_length=15, unique=True, null=True, blank=True)
 
 
 class PermReview(models.Model):
@@ -89,3 +104,10 @@ class PermReview(models.Model):
         indexes = [
             models.Index(fields=["content_type", "object_id"]),
         ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['requester', 'permission', 'content_type', 'object_id'],
+                condition=models.Q(status=0),
+                name='unique_pending_perm_review',
+            ),
+        ]
@@ -1,6 +1,6 @@
 from django.conf import settings
 
-from .tasks import send_email
+from .mail import queue_email
 
 
 def notify_register(user):
@@ -12,7 +12,7 @@ def notify_register(user):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '新用户注册等待审核',
         msg,
         settings.ADMIN_EMAIL_LIST,
@@ -24,7 +24,7 @@ def notify_register(user):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '您已成功提交帐号申请',
         msg,
         [user.email],
@@ -38,7 +38,7 @@ def notify_active(user):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '您的帐号已激活',
         msg,
         [user.email],
@@ -52,23 +52,23 @@ def notify_inactive(user):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '抱歉，您的帐号申请未通过',
         msg,
         [user.email],
     )
 
 
-def send_email_code(code):
-    msg = f"""{code.user.username} 您好：
+def send_email_code(user, code):
+    msg = f"""{user.username} 您好：
 
-    验证码: {code.code}
+    验证码: {code}
     有效期1小时，请尽快验证
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '验证码',
         msg,
-        [code.user.email],
+        [user.email],
     )
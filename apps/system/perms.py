@@ -1,28 +1,82 @@
 from django.conf import settings
 from django.contrib.auth.models import Permission
+from django.db import IntegrityError, transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from guardian.models import UserObjectPermission
 from guardian.shortcuts import assign_perm, remove_perm
+from rest_framework.exceptions import ValidationError
+
+from utils.perm_cache import invalidate_user_perms
 
 from .models import PermReview
-from .tasks import send_email
+from .mail import queue_email
+
+
+def get_permission(perm):
+    if isinstance(perm, Permission):
+        return perm
+    try:
+        app_label, codename = perm.split('.', 1)
+    except ValueError:
+        raise ValueError("For global permissions, first argument must be in"
+                         " format: 'app_label.codename' (is %r)" % perm)
+    return Permission.objects.select_related('content_type').get(
+        content_type__app_label=app_label, codename=codename)
+
+
+def bulk_assign_perm(perm, pairs):
+    """Grant ``perm`` for every ``(user_id, object_pk)`` pair in one INSERT."""
+    perm = get_permission(perm)
+    UserObjectPermission.objects.bulk_create([
+        UserObjectPermission(permission=perm, content_type_id=perm.content_type_id,
+                             user_id=user_id, object_pk=str(object_pk))
+        for user_id, object_pk in pairs
+    ], ignore_conflicts=True)
+
+
+def bulk_remove_perm(perm, pairs):
+    """Revoke ``perm`` for every ``(user_id, object_pk)`` pair, one DELETE per user."""
+    perm = get_permission(perm)
+    by_user = {}
+    for user_id, object_pk in pairs:
+        by_user.setdefault(user_id, []).append(str(object_pk))
+    for user_id, object_pks in by_user.items():
+        UserObjectPermission.objects.filter(
+            permission=perm, user_id=user_id, object_pk__in=object_pks).delete()
+
+
+def sync_user_object_perms(perm, user, object_ids):
+    """Make ``user`` hold ``perm`` on exactly ``object_ids``.
+
+    Unknown ids are rejected as a whole before anything changes.
+    """
+    perm = get_permission(perm)
+    model = perm.content_type.model_class()
+    object_ids = set(object_ids)
+    found = set(model.objects.filter(pk__in=object_ids).values_list('pk', flat=True))
+    unknown = object_ids - found
+    if unknown:
+        raise ValidationError({'unknown_ids': sorted(unknown)})
+
+    wanted = {str(pk) for pk in found}
+    existing = set(UserObjectPermission.objects.filter(
+        permission=perm, user=user).values_list('object_pk', flat=True))
+    with transaction.atomic():
+        bulk_remove_perm(perm, [(user.pk, pk) for pk in existing - wanted])
+        bulk_assign_perm(perm, [(user.pk, pk) for pk in wanted - existing])
+        invalidate_user_perms(user)
 
 
 def perm_request(perm, user, obj):
-    if not isinstance(perm, Permission):
-        try:
-            app_label, codename = perm.split('.', 1)
-        except ValueError:
-            raise ValueError("For global permissions, first argument must be in"
-                             " format: 'app_label.codename' (is %r)" % perm)
-        perm = Permission.objects.get(content_type__app_label=app_label,
-                                      codename=codename)
-
-    exist = PermReview.objects.filter(
-        object_id=obj.id, permission=perm, requester=user, status=0).count()
-    if exist:
-        return
+    perm = get_permission(perm)
 
-    pr = PermReview(content_object=obj, permission=perm, requester=user)
-    pr.save()
+    # Pending reviews are unique per (requester, permission, object).
+    try:
+        with transaction.atomic():
+            PermReview.objects.create(content_object=obj, permission=perm, requester=user)
+    except IntegrityError:
+        return
 
     msg = f"""权限申请审核
 
@@ -32,7 +86,7 @@ def perm_request(perm, user, obj):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '权限申请',
         msg,
         settings.ADMIN_EMAIL_LIST,
@@ -41,6 +95,7 @@ def perm_request(perm, user, obj):
 
 def perm_approve(perm, user, obj):
     assign_perm(perm, user, obj)
+    invalidate_user_perms(user)
 
     msg = f"""{user.username} 您好：
 
@@ -51,7 +106,7 @@ def perm_approve(perm, user, obj):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '您申请的权限已通过',
         msg,
         [user.email],
@@ -59,6 +114,7 @@ def perm_approve(perm, user, obj):
 
 def perm_reject(perm, user, obj):
     remove_perm(perm, user, obj)
+    invalidate_user_perms(user)
 
     msg = f"""{user.username} 您好：
 
@@ -69,8 +125,56 @@ def perm_reject(perm, user, obj):
 
     - {settings.EMAIL_SIGNATURE}
     """
-    send_email.delay(
+    queue_email(
         settings.EMAIL_SUBJECT_PREFIX + '抱歉，您申请的权限未通过',
         msg,
         [user.email],
     )
+
+
+def perm_review_bulk(reviews, approve, reviewer):
+    """Approve or reject the pending reviews of queryset ``reviews`` at once.
+
+    Guardian rows and review statuses change in one transaction, then each
+    requester gets a single email. Returns the number of reviews handled.
+    """
+    with transaction.atomic():
+        reviews = list(reviews.filter(status=0).select_for_update(of=('self',))
+                       .select_related('permission', 'requester'))
+        if not reviews:
+            return 0
+        by_perm = {}
+        for review in reviews:
+            by_perm.setdefault(review.permission, []).append(
+                (review.requester_id, review.object_id))
+        for perm, pairs in by_perm.items():
+            if approve:
+                bulk_assign_perm(perm, pairs)
+            else:
+                bulk_remove_perm(perm, pairs)
+        PermReview.objects.filter(id__in=[x.id for x in reviews]).update(
+            status=1 if approve else 2, reviewer=reviewer, updated_at=timezone.now())
+        invalidate_user_perms(*{x.requester_id for x in reviews})
+
+    prefetch_related_objects(reviews, 'content_object')
+    by_requester = {}
+    for review in reviews:
+        by_requester.setdefault(review.requester, []).append(review)
+    for user, items in by_requester.items():
+        lines = '\n    '.join(
+            f"权限：{x.permission.codename}  资源：{getattr(x.content_object, 'name', x.object_id)}"
+            for x in items)
+        if approve:
+            title, text = '您申请的权限已通过', '您申请的以下权限已通过'
+        else:
+            title, text = '抱歉，您申请的权限未通过', '抱歉，您申请的以下权限未通过'
+        msg = f"""{user.username} 您好：
+
+    {text}
+
+    {lines}
+
+    - {settings.EMAIL_SIGNATURE}
+    """
+        queue_email(settings.EMAIL_SUBJECT_PREFIX + title, msg, [user.email])
+    return len(reviews)
@@ -0,0 +1,134 @@
+import datetime
+import re
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import OperationLog, OperationLogRollup, RollupWatermark
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket of a
+# histogram counts everything above LATENCY_BUCKETS[-1].
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+GRANULARITY_TRUNC = {
+    'minute': lambda t: t.replace(second=0, microsecond=0),
+    'hour': lambda t: t.replace(minute=0, second=0, microsecond=0),
+}
+
+ID_SEGMENT_RE = re.compile(r'^(\d+|[0-9a-fA-F-]{32,36}|(?=.*\d)[0-9A-Za-z]{20,})$')
+
+WATERMARK = 'operation_log'
+
+
+def path_template(path):
+    """Replace id-like segments, ``/api/users/12/active/`` -> ``/api/users/:id/active/``."""
+    return '/'.join(':id' if ID_SEGMENT_RE.match(seg) else seg for seg in path.split('/'))
+
+
+def new_histogram():
+    return [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def percentile(histogram, q, latency_max=None):
+    """Upper bound of the bucket holding the q-th quantile."""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(histogram):
+        seen += n
+        if seen >= rank:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else latency_max
+    return latency_max
+
+
+def latency_summary(count, latency_sum, latency_max, histogram):
+    return {
+        'avg': round(latency_sum / count) if count else None,
+        'max': latency_max,
+        'p50': percentile(histogram, 0.5, latency_max),
+        'p95': percentile(histogram, 0.95, latency_max),
+        'p99': percentile(histogram, 0.99, latency_max),
+    }
+
+
+def aggregate(rows):
+    aggregates = {}
+    for action_time, path, method, status_code, latency in rows:
+        template = path_template(path)
+        status_class = status_code // 100
+        for granularity, trunc in GRANULARITY_TRUNC.items():
+            key = (granularity, trunc(action_time), template, method, status_class)
+            agg = aggregates.get(key)
+            if agg is None:
+                agg = aggregates[key] = {
+                    'count': 0, 'error_count': 0, 'latency_sum': 0,
+                    'latency_max': 0, 'histogram': new_histogram(),
+                }
+            agg['count'] += 1
+            agg['error_count'] += status_code >= 500
+            agg['latency_sum'] += latency
+            agg['latency_max'] = max(agg['latency_max'], latency)
+            agg['histogram'][bisect_left(LATENCY_BUCKETS, latency)] += 1
+    return aggregates
+
+
+def merge(aggregates):
+    buckets = {key[1] for key in aggregates}
+    existing = {
+        (r.granularity, r.bucket, r.path, r.method, r.status_class): r
+        for r in OperationLogRollup.objects.select_for_update().filter(bucket__in=buckets)
+    }
+    created, updated = [], []
+    for key, agg in aggregates.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            granularity, bucket, path, method, status_class = key
+            created.append(OperationLogRollup(
+                granularity=granularity, bucket=bucket, path=path,
+                method=method, status_class=status_class, **agg))
+            continue
+        rollup.count += agg['count']
+        rollup.error_count += agg['error_count']
+        rollup.latency_sum += agg['latency_sum']
+        rollup.latency_max = max(rollup.latency_max, agg['latency_max'])
+        rollup.histogram = [a + b for a, b in zip(rollup.histogram, agg['histogram'])]
+        updated.append(rollup)
+    OperationLogRollup.objects.bulk_create(created)
+    OperationLogRollup.objects.bulk_update(
+        updated, ['count', 'error_count', 'latency_sum', 'latency_max', 'histogram'])
+
+
+def rollup_operation_logs(batch_size=10000):
+    """Fold OperationLog rows past the id watermark into the rollup table.
+
+    The watermark only moves over rows inserted more than
+    ``OPERATION_LOG_ROLLUP_SETTLE`` seconds ago. A row with a lower id that
+    is still uncommitted would have been inserted even earlier, so the
+    grace period keeps in-flight inserts of other processes from being
+    skipped. ``action_time`` (the request start) only picks the bucket.
+    Returns the number of rows processed.
+    """
+    cutoff = datetime.datetime.now(tz=datetime.timezone.utc) - \
+        datetime.timedelta(seconds=settings.OPERATION_LOG_ROLLUP_SETTLE)
+    processed = 0
+    while True:
+        with transaction.atomic():
+            watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+            rows = OperationLog.objects.filter(id__gt=watermark.last_id).order_by('id').values_list(
+                'id', 'created_at', 'action_time', 'path', 'method', 'status_code', 'latency')[:batch_size]
+            settled = []
+            for row in rows:
+                if row[1] >= cutoff:
+                    break
+                settled.append(row)
+            if not settled:
+                return processed
+            merge(aggregate(row[2:] for row in settled))
+            watermark.last_id = settled[-1][0]
+            watermark.save()
+        processed += len(settled)
+        if len(settled) < batch_size:
+            return processed
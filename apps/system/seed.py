@@ -0,0 +1,202 @@
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate, islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from guardian.models import UserObjectPermission
+
+from apps.filestore.models import File, ShareLink, Tag, fs as file_storage
+from apps.filestore.visibility import rebuild_visibility
+from apps.system.models import OperationLog, OperationLogRollup, PermReview, Profile, User
+from apps.video.models import Category, Video, fs as video_storage
+
+SAMPLE_FILE = 'seed/sample.bin'
+SAMPLE_VIDEO = 'seed/sample.mp4'
+USER_PREFIX = 'seed_user_'
+VIDEO_FIRST_ID = 10000000
+
+# (method, path, weight) of the generated operation log traffic
+LOG_ROUTES = (
+    ('GET', '/api/filestore/files/', 30),
+    ('POST', '/api/filestore/files/{}/download/', 15),
+    ('GET', '/api/video/videos/', 20),
+    ('GET', '/api/video/videos/{}/video/', 20),
+    ('POST', '/api/auth/login/', 5),
+    ('GET', '/api/perm_review/', 5),
+    ('POST', '/api/users/{}/active/', 5),
+)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert(model, objs, batch_size=1000, ignore_conflicts=False):
+    """``bulk_create`` a generator of rows ``batch_size`` at a time, return the row count.
+
+    With ``ignore_conflicts`` rows already in the table are skipped and still counted.
+    """
+    count = 0
+    for chunk in batched(objs, batch_size):
+        model.objects.bulk_create(chunk, ignore_conflicts=ignore_conflicts)
+        count += len(chunk)
+    return count
+
+
+def sample_file(storage, name, size):
+    """Write a ``size`` bytes file once, every seeded row points to it."""
+    if storage.exists(name) and storage.size(name) == size:
+        return name
+    path = storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    block = b'\0' * (1024 * 1024)
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+    return name
+
+
+def seed_users(count, password, batch_size=1000):
+    """Users ``seed_user_<n>`` sharing one password, half of them in ``seed_group``."""
+    start = User.objects.filter(username__startswith=USER_PREFIX).count()
+    password = make_password(password)
+    insert(User, (User(username='{}{}'.format(USER_PREFIX, i), password=password,
+                       email='{}{}@example.com'.format(USER_PREFIX, i))
+                  for i in range(start, start + count)), batch_size)
+    group, _ = Group.objects.get_or_create(name='seed_group')
+    group.permissions.set(Permission.objects.filter(codename__in=['download_file', 'download_tag']))
+    user_ids = list(User.objects.filter(username__startswith=USER_PREFIX)
+                    .order_by('id').values_list('id', flat=True))
+    insert(User.groups.through, (User.groups.through(user_id=pk, group_id=group.id)
+                                 for pk in user_ids[start::2]), batch_size)
+    return user_ids
+
+
+def seed_files(count, user_ids, rng, size=1024, batch_size=1000):
+    tags = Tag.objects.bulk_create(Tag(name='tag_{}'.format(i)) for i in range(max(count // 1000, 3)))
+    name = sample_file(file_storage, SAMPLE_FILE, size)
+    insert(File, (File(name='file_{}'.format(i), file=name, md5sum='0' * 32,
+                       is_public=rng.random() < 0.5, tag=rng.choice(tags),
+                       created_by_id=rng.choice(user_ids))
+                  for i in range(count)), batch_size)
+    file_ids = list(File.objects.values_list('id', flat=True))
+    insert(ShareLink, (ShareLink(link='seed{:020d}'.format(pk), code='abcd', valid_days=7, file_id=pk)
+                       for pk in rng.sample(file_ids, min(count, len(file_ids)) // 10 or 1)),
+           batch_size, ignore_conflicts=True)
+    return file_ids
+
+
+def seed_videos(count, user_ids, rng, size=1024 * 1024, batch_size=1000):
+    """Videos with sequential ids, each liked by up to three users."""
+    categories = Category.objects.bulk_create(
+        Category(name='category_{}'.format(i)) for i in range(max(count // 1000, 3)))
+    last = Video.objects.order_by('-id').values_list('id', flat=True).first()
+    start = max(last + 1 if last else 0, VIDEO_FIRST_ID)
+    name = sample_file(video_storage, SAMPLE_VIDEO, size)
+    insert(Video, (Video(id=start + i, name='video_{}'.format(i), video=name, duration=60,
+                         processing_status='ready', progress=100,
+                         category=rng.choice(categories), created_by_id=rng.choice(user_ids))
+                   for i in range(count)), batch_size)
+    through = Video.liked_users.through
+    insert(through, (through(video_id=start + i, user_id=pk)
+                     for i in range(count)
+                     for pk in rng.sample(user_ids, min(len(user_ids), rng.randint(0, 3)))),
+           batch_size)
+    return list(range(start, start + count))
+
+
+def object_pairs(count, user_ids, object_ids, rng):
+    """``count`` distinct (user_id, object_id) pairs, at most one pass over the objects per user."""
+    offsets = [rng.randrange(len(object_ids)) for _ in user_ids]
+    count = min(count, len(user_ids) * len(object_ids))
+    for i in range(count):
+        u = i % len(user_ids)
+        yield user_ids[u], object_ids[(offsets[u] + i // len(user_ids)) % len(object_ids)]
+
+
+def seed_object_perms(count, user_ids, file_ids, rng, batch_size=1000):
+    permission = Permission.objects.get(codename='download_file')
+    content_type = ContentType.objects.get_for_model(File)
+    return insert(UserObjectPermission, (
+        UserObjectPermission(permission=permission, content_type=content_type,
+                             object_pk=str(file_id), user_id=user_id)
+        for user_id, file_id in object_pairs(count, user_ids, file_ids, rng)),
+        batch_size, ignore_conflicts=True)
+
+
+def seed_perm_reviews(count, user_ids, file_ids, rng, batch_size=1000):
+    permission = Permission.objects.get(codename='download_file')
+    content_type = ContentType.objects.get_for_model(File)
+    return insert(PermReview, (
+        PermReview(permission=permission, content_type=content_type, object_id=file_id,
+                   requester_id=user_id, status=rng.choice((0, 0, 1, 2)))
+        for user_id, file_id in object_pairs(count, user_ids, file_ids, rng)),
+        batch_size, ignore_conflicts=True)
+
+
+def seed_operation_logs(count, user_ids, rng, days=30, batch_size=5000):
+    """Logs spread over the last ``days`` days, latency log-normal around 40ms."""
+    usernames = list(User.objects.filter(id__in=user_ids[:1000]).values_list('username', flat=True))
+    routes = [r[:2] for r in LOG_ROUTES]
+    weights = list(accumulate(r[2] for r in LOG_ROUTES))
+    statuses, status_weights = (200, 400, 403, 500), list(accumulate((95, 3, 1.5, 0.5)))
+    now = datetime.now(tz=timezone.utc)
+    step = days * 86400 / max(count, 1)
+
+    def rows():
+        for i in range(count):
+            method, path = rng.choices(routes, cum_weights=weights)[0]
+            yield OperationLog(
+                action_time=now - timedelta(seconds=(count - i) * step),
+                operator=rng.choice(usernames),
+                ip='10.0.{}.{}'.format(rng.randrange(256), rng.randrange(256)),
+                path=path.format(rng.randrange(1, 100000)), method=method,
+                latency=int(rng.lognormvariate(3.7, 0.8)),
+                status_code=rng.choices(statuses, cum_weights=status_weights)[0])
+    return insert(OperationLog, rows(), batch_size)
+
+
+def seed_admin(password):
+    """The ``seed_admin`` superuser, created on the first run."""
+    admin = User.objects.filter(username='seed_admin').first()
+    if admin is None:
+        admin = User.objects.create_superuser('seed_admin', 'seed_admin@example.com', password)
+    Profile.objects.get_or_create(user=admin, defaults={'full_name': 'seed_admin'})
+    return admin
+
+
+def seed_visibility():
+    """Rebuild the file visibility index, ``bulk_create`` skips its signals."""
+    return rebuild_visibility(User.objects.order_by('id'))
+
+
+def seed(count, rng=None):
+    """Insert ``count`` rows of every listed model, return the superuser.
+
+    Runs again on a seeded database, adding ``count`` more rows.
+    """
+    rng = rng or random.Random()
+    admin = seed_admin('seed_admin')
+    user_ids = seed_users(count, 'seed_user')
+    file_ids = seed_files(count, user_ids, rng)
+    seed_videos(count, user_ids, rng, size=1024)
+    seed_object_perms(count, user_ids, file_ids, rng)
+    seed_perm_reviews(count, user_ids, file_ids, rng)
+    seed_operation_logs(count, user_ids, rng)
+    now = datetime.now(tz=timezone.utc).replace(second=0, microsecond=0)
+    OperationLogRollup.objects.bulk_create(
+        [OperationLogRollup(granularity='minute', bucket=now - timedelta(minutes=i),
+                            path='/api/filestore/files/', method='GET', status_class=2,
+                            count=10, latency_sum=1000, latency_max=200,
+                            histogram=[10] + [0] * 11)
+         for i in range(count)], ignore_conflicts=True)
+    seed_visibility()
+    return admin
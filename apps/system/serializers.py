@@ -2,13 +2,13 @@ import re
 
 from django.contrib.auth import authenticate, get_user_model
 from django.contrib.auth.models import Group
-from django.db.models.fields.files import FieldFile
-from django.forms.models import model_to_dict
+from django.db.models import FileField
 from rest_framework import serializers
 
 from utils.serializers import BasicUserSerializer
 
-from .models import OperationLog, VerificationCode, PermReview
+from .models import OperationLog, OperationLogRollup, PermReview
+from .rollup import latency_summary
 
 User = get_user_model()
 
@@ -19,6 +19,17 @@ class OperationLogSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class OperationLogRollupSerializer(serializers.ModelSerializer):
+    latency = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OperationLogRollup
+        fields = '__all__'
+
+    def get_latency(self, obj):
+        return latency_summary(obj.count, obj.latency_sum, obj.latency_max, obj.histogram)
+
+
 class CodeCreateSerializer(serializers.Serializer):
     email = serializers.EmailField(write_only=True)
 
@@ -119,8 +130,15 @@ class PermReviewSerializer(serializers.ModelSerializer):
         return obj.permission.codename
 
     def get_obj(self, obj):
-        data = model_to_dict(obj.content_object)
-        for k in list(data.keys()):
-            if isinstance(data[k], FieldFile):
-                data.pop(k)
-        return data
+        # content_object comes from the view's prefetch. Like model_to_dict,
+        # but only concrete fields: many-to-many values would cost a query per row.
+        instance = obj.content_object
+        if instance is None:
+            return None
+        return {f.name: f.value_from_object(instance)
+                for f in instance._meta.concrete_fields
+                if f.editable and not isinstance(f, FileField)}
+
+
+class PermReviewBulkSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False)
@@ -0,0 +1,62 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from utils.perm_cache import invalidate_user_perms, invalidate_all_perms
+from utils.response_cache import bump_version
+from utils.token_cache import token_cache
+from utils.tokens import get_token_backend
+
+User = get_user_model()
+
+
+def now_and_on_commit(func, *args):
+    # Again on commit, a request may have cached the old row in between.
+    func(*args)
+    transaction.on_commit(lambda: func(*args))
+
+
+@receiver(post_save, sender=User)
+def handle_user_saved(instance, created, **kwargs):
+    # Saved from any view, the admin or a script, cached token entries are
+    # rebuilt from the new row.
+    if not created:
+        now_and_on_commit(get_token_backend().invalidate_user, instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def handle_user_deleted(instance, **kwargs):
+    now_and_on_commit(get_token_backend().revoke_user, instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def handle_token_deleted(instance, **kwargs):
+    now_and_on_commit(token_cache.delete, instance.key)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def handle_user_perms_changed(instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # pk_set is not given on clear, collect the members before they are gone.
+        invalidate_user_perms(*instance.user_set.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            invalidate_user_perms(instance)
+        elif pk_set:
+            invalidate_user_perms(*pk_set)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def handle_group_perms_changed(action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_all_perms()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def handle_group_changed(sender, **kwargs):
+    bump_version(sender)
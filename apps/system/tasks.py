@@ -1,8 +1,33 @@
+import smtplib
+
 from celery import shared_task
 from django.conf import settings
 from django.core.mail import send_mail
 
+from .archive import archive_operation_logs as _archive_operation_logs
+from .mail import drain_outbox
+from .rollup import rollup_operation_logs as _rollup_operation_logs
+
 
 @shared_task
 def send_email(subject, message, recipient_list):
     send_mail(subject, message, settings.EMAIL_HOST_USER, recipient_list)
+
+
+@shared_task(bind=True, max_retries=5)
+def flush_email_outbox(self):
+    try:
+        return drain_outbox(settings.EMAIL_OUTBOX_BATCH_SIZE)
+    except (smtplib.SMTPException, OSError) as exc:
+        countdown = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** self.request.retries
+        raise self.retry(exc=exc, countdown=countdown)
+
+
+@shared_task
+def rollup_operation_logs():
+    return _rollup_operation_logs()
+
+
+@shared_task
+def archive_operation_logs():
+    return _archive_operation_logs()
@@ -1,3 +1,875 @@
-from django.test import TestCase
+import io
+import json
+import random
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import redis
+from aiosmtpd.controller import Controller
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.contrib.auth.models import Group, Permission
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
+from django.utils.translation import gettext_lazy
+from guardian.models import UserObjectPermission
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+
+from apps.filestore.models import File, FileVisibility, Tag
+from apps.filestore.visibility import visible_file_ids
+from apps.system import mail
+from apps.system.archive import archive_operation_logs, day_indexes, search_archive
+from apps.system.logwriter import OperationLogWriter
+from apps.system.management.commands.import_profile import parse_importtime, rss_by_module
+from apps.system.management.commands.check_query_budgets import routes
+from apps.system.models import OperationLog, OperationLogRollup, PermReview, RollupWatermark
+from apps.system.perms import perm_approve, perm_reject, perm_request
+from apps.system.rollup import WATERMARK, path_template, percentile, rollup_operation_logs
+from apps.system.seed import USER_PREFIX, seed
+from apps.system.verification import (
+    ATTEMPTS_KEY, CODE_EXPIRED, CODE_KEY, CODE_OK, CODE_THROTTLED, CODE_WRONG, IP_ATTEMPTS_KEY,
+    IP_SENDS_KEY, SENDS_KEY, CodeThrottled, check_code, issue_code,
+)
+from utils import lark, perm_cache
+from utils.authentication import CustomTokenAuthentication
+from utils.cache import _missing
+from utils.lark import Lark
+from utils.pagination import CustomCursorPagination
+from utils.querylog import QueryRecorder
+from utils.redis_client import get_redis
+from utils.renderers import ORJSONParser, ORJSONRenderer
+from utils.token_cache import token_cache
+from utils.tokens import RedisTokenBackend, get_token_backend
+
+User = get_user_model()
+
+
+class TokenAuthenticationTests(TestCase):
+    def setUp(self):
+        token_cache.local.clear()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'password')
+        self.key = get_token_backend().issue(self.user)
+        self.auth = CustomTokenAuthentication()
+
+    def authenticate(self):
+        return self.auth.authenticate_credentials(self.key)[0]
+
+    def test_cached_lookup_runs_no_query(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+        self.assertEqual(user, self.user)
+        self.assertEqual(user.username, 'alice')
+        self.assertEqual(user.date_joined, self.user.date_joined)
+        self.assertIn('password', user.get_deferred_fields())
+        self.assertTrue(user.check_password('password'))
+
+    def test_snapshot_survives_redis(self):
+        self.authenticate()
+        token_cache.local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate().date_joined, self.user.date_joined)
+
+    def test_saving_the_user_refreshes_the_entry(self):
+        self.authenticate()
+        self.user.is_staff = True
+        self.user.save()
+        self.assertTrue(self.authenticate().is_staff)
+
+    def test_entry_cached_before_commit_is_dropped(self):
+        self.authenticate()
+        stale = token_cache.get(self.key)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_superuser = True
+            self.user.save()
+            # A request reading the row before the commit caches it again.
+            token_cache.set(self.key, stale)
+        self.assertTrue(self.authenticate().is_superuser)
+
+    def test_deactivated_user_is_rejected(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_deleted_token_is_rejected(self):
+        self.authenticate()
+        Token.objects.filter(key=self.key).delete()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_deleted_user_is_rejected(self):
+        self.authenticate()
+        self.user.delete()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_logout_revokes_the_token(self):
+        response = self.client.post('/api/auth/logout/', HTTP_AUTHORIZATION='Bearer ' + self.key)
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+
+
+@override_settings(AUTH_TOKEN_BACKEND='utils.tokens.RedisTokenBackend')
+class RedisTokenBackendTests(TestCase):
+    def setUp(self):
+        get_token_backend.cache_clear()
+        self.addCleanup(get_token_backend.cache_clear)
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'password')
+        self.key = get_token_backend().issue(self.user)
+        self.auth = CustomTokenAuthentication()
+
+    def authenticate(self):
+        return self.auth.authenticate_credentials(self.key)[0]
+
+    def test_entry_holds_no_user_fields(self):
+        entry = json.loads(get_redis().get(RedisTokenBackend.prefix + self.key))
+        self.assertEqual(set(entry), {'user_id', 'is_active', 'created', 'generation'})
+
+    def test_saving_the_user_keeps_the_token(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertTrue(self.authenticate().is_staff)
+
+    def test_deactivated_user_is_revoked(self):
+        self.user.is_active = False
+        self.user.save()
+        self.user.is_active = True
+        self.user.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_deleted_user_is_revoked(self):
+        self.user.delete()
+        self.assertIsNone(get_token_backend().lookup(self.key))
+
+
+@override_settings(VERIFICATION_CODE_MAX_ATTEMPTS=3)
+class VerificationCodeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'password')
+        self.ip = '192.0.2.1'
+        get_redis().delete(*[key.format(self.user.pk) for key in (CODE_KEY, ATTEMPTS_KEY, SENDS_KEY)],
+                           *[key.format(self.ip) for key in (IP_ATTEMPTS_KEY, IP_SENDS_KEY)])
+
+    def wrong(self, code):
+        return '{:0>6}'.format((int(code) + 1) % 1000000)
+
+    def test_live_code_is_reused(self):
+        code = issue_code(self.user, self.ip)
+        self.assertEqual(issue_code(self.user, self.ip), code)
+        self.assertEqual(check_code(self.user, code, self.ip), CODE_OK)
+        self.assertEqual(check_code(self.user, code, self.ip), CODE_EXPIRED)
+
+    def test_attempts_throttle_the_code(self):
+        code = issue_code(self.user, self.ip)
+        for i in range(3):
+            self.assertEqual(check_code(self.user, self.wrong(code), self.ip), CODE_WRONG)
+        self.assertEqual(check_code(self.user, code, self.ip), CODE_THROTTLED)
+
+    def test_new_code_starts_with_no_attempts(self):
+        code = issue_code(self.user, self.ip)
+        for i in range(4):
+            check_code(self.user, self.wrong(code), self.ip)
+        code = issue_code(self.user, self.ip)
+        self.assertEqual(check_code(self.user, self.wrong(code), self.ip), CODE_WRONG)
+        self.assertEqual(check_code(self.user, code, self.ip), CODE_OK)
+
+    @override_settings(VERIFICATION_CODE_MAX_SENDS=2)
+    def test_sends_are_throttled(self):
+        issue_code(self.user, self.ip)
+        issue_code(self.user, self.ip)
+        with self.assertRaises(CodeThrottled):
+            issue_code(self.user, self.ip)
+
+def make_log(**kwargs):
+    fields = dict(action_time=datetime.now(tz=timezone.utc), operator='alice', ip='127.0.0.1',
+                  path='/api/users/', method='POST', latency=10, status_code=200)
+    fields.update(kwargs)
+    return OperationLog(**fields)
+
+
+@mock.patch.object(OperationLogWriter, '_ensure_started')
+class OperationLogWriterTests(TestCase):
+    def test_flush_writes_buffered_rows_in_batches(self, _):
+        writer = OperationLogWriter(buffer_size=10, batch_size=2, flush_interval=1000)
+        for i in range(5):
+            writer.put(make_log())
+        with self.assertNumQueries(3):
+            writer.flush()
+        self.assertEqual(OperationLog.objects.count(), 5)
+        self.assertEqual(writer.stats(), {'buffered': 0, 'written': 5, 'dropped': 0})
+
+    def test_drop_overflow(self, _):
+        writer = OperationLogWriter(buffer_size=1, batch_size=10, flush_interval=1000)
+        writer.put(make_log())
+        writer.put(make_log())
+        self.assertEqual(writer.stats()['buffered'], 1)
+        self.assertEqual(writer.dropped, 1)
+
+    def test_block_overflow_gives_up_after_timeout(self, _):
+        writer = OperationLogWriter(buffer_size=1, batch_size=10, flush_interval=1000,
+                                    overflow='block', block_timeout=0.01)
+        writer.put(make_log())
+        writer.put(make_log())
+        self.assertEqual(writer.dropped, 1)
+
+    def test_unknown_overflow_policy(self, _):
+        with self.assertRaises(ValueError):
+            OperationLogWriter(buffer_size=1, batch_size=1, flush_interval=1, overflow='spill')
+
+
+class OperationLogWriterThreadTests(TestCase):
+    def test_flush_waits_for_the_thread_batch(self):
+        writer = OperationLogWriter(buffer_size=10, batch_size=10, flush_interval=10)
+        written = []
+
+        def write(batch):
+            time.sleep(0.2)
+            written.extend(batch)
+        writer.write = write
+        writer.put(make_log())
+        while writer.stats()['buffered']:
+            time.sleep(0.01)
+        writer.flush()
+        self.assertEqual(len(written), 1)
+
+
+class OperationLogMiddlewareTests(TestCase):
+    def test_mutating_request_is_logged_without_secrets(self):
+        response = self.client.post('/api/auth/login/', {'username': 'alice', 'password': 'secret'})
+        self.assertEqual(response.status_code, 400)
+        log = OperationLog.objects.get()
+        self.assertEqual((log.path, log.method, log.status_code), ('/api/auth/login/', 'POST', 400))
+        self.assertIn('alice', log.content)
+        self.assertNotIn('secret', log.content)
+
+    def test_reads_are_not_logged(self):
+        self.client.get('/api/users/')
+        self.assertFalse(OperationLog.objects.exists())
+
+    @override_settings(OPERATION_LOG_SYNC=False)
+    @mock.patch('apps.system.middleware.writer')
+    def test_rows_are_buffered(self, writer):
+        self.client.post('/api/auth/login/', {'username': 'alice', 'password': 'secret'})
+        writer.put.assert_called_once()
+        writer.write.assert_not_called()
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.now = datetime.now(tz=timezone.utc)
+
+    def insert(self, latency=10, status_code=200, age=120):
+        log = make_log(path='/api/users/12/active/', latency=latency, status_code=status_code)
+        log.save()
+        OperationLog.objects.filter(id=log.id).update(created_at=self.now - timedelta(seconds=age))
+        return log
+
+    def test_path_template(self):
+        self.assertEqual(path_template('/api/users/12/active/'), '/api/users/:id/active/')
+        self.assertEqual(path_template('/api/users/info/'), '/api/users/info/')
+
+    def test_percentile(self):
+        histogram = [0] * 12
+        histogram[2], histogram[11] = 9, 1
+        self.assertEqual(percentile(histogram, 0.5), 25)
+        self.assertEqual(percentile(histogram, 0.99, latency_max=20000), 20000)
+
+    def test_rows_are_folded_once(self):
+        self.insert(latency=10)
+        self.insert(latency=30)
+        self.insert(latency=700, status_code=500)
+        self.assertEqual(rollup_operation_logs(), 3)
+        self.assertEqual(rollup_operation_logs(), 0)
+        minute = OperationLogRollup.objects.filter(granularity='minute', status_class=2).get()
+        self.assertEqual((minute.path, minute.count, minute.latency_sum, minute.latency_max),
+                         ('/api/users/:id/active/', 2, 40, 30))
+        errors = OperationLogRollup.objects.get(granularity='hour', status_class=5)
+        self.assertEqual((errors.count, errors.error_count), (1, 1))
+
+    def test_watermark_waits_for_recent_inserts(self):
+        first = self.insert()
+        recent = self.insert(age=0)
+        self.insert()
+        self.assertEqual(rollup_operation_logs(), 1)
+        self.assertEqual(RollupWatermark.objects.get(name=WATERMARK).last_id, first.id)
+
+        # The insert time settles the row, however old its request is.
+        OperationLog.objects.filter(id=recent.id).update(action_time=self.now - timedelta(days=1))
+        self.assertEqual(rollup_operation_logs(), 0)
+        OperationLog.objects.filter(id=recent.id).update(created_at=self.now - timedelta(seconds=120))
+        self.assertEqual(rollup_operation_logs(), 2)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings_override = override_settings(OPERATION_LOG_ARCHIVE_ROOT=root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.old = datetime.now(tz=timezone.utc).replace(hour=12) - timedelta(days=100)
+
+    def insert(self, action_time, **kwargs):
+        log = make_log(action_time=action_time, **kwargs)
+        log.save()
+        return log
+
+    def roll_up_to(self, log):
+        RollupWatermark.objects.update_or_create(name=WATERMARK, defaults={'last_id': log.id})
+
+    def test_old_rolled_up_days_are_moved(self):
+        self.insert(self.old, operator='alice')
+        last = self.insert(self.old, operator='bob', ip='10.0.0.1')
+        recent = self.insert(datetime.now(tz=timezone.utc))
+        self.roll_up_to(recent)
+
+        self.assertEqual(archive_operation_logs(days=90), {self.old.date().isoformat(): 2})
+        self.assertEqual(list(OperationLog.objects.values_list('id', flat=True)), [recent.id])
+        index, = day_indexes(self.old.date())
+        self.assertEqual((index['rows'], index['max_id'], index['operator']), (2, last.id, ['alice', 'bob']))
+
+        day = timedelta(days=1)
+        rows = list(search_archive(self.old - day, self.old + day, operator='bob'))
+        self.assertEqual([(r['id'], r['ip']) for r in rows], [(last.id, '10.0.0.1')])
+        self.assertEqual(list(search_archive(self.old - day, self.old + day, operator='carol')), [])
+
+    def test_rows_not_rolled_up_stay(self):
+        rolled = self.insert(self.old)
+        self.insert(self.old)
+        self.roll_up_to(rolled)
+        archive_operation_logs(days=90)
+        self.assertEqual(OperationLog.objects.count(), 1)
+
+        # A later run writes a second part instead of rewriting the day.
+        self.roll_up_to(OperationLog.objects.get())
+        archive_operation_logs(days=90)
+        self.assertEqual([x['rows'] for x in day_indexes(self.old.date())], [1, 1])
+        self.assertFalse(OperationLog.objects.exists())
+
+    def test_search_endpoint(self):
+        for operator in ('alice', 'bob', 'carol'):
+            self.roll_up_to(self.insert(self.old, operator=operator))
+        archive_operation_logs(days=90)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        day = timedelta(days=1)
+        params = {'start': (self.old - day).isoformat(), 'end': (self.old + day).isoformat()}
+
+        response = client.get('/api/operationlog/archive/', dict(params, limit=2))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        for limit in ('0', '-1', 'x'):
+            response = client.get('/api/operationlog/archive/', dict(params, limit=limit))
+            self.assertEqual(response.status_code, 400, limit)
+
+
+class PaginationTests(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_authenticate(admin)
+        action_time = datetime.now(tz=timezone.utc)
+        OperationLog.objects.bulk_create(make_log(action_time=action_time) for i in range(5))
+        self.ids = list(OperationLog.objects.order_by('-id').values_list('id', flat=True))
+
+    def test_page_numbers_by_default(self):
+        data = self.client.get('/api/operationlog/', {'page_size': 2}).json()
+        self.assertEqual(data['count'], 5)
+        self.assertEqual([x['id'] for x in data['results']], self.ids[:2])
+
+    def pages(self, **params):
+        ids = []
+        data = self.client.get('/api/operationlog/', dict(params, pagination='cursor', page_size=2)).json()
+        while True:
+            self.assertNotIn('count', data)
+            ids += [x['id'] for x in data['results']]
+            if not data['next']:
+                return ids
+            data = self.client.get(data['next']).json()
+
+    def test_cursor_pages_on_request(self):
+        self.assertEqual(self.pages(), self.ids)
+
+    def test_cursor_pages_rows_sharing_a_timestamp_once(self):
+        self.assertEqual(self.pages(ordering='-action_time'), self.ids)
+        self.assertEqual(sorted(self.pages(ordering='action_time')), sorted(self.ids))
+
+    def test_expression_ordering_is_rejected(self):
+        request = APIRequestFactory().get('/')
+        with self.assertRaises(ImproperlyConfigured):
+            CustomCursorPagination().get_ordering(
+                request, OperationLog.objects.order_by(F('id').desc()), view=None)
+
+
+def make_file(**kwargs):
+    kwargs.setdefault('name', 'file')
+    return File.objects.create(file='file.bin', md5sum='0' * 32, **kwargs)
+
+
+class PermCacheTests(TestCase):
+    def setUp(self):
+        # Sets cached by earlier tests under the same user ids are dropped.
+        perm_cache.local.clear()
+        perm_cache._bump([perm_cache.GLOBAL_VERSION_KEY])
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'password')
+        self.perm = Permission.objects.get(codename='view_file')
+
+    def has_perms(self, perms, obj=None):
+        # A fresh instance, compiled sets are memoized on the user object.
+        return perm_cache.has_perms(User.objects.get(pk=self.user.pk), perms, obj)
+
+    def test_user_permission_change_recompiles(self):
+        self.assertFalse(self.has_perms(['filestore.view_file']))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.user_permissions.add(self.perm)
+        self.assertTrue(self.has_perms(['filestore.view_file']))
+
+    def test_group_permission_change_recompiles(self):
+        group = Group.objects.create(name='readers')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.add(group)
+        self.assertFalse(self.has_perms(['filestore.view_file']))
+        with self.captureOnCommitCallbacks(execute=True):
+            group.permissions.add(self.perm)
+        self.assertTrue(self.has_perms(['filestore.view_file']))
+
+    def test_object_permissions(self):
+        file, other = make_file(), make_file()
+        perm = 'filestore.download_file'
+        self.assertFalse(self.has_perms([perm], file))
+        with self.captureOnCommitCallbacks(execute=True):
+            perm_approve(Permission.objects.get(codename='download_file'), self.user, file)
+        self.assertTrue(self.has_perms([perm], file))
+        self.assertFalse(self.has_perms([perm], other))
+        with self.captureOnCommitCallbacks(execute=True):
+            perm_reject(Permission.objects.get(codename='download_file'), self.user, file)
+        self.assertFalse(self.has_perms([perm], file))
+
+    def test_cached_set_answers_without_queries(self):
+        self.has_perms(['filestore.view_file'])
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            perm_cache.has_perms(user, ['filestore.view_file'])
+            perm_cache.has_perms(user, ['filestore.download_tag'], Tag(pk=1))
+
+
+class PermReviewBulkTests(APITestCase):
+    def setUp(self):
+        perm_cache.local.clear()
+        perm_cache._bump([perm_cache.GLOBAL_VERSION_KEY])
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_authenticate(admin)
+        self.users = [User.objects.create_user('user%d' % i, 'user%d@example.com' % i) for i in range(2)]
+        self.files = [make_file(is_public=False) for i in range(2)]
+        for user in self.users:
+            for file in self.files:
+                perm_request('filestore.download_file', user, file)
+
+    def pending(self):
+        return PermReview.objects.filter(status=0).count()
+
+    def test_requests_are_deduplicated(self):
+        perm_request('filestore.download_file', self.users[0], self.files[0])
+        self.assertEqual(self.pending(), 4)
+        review = PermReview.objects.first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PermReview.objects.create(permission=review.permission, content_type=review.content_type,
+                                      object_id=review.object_id, requester=review.requester)
+
+    def test_approve_ids(self):
+        ids = list(PermReview.objects.filter(requester=self.users[0]).values_list('id', flat=True))
+        response = self.client.post('/api/perm_review/bulk_approve/', {'ids': ids}, format='json')
+        self.assertEqual(response.json(), {'count': 2})
+        self.assertEqual(self.pending(), 2)
+        self.assertEqual(UserObjectPermission.objects.filter(user=self.users[0]).count(), 2)
+
+    def test_reject_by_filter(self):
+        response = self.client.post('/api/perm_review/bulk_reject/?status=0')
+        self.assertEqual(response.json(), {'count': 4})
+        self.assertEqual(PermReview.objects.filter(status=2).count(), 4)
+
+    def test_unknown_parameters_are_not_a_filter(self):
+        for query in ('', '?format=json', '?page=2', '?status='):
+            response = self.client.post('/api/perm_review/bulk_approve/' + query)
+            self.assertEqual(response.status_code, 400, query)
+        self.assertEqual(self.pending(), 4)
+        self.assertFalse(UserObjectPermission.objects.exists())
+
+
+class PermReviewListTests(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_authenticate(admin)
+        for i in range(6):
+            user = User.objects.create_user('user%d' % i, 'user%d@example.com' % i)
+            perm_request('filestore.download_file', user, make_file(name='file%d' % i, is_public=False))
+            perm_request('filestore.download_tag', user, Tag.objects.create(name='tag%d' % i))
+
+    def list(self, page_size):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get('/api/perm_review/', {'page_size': page_size}).json()
+        return data['results'], len(queries)
+
+    def test_queries_do_not_grow_with_the_page(self):
+        small, small_queries = self.list(2)
+        results, queries = self.list(12)
+        self.assertEqual(len(results), 12)
+        self.assertEqual(queries, small_queries)
+        names = {(x['permission'], x['obj']['name']) for x in results}
+        self.assertIn(('download_file', 'file3'), names)
+        self.assertIn(('download_tag', 'tag3'), names)
+
+
+class SMTPHandler:
+    """Accepts everything but recipients starting with ``bounce``."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith('bounce'):
+            return '550 No such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 Message accepted'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        keys = mock.patch.multiple(
+            mail, OUTBOX_KEY='test.mail.outbox', DEAD_KEY='test.mail.outbox.dead',
+            PROCESSING_KEY='test.mail.outbox.processing', LOCK_KEY='test.mail.outbox.lock')
+        keys.start()
+        self.addCleanup(keys.stop)
+        self.redis = get_redis()
+        self.redis.delete(mail.OUTBOX_KEY, mail.DEAD_KEY, mail.PROCESSING_KEY, mail.LOCK_KEY)
+        self.handler = SMTPHandler()
+        port = free_port()
+        self.server = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        settings_override = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=port, EMAIL_USE_SSL=False,
+            EMAIL_HOST_USER='noreply@example.com', EMAIL_HOST_PASSWORD='',
+            EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def queue(self, *recipients):
+        for recipient in recipients:
+            self.redis.rpush(mail.OUTBOX_KEY, json.dumps(['subject', 'message', [recipient]]))
+
+    def outbox(self, key=None):
+        return [json.loads(x)[2][0] for x in self.redis.lrange(key or mail.OUTBOX_KEY, 0, -1)]
+
+    def test_batches_share_a_connection(self):
+        self.queue('a@example.com', 'b@example.com', 'c@example.com')
+        connect = smtplib.SMTP.connect
+        with mock.patch.object(smtplib.SMTP, 'connect', autospec=True, side_effect=connect) as connect:
+            self.assertEqual(mail.drain_outbox(batch_size=2), 3)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual([x.rcpt_tos for x in self.handler.messages],
+                         [['a@example.com'], ['b@example.com'], ['c@example.com']])
+        self.assertEqual(self.outbox(), [])
+
+    def test_refused_message_does_not_block_the_outbox(self):
+        self.queue('a@example.com', 'bounce@example.com', 'c@example.com')
+        self.assertEqual(mail.drain_outbox(batch_size=10), 2)
+        self.assertEqual(self.outbox(), ['bounce@example.com'])
+
+        self.queue('d@example.com')
+        self.assertEqual(mail.drain_outbox(batch_size=10), 1)
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.outbox(mail.DEAD_KEY), ['bounce@example.com'])
+        self.assertEqual(len(self.handler.messages), 3)
+
+    def test_unreachable_server_keeps_the_outbox(self):
+        self.queue('a@example.com', 'b@example.com')
+        with self.assertRaises(OSError), override_settings(EMAIL_PORT=free_port()):
+            mail.drain_outbox(batch_size=10)
+        self.assertEqual(self.outbox(), ['a@example.com', 'b@example.com'])
+
+    def test_killed_worker_loses_nothing(self):
+        self.queue('a@example.com', 'b@example.com', 'c@example.com')
+        # The worker dies while sending the second message, nothing is put back.
+        with mock.patch.object(EmailBackend, 'send_messages', side_effect=[1, SystemExit]), \
+                mock.patch.object(redis.lock.Lock, 'release'):
+            with self.assertRaises(SystemExit):
+                mail.drain_outbox(batch_size=10)
+        self.assertEqual(self.outbox(mail.PROCESSING_KEY), ['b@example.com', 'c@example.com'])
+
+        self.redis.delete(mail.LOCK_KEY)  # expired
+        self.assertEqual(mail.drain_outbox(batch_size=10), 2)
+        self.assertEqual([x.rcpt_tos for x in self.handler.messages], [['b@example.com'], ['c@example.com']])
+        self.assertEqual(self.outbox() + self.outbox(mail.PROCESSING_KEY), [])
+
+    def test_one_drain_at_a_time(self):
+        self.queue('a@example.com')
+        with self.redis.lock(mail.LOCK_KEY, timeout=10):
+            self.assertEqual(mail.drain_outbox(batch_size=10), 0)
+        self.assertEqual(mail.drain_outbox(batch_size=10), 1)
+
+
+class LarkStub(BaseHTTPRequestHandler):
+    """Lark open API answering from the server's ``tokens`` and ``replies``."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append((self.path, self.headers.get('Authorization'), body))
+        if self.path.startswith('/open-apis/auth/'):
+            token = self.server.tokens.pop(0)
+            data = {'code': 0, 'tenant_access_token': token, 'expire': 7200}
+        else:
+            data = self.server.replies.pop(0) if self.server.replies else {'code': 0}
+        payload = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class LarkTests(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), LarkStub)
+        self.server.requests, self.server.tokens, self.server.replies = [], ['t1', 't2'], []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        # A fresh app per test, its token and bucket keys start empty.
+        self.app_id = 'test-' + uuid.uuid4().hex
+
+    def lark(self, rate=1000):
+        return Lark(app_id=self.app_id, app_secret='secret',
+                    base_url='http://127.0.0.1:{}'.format(self.server.server_port), rate=rate)
+
+    def paths(self):
+        return [x[0] for x in self.server.requests]
+
+    def test_token_is_shared_by_clients(self):
+        self.lark().request('POST', '/open-apis/message/v4/send/', json={})
+        self.lark().request('POST', '/open-apis/message/v4/send/', json={})
+        self.assertEqual(self.paths().count('/open-apis/auth/v3/tenant_access_token/internal/'), 1)
+        self.assertEqual([x[1] for x in self.server.requests[1:]], ['Bearer t1', 'Bearer t1'])
+
+    def test_concurrent_callers_refresh_once(self):
+        client = self.lark()
+        threads = [threading.Thread(target=client.get_tenant_access_token) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.paths(), ['/open-apis/auth/v3/tenant_access_token/internal/'])
+
+    def test_token_error_refreshes_and_retries(self):
+        self.server.replies = [{'code': 99991663}, {'code': 0, 'data': 'sent'}]
+        data = self.lark().request('POST', '/open-apis/message/v4/send/', json={})
+        self.assertEqual(data, {'code': 0, 'data': 'sent'})
+        self.assertEqual([x[1] for x in self.server.requests if x[0] == '/open-apis/message/v4/send/'],
+                         ['Bearer t1', 'Bearer t2'])
+
+    def test_batch_send_in_chunks(self):
+        results = self.lark().batch_send_message(list(range(5)), 'text', {'text': 'hi'}, chunk_size=2)
+        self.assertEqual(len(results), 3)
+        self.assertEqual([x[2]['user_ids'] for x in self.server.requests[1:]], [[0, 1], [2, 3], [4]])
+
+    def test_rate_limit_is_shared_by_clients(self):
+        clients = [self.lark(rate=10), self.lark(rate=10)]
+        clients[0].get_tenant_access_token()
+        started = time.monotonic()
+        for i in range(15):
+            clients[i % 2].limiter.acquire()
+        # The bucket held 9 tokens after the refresh, 6 more refill at 10/s.
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+    def test_rate_limit_without_redis(self):
+        client = self.lark(rate=10)
+        with mock.patch.object(client.limiter, '_take', side_effect=redis.ConnectionError), \
+                mock.patch('utils.lark.logger'):
+            started = time.monotonic()
+            for i in range(12):
+                client.limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+
+
+class QueryBudgetTests(APITestCase):
+    """The ``check_query_budgets`` query budgets, latency is left to the command."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = seed(20, random.Random(0))
+
+    def setUp(self):
+        perm_cache.local.clear()
+        perm_cache._bump([perm_cache.GLOBAL_VERSION_KEY])
+        self.client.force_authenticate(self.admin)
+
+    def test_endpoints_within_query_budget(self):
+        for name, viewset, action, url in routes():
+            max_queries, _ = getattr(viewset, 'query_budgets', {}).get(
+                action, settings.QUERY_BUDGET_DEFAULT)
+            with self.subTest(name):
+                self.client.get(url)
+                recorder = QueryRecorder()
+                with recorder.record():
+                    response = self.client.get(url)
+                self.assertLess(response.status_code, 500)
+                self.assertLessEqual(recorder.count, max_queries, recorder.duplicates())
+
+    @override_settings(QUERY_COUNT_HEADERS=False)
+    def test_benchmark_restores_the_settings(self):
+        out = io.StringIO()
+        call_command('benchmark_api', endpoints='file_list', requests=2, warmup=0,
+                     concurrency=1, stdout=out, stderr=io.StringIO())
+        self.assertIsNotNone(json.loads(out.getvalue())['results']['file_list']['queries'])
+        self.assertFalse(settings.QUERY_COUNT_HEADERS)
+
+
+class SeedTests(TestCase):
+    def test_seed_runs_again(self):
+        admin = seed(10, random.Random(0))
+        self.assertEqual(seed(10, random.Random(0)), admin)
+        self.assertEqual(User.objects.filter(username__startswith=USER_PREFIX).count(), 20)
+        self.assertEqual(File.objects.count(), 20)
+
+    def test_seed_rebuilds_file_visibility(self):
+        seed(10, random.Random(0))
+        seed(10, random.Random(1))
+        users = User.objects.filter(username__startswith=USER_PREFIX)
+        for user in users:
+            self.assertEqual(
+                set(FileVisibility.objects.filter(user=user).values_list('file_id', flat=True)),
+                visible_file_ids(user))
+        self.assertTrue(FileVisibility.objects.exists())
+
+
+class ORJSONTests(TestCase):
+    data = {
+        'id': 1,
+        'time': datetime(2022, 12, 1, 8, 30, 15, 123456, tzinfo=timezone.utc),
+        'date': datetime(2022, 12, 1).date(),
+        'amount': Decimal('1.10'),
+        'name': gettext_lazy('name'),
+        'text': '中文 \u2028 \u2029',
+        'keys': {1: 'int key'},
+        'rows': [None, True, 1.5],
+    }
+
+    def test_same_output_as_json_renderer(self):
+        self.assertEqual(json.loads(ORJSONRenderer().render(self.data)),
+                         json.loads(JSONRenderer().render(self.data)))
+
+    def test_line_separators_are_escaped(self):
+        ret = ORJSONRenderer().render({'text': '\u2028\u2029'})
+        self.assertEqual(ret, b'{"text":"\\u2028\\u2029"}')
+
+    def test_big_integers_fall_back(self):
+        self.assertEqual(ORJSONRenderer().render({'id': 2 ** 70}), JSONRenderer().render({'id': 2 ** 70}))
+
+    def test_indent(self):
+        ret = ORJSONRenderer().render({'id': 1}, 'application/json; indent=2')
+        self.assertEqual(ret, b'{\n  "id": 1\n}')
+
+    def test_parse(self):
+        self.assertEqual(ORJSONParser().parse(io.BytesIO('{"name": "中文"}'.encode())), {'name': '中文'})
+        with self.assertRaises(exceptions.ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"name"'))
+
+
+class TwoTierCacheTests(TestCase):
+    def setUp(self):
+        self.tier = cache.tier
+        cache.set('test.two_tier', 'old')
+        self.key = cache.make_and_validate_key('test.two_tier')
+        self.tier._ensure_listener()
+        self.assertTrue(self.tier._listening.wait(5))
+
+    def cached_locally(self):
+        return self.tier.lru.get(self.key, _missing) is not _missing
+
+    def test_read_fills_the_local_tier(self):
+        self.assertEqual(cache.get('test.two_tier'), 'old')
+        self.assertTrue(self.cached_locally())
+        with mock.patch.object(redis.client.Pipeline, 'execute') as execute:
+            self.assertEqual(cache.get('test.two_tier'), 'old')
+        execute.assert_not_called()
+
+    def test_invalidation_during_the_fetch(self):
+        execute = redis.client.Pipeline.execute
+
+        def write_during_fetch(pipe):
+            results = execute(pipe)
+            # Another process writes the key and its message arrives before the fill.
+            get_redis().set(self.key, results[0].replace(b'old', b'new'))
+            self.tier._handle_message({'data': json.dumps({'node': 'other', 'keys': [self.key]})})
+            return results
+
+        with mock.patch.object(redis.client.Pipeline, 'execute', autospec=True,
+                               side_effect=write_during_fetch):
+            self.assertEqual(cache.get('test.two_tier'), 'old')
+        self.assertFalse(self.cached_locally())
+        self.assertEqual(cache.get('test.two_tier'), 'new')
+
+
+class ImportProfileTests(TestCase):
+    def test_parse_importtime(self):
+        stderr = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |     _io\n'
+            'import time:      2500 |       9000 |   django.db\n'
+            'unrelated line\n'
+        )
+        self.assertEqual(parse_importtime(stderr), {'_io': (120, 120), 'django.db': (2500, 9000)})
+
+    def test_rss_is_attributed_to_the_import(self):
+        samples = [('django', 100), ('django.db', 300), ('json', 250), (None, 400)]
+        self.assertEqual(rss_by_module(samples), {'django': 200, 'django.db': 0, 'json': 150})
+
+    def test_startup_skips_heavy_imports(self):
+        out = io.StringIO()
+        call_command('import_profile', target='asgi', json=True, limit=10000, stdout=out)
+        modules = {x['module'] for x in json.loads(out.getvalue())['modules']}
+        self.assertIn('django_project.asgi', modules)
+        self.assertNotIn('cv2', modules)
+        self.assertNotIn('utils.lark', modules)
+
+    def test_lark_client_is_built_on_first_use(self):
+        with mock.patch.object(lark, '_lark', None), mock.patch.object(lark, 'Lark') as client:
+            self.assertIs(lark.lark, client.return_value)
+            self.assertIs(lark.get_lark(), client.return_value)
+        client.assert_called_once_with(app_id=settings.LARK_APP_ID, app_secret=settings.LARK_APP_SECRET)
\ No newline at end of file
@@ -10,6 +10,8 @@ router.register(r'users', views.UserViewSet)
 router.register(r'groups', views.GroupViewSet)
 router.register(r'perm_review', views.PermReviewViewSet)
 router.register(r'operationlog', views.OperationLogViewSet)
+router.register(r'operationlog_rollup', views.OperationLogRollupViewSet)
+router.register(r'metrics', views.MetricsViewSet, basename='metrics')
 
 urlpatterns = [
     path('', include(router.urls)),
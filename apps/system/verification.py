@@ -0,0 +1,89 @@
+import secrets
+
+from django.conf import settings
+
+from utils.redis_client import get_redis
+
+CODE_KEY = 'auth.code.{}'
+ATTEMPTS_KEY = 'auth.code.attempts.{}'
+IP_ATTEMPTS_KEY = 'auth.code.attempts.ip.{}'
+SENDS_KEY = 'auth.code.sends.{}'
+IP_SENDS_KEY = 'auth.code.sends.ip.{}'
+
+CODE_OK = 1
+CODE_EXPIRED = 0
+CODE_WRONG = 2
+CODE_THROTTLED = -1
+
+# Count the attempt for the user and the ip, then compare and consume the
+# code in the same step.
+CHECK_SCRIPT = """
+local attempts = redis.call('INCR', KEYS[2])
+if attempts == 1 then redis.call('EXPIRE', KEYS[2], ARGV[4]) end
+local ip_attempts = redis.call('INCR', KEYS[3])
+if ip_attempts == 1 then redis.call('EXPIRE', KEYS[3], ARGV[4]) end
+if attempts > tonumber(ARGV[2]) or ip_attempts > tonumber(ARGV[3]) then
+    redis.call('DEL', KEYS[1])
+    return -1
+end
+local code = redis.call('GET', KEYS[1])
+if not code then return 0 end
+if code == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 1
+end
+return 2
+"""
+
+# Create a code unless one is live. A new code starts with no attempts.
+ISSUE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2], 'NX') then
+    redis.call('DEL', KEYS[2])
+    return ARGV[1]
+end
+return redis.call('GET', KEYS[1])
+"""
+
+_check_script = None
+_issue_script = None
+
+
+class CodeThrottled(Exception):
+    pass
+
+
+def issue_code(user, ip):
+    """Return the user's code, creating one with fresh attempts if none is live.
+
+    Raises ``CodeThrottled`` once the user or the ip asked for too many codes
+    within ``VERIFICATION_CODE_SEND_WINDOW``.
+    """
+    client = get_redis()
+    pipe = client.pipeline()
+    for key in (SENDS_KEY.format(user.pk), IP_SENDS_KEY.format(ip)):
+        pipe.set(key, 0, ex=settings.VERIFICATION_CODE_SEND_WINDOW, nx=True)
+        pipe.incr(key)
+    _, sends, _, ip_sends = pipe.execute()
+    if sends > settings.VERIFICATION_CODE_MAX_SENDS or \
+            ip_sends > settings.VERIFICATION_CODE_MAX_IP_SENDS:
+        raise CodeThrottled()
+
+    global _issue_script
+    if _issue_script is None:
+        _issue_script = client.register_script(ISSUE_SCRIPT)
+    return _issue_script(
+        keys=[CODE_KEY.format(user.pk), ATTEMPTS_KEY.format(user.pk)],
+        args=['{:0>6}'.format(secrets.randbelow(1000000)), settings.VERIFICATION_CODE_TTL],
+    ).decode()
+
+
+def check_code(user, code, ip):
+    """Consume the user's code if it matches, returns one of the CODE_* results."""
+    global _check_script
+    if _check_script is None:
+        _check_script = get_redis().register_script(CHECK_SCRIPT)
+    return _check_script(
+        keys=[CODE_KEY.format(user.pk), ATTEMPTS_KEY.format(user.pk), IP_ATTEMPTS_KEY.format(ip)],
+        args=[code, settings.VERIFICATION_CODE_MAX_ATTEMPTS,
+              settings.VERIFICATION_CODE_MAX_IP_ATTEMPTS, settings.VERIFICATION_CODE_TTL],
+    )
@@ -1,23 +1,38 @@
-import time
+import os
 import traceback
+from itertools import islice
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.forms.models import model_to_dict
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions, status
-from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet, ModelViewSet, ReadOnlyModelViewSet
 
+from utils import get_client_ip
+from utils.pagination import CursorOptInPagination
 from utils.permissions import ActionModelWithReadPermissions
+from utils.query_plan import QueryPlanMixin
+from utils.response_cache import CachedListMixin
+from utils.token_cache import token_cache
+from utils.tokens import get_token_backend
 
-from .models import VerificationCode, OperationLog, PermReview
+from .archive import search_archive
+from .logwriter import writer
+from .models import OperationLog, OperationLogRollup, PermReview
 from .notification import notify_register, send_email_code, notify_active, notify_inactive
-from .perms import perm_approve, perm_reject
+from .perms import perm_approve, perm_reject, perm_review_bulk
+from .rollup import latency_summary
+from .verification import (
+    CodeThrottled, issue_code, check_code, CODE_EXPIRED, CODE_WRONG, CODE_THROTTLED,
+)
 from .serializers import (
     CodeCreateSerializer,
     ResetPasswordSerializer,
@@ -26,7 +41,9 @@ from .serializers import (
     UserSerializer,
     GroupSerializer,
     OperationLogSerializer,
+    OperationLogRollupSerializer,
     PermReviewSerializer,
+    PermReviewBulkSerializer,
 )
 
 User = get_user_model()
@@ -36,8 +53,83 @@ class OperationLogViewSet(ReadOnlyModelViewSet):
     queryset = OperationLog.objects.order_by('-id')
     serializer_class = OperationLogSerializer
     permission_classes = [ActionModelWithReadPermissions]
+    pagination_class = CursorOptInPagination
     search_fields = ['operator', 'ip', 'path']
     filterset_fields = ['operator', 'ip', 'path', 'method', 'status_code']
+    query_budgets = {'list': (2, 200), 'retrieve': (2, 200)}
+
+    @action(detail=False)
+    def archive(self, request, *args, **kwargs):
+        """Search archived rows, ``start``/``end`` are required ISO datetimes."""
+        params = request.query_params
+        start = parse_datetime(params.get('start', ''))
+        end = parse_datetime(params.get('end', ''))
+        if not start or not end or start.tzinfo is None or end.tzinfo is None:
+            return Response('start/end 须为带时区的时间', status=status.HTTP_400_BAD_REQUEST)
+        try:
+            status_code = int(params['status_code']) if params.get('status_code') else None
+            limit = int(params.get('limit', 100))
+        except ValueError:
+            return Response('参数不合法', status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response('参数不合法', status=status.HTTP_400_BAD_REQUEST)
+        limit = min(limit, settings.OPERATION_LOG_ARCHIVE_MAX_LIMIT)
+        rows = search_archive(
+            start, end,
+            operator=params.get('operator'),
+            ip=params.get('ip'),
+            path=params.get('path'),
+            method=params.get('method'),
+            status_code=status_code,
+        )
+        return Response(list(islice(rows, limit)))
+
+
+class OperationLogRollupViewSet(ReadOnlyModelViewSet):
+    queryset = OperationLogRollup.objects.order_by('-bucket', 'path')
+    serializer_class = OperationLogRollupSerializer
+    permission_classes = [ActionModelWithReadPermissions]
+    filterset_fields = {
+        'granularity': ['exact'],
+        'bucket': ['gte', 'lt'],
+        'path': ['exact'],
+        'method': ['exact'],
+        'status_class': ['exact'],
+    }
+    action_model_perms_map = {
+        'summary': ['%(app_label)s.view_%(model_name)s'],
+    }
+
+    @action(detail=False)
+    def summary(self, request, *args, **kwargs):
+        """Merge the filtered buckets per (path, method), slowest p95 first."""
+        queryset = self.filter_queryset(self.get_queryset())
+        groups = {}
+        for rollup in queryset.iterator():
+            key = (rollup.path, rollup.method)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    'path': rollup.path, 'method': rollup.method,
+                    'count': 0, 'error_count': 0, 'latency_sum': 0,
+                    'latency_max': 0, 'histogram': [0] * len(rollup.histogram),
+                }
+            group['count'] += rollup.count
+            group['error_count'] += rollup.error_count
+            group['latency_sum'] += rollup.latency_sum
+            group['latency_max'] = max(group['latency_max'], rollup.latency_max)
+            group['histogram'] = [a + b for a, b in zip(group['histogram'], rollup.histogram)]
+        data = []
+        for group in groups.values():
+            group['latency'] = latency_summary(group['count'], group.pop('latency_sum'),
+                                               group.pop('latency_max'), group['histogram'])
+            data.append(group)
+        data.sort(key=lambda x: x['latency']['p95'] or 0, reverse=True)
+
+        page = self.paginate_queryset(data)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(data)
 
 
 class AuthViewSet(ViewSet):
@@ -49,11 +141,11 @@ class AuthViewSet(ViewSet):
         serializer.is_valid(raise_exception=True)
         email = serializer.validated_data['email']
         user = get_object_or_404(User, email=email)
-        code, created = VerificationCode.objects.get_or_create(user=user)
-        if not created and code.is_expired():
-            code.delete()
-            code, created = VerificationCode.objects.get_or_create(user=user)
-        send_email_code(code)
+        try:
+            code = issue_code(user, get_client_ip(request))
+        except CodeThrottled:
+            return Response('发送过于频繁，请稍后再试', status=status.HTTP_429_TOO_MANY_REQUESTS)
+        send_email_code(user, code)
         return Response()
 
     @action(detail=False, methods=['post'])
@@ -75,18 +167,15 @@ class AuthViewSet(ViewSet):
         serializer = LoginSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
-        token, created = Token.objects.get_or_create(user=user)
-        if time.time() - token.created.timestamp() > settings.TOKEN_EXPIRE_SECONDS:
-            Token.objects.filter(user_id=user.id).delete()
-            token, created = Token.objects.get_or_create(user=user)
-        return Response({'token': token.key,
+        key = get_token_backend().issue(user)
+        return Response({'token': key,
                          'userId': user.username,})
 
     @action(detail=False, methods=['post'])
     def logout(self, request, *args, **kwargs):
         user = request.user
-        if user:
-            Token.objects.filter(user_id=user.id).delete()
+        if user and user.is_authenticated:
+            get_token_backend().revoke_user(user.id)
         return Response()
 
     @action(detail=False, methods=['post'])
@@ -95,24 +184,26 @@ class AuthViewSet(ViewSet):
         serializer.is_valid(raise_exception=True)
         email = serializer.validated_data['email']
         user = get_object_or_404(User, email=email)
-        code = get_object_or_404(VerificationCode, user=user)
-        if code.is_expired():
-            code.delete()
+        result = check_code(user, serializer.validated_data['code'], get_client_ip(request))
+        if result == CODE_THROTTLED:
+            return Response('尝试次数过多，请重新获取验证码', status=status.HTTP_429_TOO_MANY_REQUESTS)
+        if result == CODE_EXPIRED:
             return Response('验证码已过期', status=status.HTTP_400_BAD_REQUEST)
-        if code.code != serializer.validated_data['code']:
+        if result == CODE_WRONG:
             return Response('验证码不正确', status=status.HTTP_400_BAD_REQUEST)
         user.set_password(serializer.validated_data['password'])
         user.save()
         return Response()
 
 
-class UserViewSet(ModelViewSet):
+class UserViewSet(QueryPlanMixin, ModelViewSet):
     queryset = User.objects.exclude(is_superuser=True).\
             exclude(username='AnonymousUser').order_by('-date_joined')
     serializer_class = UserSerializer
     permission_classes = [ActionModelWithReadPermissions]
     search_fields = ['full_name', 'email', 'mobile',]
     filterset_fields = ['is_active']
+    query_budgets = {'list': (4, 300), 'retrieve': (3, 200)}
 
     @action(detail=False, permission_classes=[permissions.IsAuthenticated])
     def info(self, request, pk=None):
@@ -143,17 +234,35 @@ class UserViewSet(ModelViewSet):
         return Response()
 
 
-class GroupViewSet(ModelViewSet):
+class MetricsViewSet(ViewSet):
+    """Cache counters of the process serving the request."""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def list(self, request, *args, **kwargs):
+        return Response({
+            'pid': os.getpid(),
+            'token_cache': token_cache.stats(),
+            'cache': cache.stats() if hasattr(cache, 'stats') else None,
+            'operation_log': writer.stats(),
+        })
+
+
+class GroupViewSet(CachedListMixin, ModelViewSet):
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
     permission_classes = [ActionModelWithReadPermissions]
 
 
-class PermReviewViewSet(ModelViewSet):
-    queryset = PermReview.objects.order_by('-id')
+class PermReviewViewSet(QueryPlanMixin, ModelViewSet):
+    # prefetch_related on the generic FK fetches each content type's objects
+    # in one query, a page costs the same number of queries at any size.
+    queryset = PermReview.objects.select_related(
+        'permission', 'requester', 'reviewer').prefetch_related('content_object').order_by('-id')
     serializer_class = PermReviewSerializer
     permission_classes = [ActionModelWithReadPermissions]
     filterset_fields = ['status']
+    query_budgets = {'list': (4, 300), 'retrieve': (3, 200)}
 
     @action(detail=True, methods=['post'])
     def approve(self, request, *args, **kwargs):
@@ -176,3 +285,35 @@ class PermReviewViewSet(ModelViewSet):
         instance.reviewer = request.user
         instance.save()
         return Response()
+
+    @action(detail=False, methods=['post'])
+    def bulk_approve(self, request, *args, **kwargs):
+        return self.bulk_review(request, approve=True)
+
+    @action(detail=False, methods=['post'])
+    def bulk_reject(self, request, *args, **kwargs):
+        return self.bulk_review(request, approve=False)
+
+    def bulk_review(self, request, approve):
+        """Handle the reviews in ``ids``, or else those matching the query filters.
+
+        Parameters the filterset does not know (``format``, ``page``...) are
+        ignored by it, so they never count as a filter.
+        """
+        serializer = PermReviewBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data.get('ids')
+        if ids:
+            queryset = self.get_queryset().filter(id__in=ids)
+        elif self.get_filter_params(request):
+            queryset = self.filter_queryset(self.get_queryset())
+        else:
+            return Response('请指定 ids 或过滤条件', status=status.HTTP_400_BAD_REQUEST)
+        count = perm_review_bulk(queryset.order_by(), approve, request.user)
+        return Response({'count': count})
+
+    def get_filter_params(self, request):
+        """Names of the non-empty query parameters the filterset filters on."""
+        filterset_class = DjangoFilterBackend().get_filterset_class(self, self.get_queryset())
+        names = set(filterset_class.base_filters) if filterset_class else set()
+        return {k for k, v in request.query_params.items() if k in names and v != ''}
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import Video, fs
+
+logger = logging.getLogger(__name__)
+
+HLS_PLAYLIST = 'index.m3u8'
+HLS_SEGMENT_RE = r'seg_\d{5}\.ts'
+# Stream copy when the codecs fit MPEG-TS, transcode otherwise.
+HLS_CODECS = (
+    ['-c', 'copy'],
+    ['-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac'],
+)
+
+
+def hls_dir(video_id):
+    """Directory of a video's playlist and segments in the video storage."""
+    return os.path.join('hls', str(video_id))
+
+
+def probe_duration(path):
+    """Duration in seconds from the container metadata, no frame is decoded."""
+    if shutil.which('ffprobe'):
+        output = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', path],
+            capture_output=True, check=True, timeout=60).stdout
+        return float(json.loads(output)['format']['duration'])
+
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise ValueError('Unreadable video')
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        if not fps or frames <= 0:
+            raise ValueError('Video has no frame rate or frame count')
+        return frames / fps
+    finally:
+        cap.release()
+
+
+def extract_cover(path, cover_path, at):
+    """Write the frame ``at`` seconds into the video to ``cover_path``, seeking to it."""
+    os.makedirs(os.path.dirname(cover_path), exist_ok=True)
+    if shutil.which('ffmpeg'):
+        subprocess.run(
+            ['ffmpeg', '-v', 'error', '-y', '-ss', str(at), '-i', path, '-frames:v', '1', cover_path],
+            capture_output=True, check=True, timeout=120)
+        return
+
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        cap.set(cv2.CAP_PROP_POS_MSEC, at * 1000)
+        ok, frame = cap.read()
+        if not ok:
+            raise ValueError('No frame at {}s'.format(at))
+        cv2.imwrite(cover_path, frame)
+    finally:
+        cap.release()
+
+
+def package_hls(path, out_dir, duration, on_progress):
+    """Split the video into ``VIDEO_HLS_SEGMENT_SECONDS`` MPEG-TS segments and a VOD playlist.
+
+    ``on_progress`` is called with the encoded fraction of the video.
+    """
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    error = ''
+    for codecs in HLS_CODECS:
+        # stderr goes to a file, a full stderr pipe would stall ffmpeg
+        # while stdout is read.
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(
+                ['ffmpeg', '-v', 'error', '-nostats', '-y', '-i', path, *codecs,
+                 '-f', 'hls', '-hls_time', str(settings.VIDEO_HLS_SEGMENT_SECONDS),
+                 '-hls_playlist_type', 'vod',
+                 '-hls_segment_filename', os.path.join(out_dir, 'seg_%05d.ts'),
+                 '-progress', 'pipe:1', os.path.join(out_dir, HLS_PLAYLIST)],
+                stdout=subprocess.PIPE, stderr=stderr, text=True)
+            timed_out = threading.Event()
+
+            def kill():
+                timed_out.set()
+                proc.kill()
+
+            timer = threading.Timer(settings.VIDEO_HLS_TIMEOUT, kill)
+            timer.start()
+            try:
+                for line in proc.stdout:
+                    key, _, value = line.strip().partition('=')
+                    if key == 'out_time_us' and value.isdigit() and duration:
+                        on_progress(min(int(value) / 1e6 / duration, 1))
+                returncode = proc.wait()
+            finally:
+                timer.cancel()
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+            if timed_out.is_set():
+                raise RuntimeError('ffmpeg timed out after {}s'.format(settings.VIDEO_HLS_TIMEOUT))
+            if returncode == 0:
+                return
+            stderr.seek(max(stderr.seek(0, os.SEEK_END) - 1024, 0))
+            error = stderr.read().decode(errors='replace')
+    raise RuntimeError(error.strip()[-255:] or 'ffmpeg failed')
+
+
+def set_status(video_id, **fields):
+    Video.objects.filter(id=video_id).update(**fields)
+
+
+def ingest(video_id):
+    """Read the duration, grab the cover and package HLS, tracking progress on the row.
+
+    Uses ffprobe/ffmpeg when installed, OpenCV otherwise. HLS packaging
+    (``VIDEO_HLS``) needs ffmpeg, OpenCV writes neither MPEG-TS nor audio.
+    """
+    video = Video.objects.get(id=video_id)
+    if not video.video:
+        set_status(video_id, processing_status='no_file', progress=0)
+        return
+    set_status(video_id, processing_status='processing', progress=0, processing_error='')
+    try:
+        path = video.video.path
+        duration = probe_duration(path)
+        set_status(video_id, duration=int(duration), progress=20)
+
+        cover = os.path.join('video', '{}_cover.png'.format(video.id))
+        # Around the first second, like the old in-request cover grab.
+        extract_cover(path, video.cover.storage.path(cover), min(1.0, duration / 2))
+        set_status(video_id, cover=cover, progress=30)
+
+        playlist = ''
+        if settings.VIDEO_HLS and shutil.which('ffmpeg'):
+            done = [30]
+
+            def on_progress(fraction):
+                progress = 30 + int(fraction * 69)
+                if progress >= done[0] + 5:
+                    done[0] = progress
+                    set_status(video_id, progress=progress)
+
+            package_hls(path, fs.path(hls_dir(video.id)), duration, on_progress)
+            playlist = os.path.join(hls_dir(video.id), HLS_PLAYLIST)
+        elif settings.VIDEO_HLS:
+            logger.warning('ffmpeg not found, video %s is not packaged for HLS', video_id)
+        set_status(video_id, hls_playlist=playlist, processing_status='ready', progress=100)
+    except Exception as e:
+        logger.exception('Ingest of video %s failed', video_id)
+        set_status(video_id, processing_status='failed', processing_error=str(e)[:255])
+        raise
+
+
+def ingest_in_pool(video_id):
+    """``ingest`` for process pool workers, returns (video_id, error)."""
+    close_old_connections()
+    try:
+        ingest(video_id)
+        return video_id, None
+    except Exception as e:
+        return video_id, str(e)
@@ -0,0 +1,44 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apps.video.ingest import ingest_in_pool
+from apps.video.models import Video
+
+
+class Command(BaseCommand):
+    help = 'Ingest videos in parallel worker processes, e.g. to backfill or retry failures.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='Video ids, default by --status.')
+        parser.add_argument('--status', default='pending,failed',
+                            help='Comma separated processing statuses to ingest.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Worker processes.')
+
+    def handle(self, *args, **options):
+        if options['ids']:
+            ids = options['ids']
+        else:
+            ids = list(Video.objects.filter(
+                processing_status__in=options['status'].split(',')).values_list('id', flat=True))
+        if not ids:
+            self.stdout.write('Nothing to ingest')
+            return
+
+        # Forked workers must open their own database connections.
+        connections.close_all()
+        failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [executor.submit(ingest_in_pool, pk) for pk in ids]
+            for future in as_completed(futures):
+                video_id, error = future.result()
+                if error:
+                    failed += 1
+                    self.stderr.write('{}: {}'.format(video_id, error))
+                else:
+                    self.stdout.write('{}: ready'.format(video_id))
+        style = self.style.ERROR if failed else self.style.SUCCESS
+        self.stdout.write(style('{} ingested, {} failed'.format(len(ids) - failed, failed)))
@@ -1,7 +1,6 @@
 import os
 import random
 
-import cv2
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.db import models
@@ -11,6 +10,15 @@ from utils.model import BaseModel
 fs = FileSystemStorage(location=settings.STORAGE_ROOT.joinpath('video'))
 
 
+PROCESSING_STATUS = (
+    ('pending', 'Pending'),
+    ('processing', 'Processing'),
+    ('ready', 'Ready'),
+    ('failed', 'Failed'),
+    ('no_file', 'No file'),
+)
+
+
 def video_path(instance, filename):
     return os.path.join('video', filename)
 
@@ -25,6 +33,13 @@ class Video(BaseModel):
     cover = models.ImageField(upload_to=video_path)
     video = models.FileField(storage=fs, null=True, blank=True)
     duration = models.IntegerField(default=0)
+    # Set by the ingest task, see apps.video.ingest
+    processing_status = models.CharField(choices=PROCESSING_STATUS, max_length=16,
+                                         default='pending')
+    progress = models.IntegerField(default=0, verbose_name='处理进度/%')
+    processing_error = models.CharField(max_length=255, blank=True, default='')
+    # Playlist in ``fs``, empty when the video is not packaged for HLS
+    hls_playlist = models.CharField(max_length=255, blank=True, default='')
     category = models.ForeignKey(
         Category,
         on_delete=models.PROTECT,
@@ -44,20 +59,3 @@ class Video(BaseModel):
                 except Video.DoesNotExist:
                     break
         super().save(*args, **kwargs)
-        if self.video and not self.duration:
-            self.cover = os.path.join(
-                'video', '{}_cover.png'.format(self.id))
-            cap = cv2.VideoCapture(self.video.path)
-            for i in range(30):
-                ok, frame = cap.read()
-                if not ok:
-                    cap.release()
-                    break
-            cv2.imwrite(self.cover.path, frame)
-            if cap.isOpened():
-                rate = cap.get(5)
-                frame_num = cap.get(7)
-                self.duration = int(frame_num / rate)
-                cap.release()
-            cv2.destroyAllWindows()
-            super().save(*args, **kwargs)
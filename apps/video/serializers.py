@@ -24,6 +24,8 @@ class VideoCreateSerializer(BaseModelSerializer):
     class Meta:
         model = Video
         exclude = ['liked_users']
+        read_only_fields = ['duration', 'processing_status', 'progress', 'processing_error',
+                            'hls_playlist']
 
 
 class VideoDetailSerializer(BaseModelSerializer):
@@ -1,10 +1,47 @@
-from django.db.models.signals import pre_delete
+import shutil
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
-from .models import Video
+from utils.response_cache import bump_version
+
+from .ingest import hls_dir
+from .models import Category, Video, fs
+from .tasks import ingest_video
 
 
 @receiver(pre_delete, sender=Video)
 def handle_video_deleted(instance, **kwargs):
     instance.video.delete(save=False)
     instance.cover.delete(save=False)
+    shutil.rmtree(fs.path(hls_dir(instance.id)), ignore_errors=True)
+
+
+@receiver(pre_save, sender=Video)
+def handle_video_saving(instance, **kwargs):
+    # An uncommitted file is a new upload, written to storage by this save.
+    instance._ingest = bool(instance.video) and not instance.video._committed
+    if instance._ingest:
+        instance.processing_status = 'pending'
+        instance.progress = 0
+        instance.duration = 0
+        instance.hls_playlist = ''
+    elif not instance.video:
+        # Nothing to ingest, the row must not wait for a task that never comes.
+        instance.processing_status = 'no_file'
+        instance.progress = 0
+        instance.hls_playlist = ''
+
+
+@receiver(post_save, sender=Video)
+def handle_video_saved(instance, **kwargs):
+    if getattr(instance, '_ingest', False):
+        instance._ingest = False
+        transaction.on_commit(lambda: ingest_video.delay(instance.id))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def handle_category_changed(sender, **kwargs):
+    bump_version(sender)
@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .ingest import ingest
+
+
+@shared_task(acks_late=True)
+def ingest_video(video_id):
+    ingest(video_id)
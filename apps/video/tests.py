@@ -1,3 +1,304 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, StreamingHttpResponse
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from utils.streaming import MAX_BLOCK, MIN_BLOCK, ASGIHandler, FileStream, stream_file
+
+from .ingest import HLS_CODECS, HLS_PLAYLIST, hls_dir, ingest, package_hls
+from .models import Category, Video, fs
+
+
+class TempStorageMixin:
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        for attr in ('base_location', 'location'):
+            patcher = mock.patch.object(fs, attr, root)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.category = Category.objects.create(name='category')
+
+    def make_video(self, content=b'video', **kwargs):
+        video = SimpleUploadedFile('video.mp4', content) if content is not None else None
+        return Video.objects.create(name='video', category=self.category, video=video, **kwargs)
+
+
+@mock.patch('apps.video.signals.ingest_video')
+class ProcessingStatusTests(TempStorageMixin, TestCase):
+    def test_upload_is_queued_for_ingest(self, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            video = self.make_video()
+        self.assertEqual(video.processing_status, 'pending')
+        task.delay.assert_called_once_with(video.id)
+
+    def test_video_without_file_is_not_pending(self, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            video = self.make_video(content=None)
+        video.refresh_from_db()
+        self.assertEqual(video.processing_status, 'no_file')
+        task.delay.assert_not_called()
+
+    def test_saving_without_a_new_upload_keeps_the_status(self, task):
+        video = self.make_video()
+        Video.objects.filter(id=video.id).update(processing_status='ready', progress=100)
+        video.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            video.name = 'renamed'
+            video.save()
+        video.refresh_from_db()
+        self.assertEqual(video.processing_status, 'ready')
+        task.delay.assert_not_called()
+
+
+@override_settings(VIDEO_HLS=False)
+@mock.patch('apps.video.signals.ingest_video', mock.Mock())
+@mock.patch('apps.video.ingest.extract_cover')
+@mock.patch('apps.video.ingest.probe_duration', return_value=12.5)
+class IngestTests(TempStorageMixin, TestCase):
+    def test_ingest_marks_ready(self, probe, cover):
+        video = self.make_video()
+        ingest(video.id)
+        video.refresh_from_db()
+        self.assertEqual((video.processing_status, video.progress, video.duration), ('ready', 100, 12))
+        self.assertEqual(video.cover.name, 'video/{}_cover.png'.format(video.id))
+        self.assertEqual(cover.call_args[0][2], 1.0)
+
+    def test_failure_is_recorded(self, probe, cover):
+        probe.side_effect = ValueError('Unreadable video')
+        video = self.make_video()
+        with self.assertRaises(ValueError), mock.patch('apps.video.ingest.logger'):
+            ingest(video.id)
+        video.refresh_from_db()
+        self.assertEqual(video.processing_status, 'failed')
+        self.assertEqual(video.processing_error, 'Unreadable video')
+
+    def test_nothing_to_ingest(self, probe, cover):
+        video = self.make_video(content=None)
+        Video.objects.filter(id=video.id).update(processing_status='pending')
+        ingest(video.id)
+        video.refresh_from_db()
+        self.assertEqual(video.processing_status, 'no_file')
+        probe.assert_not_called()
+
+
+    @override_settings(VIDEO_HLS=True)
+    @mock.patch('apps.video.ingest.shutil.which', return_value='/usr/bin/ffmpeg')
+    @mock.patch('apps.video.ingest.package_hls')
+    def test_ingest_packages_hls(self, package, which, probe, cover):
+        video = self.make_video()
+        ingest(video.id)
+        video.refresh_from_db()
+        self.assertEqual(video.hls_playlist, os.path.join(hls_dir(video.id), HLS_PLAYLIST))
+        self.assertEqual(package.call_args[0][1], fs.path(hls_dir(video.id)))
+
+
+def ffmpeg(*scripts):
+    """Patch Popen to run a Python script per call in place of ffmpeg."""
+    scripts = iter(scripts)
+    popen = subprocess.Popen
+
+    def run(args, **kwargs):
+        return popen([sys.executable, '-c', next(scripts)], **kwargs)
+    return mock.patch('apps.video.ingest.subprocess.Popen', side_effect=run)
+
+
+class PackageHLSTests(TestCase):
+    def setUp(self):
+        self.out_dir = os.path.join(tempfile.mkdtemp(), 'hls')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.out_dir), ignore_errors=True)
+
+    def test_progress_is_reported(self):
+        script = 'print("frame=1\\nout_time_us=5000000\\nout_time_us=N/A\\nout_time_us=10000000")'
+        progress = []
+        with ffmpeg(script) as popen:
+            package_hls('in.mp4', self.out_dir, 10, progress.append)
+        self.assertEqual(progress, [0.5, 1])
+        self.assertEqual(popen.call_count, 1)
+        self.assertTrue(os.path.isdir(self.out_dir))
+
+    def test_transcodes_when_copy_fails(self):
+        with ffmpeg('import sys; sys.exit("codec not supported")', 'pass') as popen:
+            package_hls('in.mp4', self.out_dir, 10, mock.Mock())
+        args = [call[0][0] for call in popen.call_args_list]
+        for codecs, command in zip(HLS_CODECS, args):
+            self.assertEqual(command[command.index('-i') + 2:][:len(codecs)], codecs)
+
+    def test_failure_raises_the_error(self):
+        # More stderr than a pipe buffers, while stdout stays open.
+        script = 'import sys; sys.stderr.write("x" * 1000000 + "{}\\n"); sys.exit(1)'
+        with ffmpeg(script.format('bad'), script.format('worse')):
+            with self.assertRaisesMessage(RuntimeError, 'worse'):
+                package_hls('in.mp4', self.out_dir, 10, mock.Mock())
+
+    @override_settings(VIDEO_HLS_TIMEOUT=0.5)
+    def test_hung_ffmpeg_is_killed(self):
+        start = time.monotonic()
+        with ffmpeg('import time; time.sleep(30)') as popen:
+            with self.assertRaisesMessage(RuntimeError, 'timed out'):
+                package_hls('in.mp4', self.out_dir, 10, mock.Mock())
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(popen.call_count, 1)
+
+
+@override_settings(FILE_DELIVERY='stream')
+class HLSViewTests(TempStorageMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        with mock.patch('apps.video.signals.ingest_video'):
+            self.video = self.make_video()
+        self.token = 'test-hls-token'
+        cache.set('video.token.' + self.token, self.video.id)
+        self.addCleanup(cache.delete, 'video.token.' + self.token)
+        os.makedirs(fs.path(hls_dir(self.video.id)))
+        with open(fs.path(os.path.join(hls_dir(self.video.id), HLS_PLAYLIST)), 'w') as f:
+            f.write('#EXTM3U\n#EXTINF:6.0,\nseg_00000.ts\n#EXT-X-ENDLIST\n')
+        with open(fs.path(os.path.join(hls_dir(self.video.id), 'seg_00000.ts')), 'wb') as f:
+            f.write(b'segment')
+        self.base = '/api/video/videos/{}/'.format(self.video.id)
+
+    def get(self, path, token=None):
+        return self.client.get(self.base + path, {'token': token or self.token})
+
+    def test_playlist_segments_carry_the_token(self):
+        response = self.get('playlist/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.apple.mpegurl')
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[2], self.base + 'segments/seg_00000.ts/?token=' + self.token)
+        self.assertEqual(lines[3], '#EXT-X-ENDLIST')
+
+    def test_segment(self):
+        response = self.get('segments/seg_00000.ts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'segment')
+        self.assertEqual(response['Content-Type'], 'video/mp2t')
+
+    def test_token_is_required(self):
+        self.assertEqual(self.get('playlist/', token='other').status_code, 403)
+        self.assertEqual(self.get('segments/seg_00000.ts/', token='other').status_code, 403)
+
+    def test_missing_files(self):
+        self.assertEqual(self.get('segments/seg_00001.ts/').status_code, 404)
+        shutil.rmtree(fs.path(hls_dir(self.video.id)))
+        self.assertEqual(self.get('playlist/').status_code, 404)
+
+
+class StreamingTests(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.mp4')
+        self.addCleanup(os.remove, self.path)
+        self.data = os.urandom(3 * MAX_BLOCK + 123)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def asgi_request(self):
+        scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': []}
+        return ASGIRequest(scope, io.BytesIO())
+
+    def test_blocks_grow_to_the_cap(self):
+        sizes = [size for _, size in FileStream(self.path).blocks()]
+        self.assertEqual(sizes[0], MIN_BLOCK)
+        self.assertEqual(max(sizes), MAX_BLOCK)
+        self.assertEqual(sum(sizes), len(self.data))
+        sizes = [size for _, size in FileStream(self.path, max_block=MIN_BLOCK).blocks()]
+        self.assertEqual(max(sizes), MIN_BLOCK)
+
+    def test_range(self):
+        stream = FileStream(self.path, offset=MIN_BLOCK + 5, length=MAX_BLOCK)
+        self.assertEqual(b''.join(stream.chunks()), self.data[MIN_BLOCK + 5:MIN_BLOCK + 5 + MAX_BLOCK])
+        self.assertEqual(FileStream(self.path, offset=len(self.data) + 1).length, 0)
+
+    def test_wsgi_whole_file_uses_file_response(self):
+        resp = stream_file(APIRequestFactory().get('/'), self.path)
+        self.assertIsInstance(resp, FileResponse)
+        self.assertEqual(resp['Content-Length'], str(len(self.data)))
+        resp.close()
+
+    def test_asgi_streams_the_file(self):
+        resp = stream_file(self.asgi_request(), self.path, offset=1)
+        self.assertIsInstance(resp, StreamingHttpResponse)
+        self.assertEqual(b''.join(resp.streaming_content), self.data[1:])
+        self.assertEqual(resp['Content-Length'], str(len(self.data) - 1))
+
+    def test_asgi_handler_reads_off_the_loop(self):
+        threads = []
+
+        def chunks():
+            for chunk in FileStream(self.path).chunks():
+                threads.append(threading.get_ident())
+                yield chunk
+
+        async def send_response():
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            resp = StreamingHttpResponse(chunks())
+            resp.set_cookie('name', 'value')
+            await ASGIHandler().send_response(resp, send)
+            return threading.get_ident(), messages
+
+        loop_thread, messages = asyncio.run(send_response())
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        self.assertIn(b'Set-Cookie', dict(messages[0]['headers']))
+        self.assertEqual(b''.join(m.get('body', b'') for m in messages[1:]), self.data)
+        self.assertNotIn('more_body', messages[-1])
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads)
+
+
+@override_settings(FILE_DELIVERY='stream')
+class VideoStreamTests(TempStorageMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(1000)
+        with mock.patch('apps.video.signals.ingest_video'):
+            self.video = self.make_video(content=self.data)
+        self.token = 'test-stream-token'
+        cache.set('video.token.' + self.token, self.video.id)
+        self.addCleanup(cache.delete, 'video.token.' + self.token)
+        self.url = '/api/video/videos/{}/video/'.format(self.video.id)
+
+    def get(self, **headers):
+        return self.client.get(self.url, {'token': self.token}, **headers)
+
+    def test_whole_video(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-999/1000')
+        self.assertEqual(b''.join(response.streaming_content), self.data[100:])
+
+    def test_range_past_the_end(self):
+        response = self.get(HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1000')
+
+    @override_settings(FILE_DELIVERY='x-accel')
+    def test_offloaded(self):
+        with override_settings(FILE_DELIVERY_LOCATIONS={fs.location: '/protected/storage/video/'}):
+            response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/storage/video/' + self.video.video.name)
@@ -2,34 +2,41 @@ import binascii
 import mimetypes
 import os
 import re
+from urllib.parse import urlencode
 
 from django.core.cache import cache
 from django.db.models import Max
-from django.http import FileResponse, StreamingHttpResponse
+from django.http import HttpResponse
+from django.urls import reverse
 from rest_framework import permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
-from utils import file_iterator
+from utils.delivery import offload, serve_file
 from utils.permissions import ActionModelPermissions
+from utils.query_plan import QueryPlanMixin
+from utils.response_cache import CachedListMixin
+from utils.streaming import stream_file
 
 from . import serializers
-from .models import Category, Video
+from .ingest import HLS_PLAYLIST, HLS_SEGMENT_RE, hls_dir
+from .models import Category, Video, fs
 
 
-class CategoryViewSet(ModelViewSet):
+class CategoryViewSet(CachedListMixin, ModelViewSet):
     queryset = Category.objects.order_by('id')
     serializer_class = serializers.CategorySerializer
     permission_classes = [ActionModelPermissions]
 
 
-class VideoViewSet(ModelViewSet):
+class VideoViewSet(QueryPlanMixin, ModelViewSet):
     queryset = Video.objects.all()
     serializer_class = serializers.VideoSerializer
     permission_classes = [ActionModelPermissions]
     search_fields = ['name', 'content']
     filterset_fields = ['category']
+    query_budgets = {'list': (4, 300), 'retrieve': (3, 200)}
 
     def get_serializer_class(self):
         if self.action in ('create', 'update', 'partial_update'):
@@ -59,15 +66,32 @@ class VideoViewSet(ModelViewSet):
         ret['video_token'] = video_token
         return Response(ret)
 
+    @action(detail=True)
+    def processing(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return Response({'processing_status': instance.processing_status,
+                         'progress': instance.progress,
+                         'processing_error': instance.processing_error})
+
+    def get_video_token(self):
+        """The ``token`` query parameter when ``study`` issued it for this video."""
+        video_token = self.request.query_params.get('token', None)
+        if video_token is None or \
+                str(cache.get('video.token.' + video_token)) != self.kwargs['pk']:
+            return None
+        return video_token
+
     @action(detail=True, methods=['GET'], permission_classes=[permissions.AllowAny])
     def video(self, request, *args, **kwargs):
-        video_token = request.query_params.get('token', None)
-        key = 'video.token.' + video_token
-        instance = self.get_object()
-        if video_token is None or cache.get(key) != instance.id:
+        if self.get_video_token() is None:
             return Response(status=status.HTTP_403_FORBIDDEN)
+        instance = self.get_object()
 
         path = instance.video.path
+        # The web server answers Range requests itself when offloaded.
+        resp = offload(path)
+        if resp is not None:
+            return resp
         range_header = request.META.get('HTTP_RANGE', '').strip()
         range_re = re.compile(r'bytes\s*=\s*(\d+)\s*-\s*(\d*)', re.I)
         range_match = range_re.match(range_header)
@@ -77,24 +101,56 @@ class VideoViewSet(ModelViewSet):
         if range_match:
             first_byte, last_byte = range_match.groups()
             first_byte = int(first_byte) if first_byte else 0
+            if first_byte >= size:
+                resp = Response(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                resp['Content-Range'] = 'bytes */%s' % size
+                return resp
             last_byte = first_byte + 1024 * 1024 * 16
             if last_byte >= size:
                 last_byte = size - 1
             length = last_byte - first_byte + 1
-            resp = StreamingHttpResponse(
-                file_iterator(path, offset=first_byte, length=length),
-                status=206,
-                content_type=content_type
-            )
-            resp['Content-Length'] = str(length)
+            resp = stream_file(request, path, offset=first_byte, length=length,
+                               status=206, content_type=content_type)
             resp['Content-Range'] = 'bytes %s-%s/%s' % (first_byte, last_byte, size)
         else:
-            resp = FileResponse(instance.video)
-            if not resp.headers.get("Content-Length", None):
-                resp.headers["Content-Length"] = instance.video.size
+            resp = stream_file(request, path, content_type=content_type)
         resp['Accept-Ranges'] = 'bytes'
         return resp
 
+    @action(detail=True, methods=['GET'], permission_classes=[permissions.AllowAny])
+    def playlist(self, request, *args, **kwargs):
+        """HLS playlist whose segment URIs carry the video token."""
+        video_token = self.get_video_token()
+        if video_token is None:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        name = os.path.join(hls_dir(kwargs['pk']), HLS_PLAYLIST)
+        if not fs.exists(name):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        with fs.open(name) as f:
+            lines = f.read().decode().splitlines()
+        query = urlencode({'token': video_token})
+        for i, line in enumerate(lines):
+            if line and not line.startswith('#'):
+                path = reverse('video-segment', kwargs={'pk': kwargs['pk'],
+                                                        'segment': os.path.basename(line)})
+                lines[i] = '{}?{}'.format(path, query)
+        resp = HttpResponse('\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+        resp['Cache-Control'] = 'no-store'
+        return resp
+
+    @action(detail=True, methods=['GET'], permission_classes=[permissions.AllowAny],
+            url_path=r'segments/(?P<segment>{})'.format(HLS_SEGMENT_RE))
+    def segment(self, request, *args, **kwargs):
+        # Authorized by the token alone, no database access per segment.
+        if self.get_video_token() is None:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        name = os.path.join(hls_dir(kwargs['pk']), kwargs['segment'])
+        if not fs.exists(name):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        resp = serve_file(request, fs.path(name), content_type='video/mp2t')
+        resp['Cache-Control'] = 'private, max-age=86400'
+        return resp
+
     @action(detail=True, methods=['POST'], permission_classes=[permissions.IsAuthenticated])
     def like(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -9,8 +9,11 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
+django.setup(set_prefix=False)
 
-application = get_asgi_application()
+from utils.streaming import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
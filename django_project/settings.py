@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -52,6 +53,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'apps.system.middleware.QueryCountMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     #'django.middleware.csrf.CsrfViewMiddleware',
@@ -135,6 +137,14 @@ STATIC_ROOT = BASE_DIR / 'static'
 MEDIA_URL = URL_PREFIX + 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 STORAGE_ROOT = BASE_DIR / 'storage'
+# How file contents are sent, see utils.delivery: 'stream' through Django,
+# 'x-accel' (nginx X-Accel-Redirect) or 'x-sendfile' (Apache, lighttpd)
+FILE_DELIVERY = os.environ.get('FILE_DELIVERY') or 'stream'
+# Filesystem root -> internal location the web server serves it from
+FILE_DELIVERY_LOCATIONS = {
+    STORAGE_ROOT: '/protected/storage/',
+    MEDIA_ROOT: '/protected/media/',
+}
 
 
 # Default primary key field type
@@ -146,12 +156,53 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 CORS_ALLOW_ALL_ORIGINS = True
 
 TOKEN_EXPIRE_SECONDS = 3600 * 24 * 14
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_LOCAL_TTL = 30
+# utils.tokens.DatabaseTokenBackend, RedisTokenBackend or DualTokenBackend
+# (Redis for new logins, Token rows still accepted while migrating)
+AUTH_TOKEN_BACKEND = os.environ.get('AUTH_TOKEN_BACKEND') or 'utils.tokens.DatabaseTokenBackend'
+TOKEN_SLIDING_EXPIRY = False  # Redis backends only
+
+VERIFICATION_CODE_TTL = 3600
+VERIFICATION_CODE_MAX_ATTEMPTS = 5  # per code
+VERIFICATION_CODE_MAX_IP_ATTEMPTS = 20  # per VERIFICATION_CODE_TTL
+VERIFICATION_CODE_SEND_WINDOW = 3600
+VERIFICATION_CODE_MAX_SENDS = 5  # per user and window
+VERIFICATION_CODE_MAX_IP_SENDS = 20  # per ip and window
+
+# QueryCountMiddleware, X-DB-* headers on responses
+QUERY_COUNT_HEADERS = DEBUG
+# Default (queries, milliseconds) budget of check_query_budgets, viewsets
+# declare their own per action in ``query_budgets``
+QUERY_BUDGET_DEFAULT = (10, 500)
+
+# OperationLogMiddleware buffering, overflow is one of 'drop', 'sample', 'block'
+OPERATION_LOG_BUFFER_SIZE = 10000
+OPERATION_LOG_BATCH_SIZE = 200
+OPERATION_LOG_FLUSH_INTERVAL = 1000  # ms
+OPERATION_LOG_OVERFLOW = 'drop'
+OPERATION_LOG_SAMPLE_RATE = 0.1
+# Write each row in its request instead of the writer thread. On for the
+# test runner, so the rows stay in the test's transaction.
+OPERATION_LOG_SYNC = os.environ.get('OPERATION_LOG_SYNC', 'False') == 'True' or sys.argv[1:2] == ['test']
+OPERATION_LOG_ROLLUP_SETTLE = 60  # seconds after insert before a row is rolled up
+OPERATION_LOG_ARCHIVE_ROOT = STORAGE_ROOT / 'operationlog'
+OPERATION_LOG_ARCHIVE_DAYS = 90
+OPERATION_LOG_ARCHIVE_BATCH_SIZE = 5000
+OPERATION_LOG_ARCHIVE_LEVEL = 10
+OPERATION_LOG_ARCHIVE_MAX_LIMIT = 1000
 
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
     'guardian.backends.ObjectPermissionBackend',
 ]
 
+# Compiled per-user permission sets, see utils.perm_cache. Guardian object
+# permissions are compiled in for these models only, files and tags.
+PERM_CACHE_OBJECT_MODELS = ['filestore.File', 'filestore.Tag']
+PERM_CACHE_SIZE = 10000
+PERM_CACHE_TTL = 3600
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'utils.authentication.CustomTokenAuthentication',
@@ -162,9 +213,14 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # orjson backed, behaves as the stock classes when orjson is not installed
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
+        'utils.renderers.ORJSONRenderer',
+    ] + (['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
+    'DEFAULT_PARSER_CLASSES': [
+        'utils.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -174,21 +230,75 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'utils.pagination.CustomPagination',
     'PAGE_SIZE': 10,
 }
+PAGINATION_MAX_PAGE_SIZE = 100
+# utils.response_cache, cached list responses and their rebuild lock
+RESPONSE_CACHE_TIMEOUT = 60 * 60
+RESPONSE_CACHE_LOCK_TIMEOUT = 10
+RESPONSE_CACHE_LOCK_WAIT = 0.1  # seconds a miss waits for the request building the entry
+# Above this many rows (planner estimate) list counts are estimated
+PAGINATION_ESTIMATE_THRESHOLD = 100000
 
 from celery.schedules import crontab
 REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379/0'
+# Local LRU in front of Redis, see utils.cache. The database is shared with
+# Celery, keys live under KEY_PREFIX which is what cache.clear() deletes.
+CACHES = {
+    'default': {
+        'BACKEND': 'utils.cache.TwoTierRedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'cache',
+        'OPTIONS': {
+            'LOCAL_MAXSIZE': 10000,
+            'LOCAL_TTL': 60,
+        },
+    },
+}
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL') or REDIS_URL
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND') or REDIS_URL
 CELERY_TIMEZONE = 'Asia/Shanghai'
 CELERY_ENABLE_UTC = False
 CELERY_RESULT_EXPIRES = 60 * 60
-CELERY_BEAT_SCHEDULE = {}
+# Package uploaded videos as HLS (needs ffmpeg), segments of this many seconds
+VIDEO_HLS = os.environ.get('VIDEO_HLS', 'False') == 'True'
+VIDEO_HLS_SEGMENT_SECONDS = 6
+VIDEO_HLS_TIMEOUT = 60 * 60  # seconds an ffmpeg run may take before it is killed
+# Video ingest is CPU bound and runs on its own workers, see deploy/docker-compose.yml
+CELERY_TASK_ROUTES = {
+    'apps.video.tasks.*': {'queue': 'video'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'rollup-operation-logs': {
+        'task': 'apps.system.tasks.rollup_operation_logs',
+        'schedule': crontab(),
+    },
+    'archive-operation-logs': {
+        'task': 'apps.system.tasks.archive_operation_logs',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    'flush-email-outbox': {
+        'task': 'apps.system.tasks.flush_email_outbox',
+        'schedule': crontab(),
+    },
+}
 
-EMAIL_HOST = 'smtp.feishu.cn'
-EMAIL_PORT = 465
+# For a local debugging server (aiosmtpd, see requirements-dev.txt):
+# python -m aiosmtpd -n -l localhost:1025
+# with EMAIL_HOST=localhost EMAIL_PORT=1025 EMAIL_USE_SSL=False
+EMAIL_HOST = os.environ.get('EMAIL_HOST') or 'smtp.feishu.cn'
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT') or 465)
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
-EMAIL_USE_SSL = True
+EMAIL_USE_SSL = os.environ.get('EMAIL_USE_SSL', 'True') == 'True'
+EMAIL_OUTBOX_DELAY = 5  # seconds a new message waits for others to batch with
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_RETRY_DELAY = 30  # seconds, doubled on every retry
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5  # refusals of a message before it moves to the dead list
 ADMIN_EMAIL_LIST = ['admin@project.com',]
 EMAIL_SUBJECT_PREFIX = "【ProjectName】"
 EMAIL_SIGNATURE = "ProjectName"
+
+LARK_APP_ID = os.environ.get('LARK_APP_ID', '')
+LARK_APP_SECRET = os.environ.get('LARK_APP_SECRET', '')
+# Point at a stub server to test without reaching Lark.
+LARK_BASE_URL = os.environ.get('LARK_BASE_URL') or 'https://open.feishu.cn'
+LARK_RATE_LIMIT = 50  # requests per second, shared by all processes
@@ -28,8 +28,10 @@ urlpatterns = [
     path(settings.URL_PREFIX + 'admin/', admin.site.urls),
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+# Offloading deployments serve media and static from the web server.
+if settings.FILE_DELIVERY == 'stream':
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 if settings.DEBUG:
     from drf_yasg import openapi
@@ -1,15 +1,4 @@
-import os
-
-
-def file_iterator(file_name, chunk_size=8192, offset=0, length=None):
-    with open(file_name, "rb") as f:
-        f.seek(offset, os.SEEK_SET)
-        remaining = length
-        while True:
-            bytes_length = chunk_size if remaining is None else min(remaining, chunk_size)
-            data = f.read(bytes_length)
-            if not data:
-                break
-            if remaining:
-                remaining -= len(data)
-            yield data
+def get_client_ip(request):
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    return x_forwarded_for.split(",")[0] if x_forwarded_for \
+        else request.META.get('REMOTE_ADDR')
@@ -1,27 +1,41 @@
 import time
+from datetime import datetime, timezone
 
-from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.utils.translation import gettext_lazy as _
 from rest_framework import exceptions
 from rest_framework.authentication import TokenAuthentication
 
+from .token_cache import load_user
+from .tokens import get_token_backend
+
+User = get_user_model()
+
 
 class CustomTokenAuthentication(TokenAuthentication):
-    """Add token expired."""
+    """Add token expired, tokens are resolved by the ``AUTH_TOKEN_BACKEND``."""
 
     keyword = 'Bearer'
 
     def authenticate_credentials(self, key):
-        model = self.get_model()
-        try:
-            token = model.objects.select_related('user').get(key=key)
-        except model.DoesNotExist:
+        entry = get_token_backend().lookup(key)
+        if entry is None:
             raise exceptions.AuthenticationFailed(_('Invalid token.'))
 
-        if not token.user.is_active:
+        if not entry['is_active']:
             raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
 
-        if time.time() - token.created.timestamp() > settings.TOKEN_EXPIRE_SECONDS:
+        if entry['expires'] is not None and time.time() > entry['expires']:
             raise exceptions.AuthenticationFailed(_('Token expired.'))
 
-        return (token.user, token)
+        # Cached snapshots are dropped whenever the row changes, entries
+        # without one are resolved against the row.
+        if 'user' in entry:
+            user = load_user(entry['user'])
+        else:
+            user = User.objects.filter(pk=entry['user_id']).first()
+        if user is None or not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        created = datetime.fromtimestamp(entry['created'], tz=timezone.utc)
+        return (user, self.get_model()(key=key, user=user, created=created))
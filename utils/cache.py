@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import redis
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.redis import RedisCache, RedisCacheClient
+
+from .lru import LRUCache
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+class SharedRedisCacheClient(RedisCacheClient):
+    """Use the process-wide pool of ``get_redis`` when the cache points at ``REDIS_URL``."""
+
+    def _get_connection_pool(self, write):
+        if self._servers == [settings.REDIS_URL]:
+            return get_redis().connection_pool
+        return super()._get_connection_pool(write)
+
+
+class LocalTier:
+    """In-process LRU of one channel, shared by the per-thread cache instances.
+
+    A daemon thread subscribed to ``channel`` drops keys written by other
+    processes. Entries are only served while subscribed. ``generation``
+    counts the invalidations, a value read before an invalidation is not
+    stored.
+    """
+
+    def __init__(self, channel, maxsize, ttl):
+        self.channel = channel
+        self.lru = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.redis_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._pid = None
+        self._node = None
+        self._listening = threading.Event()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def get(self, key):
+        self._ensure_listener()
+        if not self._listening.is_set():
+            return _missing
+        return self.lru.get(key, _missing)
+
+    def set(self, key, raw, ttl, generation):
+        """Store ``raw`` read from Redis while the tier was at ``generation``."""
+        with self._write_lock:
+            if self._listening.is_set() and generation == self.generation:
+                self.lru.set(key, raw, ttl)
+
+    def drop(self, keys):
+        with self._write_lock:
+            self.generation += 1
+            if keys == '*':
+                self.lru.clear()
+            else:
+                for key in keys:
+                    self.lru.delete(key)
+
+    def invalidate(self, keys):
+        """Drop ``keys`` (or everything for ``'*'``) here and in every other process."""
+        self.drop(keys)
+        self._ensure_listener()
+        try:
+            get_redis().publish(self.channel, json.dumps({'node': self._node, 'keys': keys}))
+        except redis.RedisError:
+            logger.warning('Cache invalidation publish failed', exc_info=True)
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child must not trust entries or the thread of its parent.
+            self.drop('*')
+            self._listening.clear()
+            self._node = uuid.uuid4().hex
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen, name='cache-invalidation', daemon=True).start()
+
+    def _listen(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                self._listening.set()
+                for message in pubsub.listen():
+                    self._handle_message(message)
+            except redis.RedisError:
+                logger.warning('Cache invalidation subscription lost', exc_info=True)
+            finally:
+                # Messages may be missed until subscribed again.
+                self._listening.clear()
+                self.drop('*')
+                pubsub.close()
+            time.sleep(1)
+
+    def _handle_message(self, message):
+        data = json.loads(message['data'])
+        if data['node'] == self._node:
+            return
+        self.invalidations += 1
+        self.drop(data['keys'])
+
+    def stats(self):
+        local_hits = self.lru.hits
+        total = local_hits + self.redis_hits + self.misses
+        return {
+            'size': len(self.lru),
+            'listening': self._listening.is_set(),
+            'local_hits': local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round((total - self.misses) / total, 4) if total else None,
+        }
+
+
+def get_local_tier(channel, maxsize, ttl):
+    with _tiers_lock:
+        if channel not in _tiers:
+            _tiers[channel] = LocalTier(channel, maxsize, ttl)
+        return _tiers[channel]
+
+
+class TwoTierRedisCache(RedisCache):
+    """RedisCache with an in-process LRU in front of it.
+
+    Reads fill the local tier for at most ``LOCAL_TTL`` seconds and never
+    past the key's expiry in Redis. Every write is published on
+    ``CHANNEL`` and other processes drop the key from their local tier.
+    Django builds one backend per thread, the tier is shared per process.
+
+    OPTIONS: ``LOCAL_MAXSIZE``, ``LOCAL_TTL``, ``CHANNEL``, the rest is
+    passed to RedisCacheClient.
+    """
+
+    def __init__(self, server, params):
+        params = dict(params)
+        options = dict(params.get('OPTIONS', {}))
+        self.tier = get_local_tier(options.pop('CHANNEL', 'cache.invalidate'),
+                                   options.pop('LOCAL_MAXSIZE', 10000),
+                                   options.pop('LOCAL_TTL', 60))
+        params['OPTIONS'] = options
+        super().__init__(server, params)
+        self._class = SharedRedisCacheClient
+
+    # Reads
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._get_many([key]).get(key, default)
+
+    def get_many(self, keys, version=None):
+        key_map = {self.make_and_validate_key(k, version=version): k for k in keys}
+        return {key_map[k]: v for k, v in self._get_many(list(key_map)).items()}
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return key in self._get_many([key])
+
+    def _get_many(self, keys):
+        serializer = self._cache._serializer
+        found, fetch = {}, []
+        for key in keys:
+            raw = self.tier.get(key)
+            if raw is _missing:
+                fetch.append(key)
+            else:
+                found[key] = serializer.loads(raw)
+        if not fetch:
+            return found
+
+        # An invalidation during the round trip may concern the values read.
+        generation = self.tier.generation
+        # One round trip for the values and their remaining lifetime.
+        pipe = self._cache.get_client().pipeline(transaction=False)
+        for key in fetch:
+            pipe.get(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+        for key, raw, pttl in zip(fetch, results[::2], results[1::2]):
+            if raw is None:
+                self.tier.misses += 1
+                continue
+            self.tier.redis_hits += 1
+            found[key] = serializer.loads(raw)
+            self.tier.set(key, raw, pttl / 1000 if pttl > 0 else None, generation)
+        return found
+
+    # Writes, each one invalidates the key in every process
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = super().add(key, value, timeout, version)
+        if added:
+            self.tier.invalidate([self.make_and_validate_key(key, version=version)])
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version)
+        self.tier.invalidate([self.make_and_validate_key(key, version=version)])
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        touched = super().touch(key, timeout, version)
+        self.tier.invalidate([self.make_and_validate_key(key, version=version)])
+        return touched
+
+    def delete(self, key, version=None):
+        deleted = super().delete(key, version)
+        self.tier.invalidate([self.make_and_validate_key(key, version=version)])
+        return deleted
+
+    def incr(self, key, delta=1, version=None):
+        value = super().incr(key, delta, version)
+        self.tier.invalidate([self.make_and_validate_key(key, version=version)])
+        return value
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = super().set_many(data, timeout, version)
+        self.tier.invalidate([self.make_and_validate_key(k, version=version) for k in data])
+        return failed
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        super().delete_many(keys, version)
+        self.tier.invalidate([self.make_and_validate_key(k, version=version) for k in keys])
+
+    def clear(self):
+        """Delete the keys under ``KEY_PREFIX``, RedisCache would flush the whole database."""
+        if not self.key_prefix:
+            cleared = super().clear()
+        else:
+            client = self._cache.get_client(write=True)
+            keys = []
+            for key in client.scan_iter(match=self.key_prefix + ':*', count=1000):
+                keys.append(key)
+                if len(keys) >= 1000:
+                    client.delete(*keys)
+                    keys = []
+            if keys:
+                client.delete(*keys)
+            cleared = True
+        self.tier.invalidate('*')
+        return cleared
+
+    def stats(self):
+        return self.tier.stats()
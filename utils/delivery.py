@@ -0,0 +1,65 @@
+import mimetypes
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+
+from .streaming import stream_file
+
+MODES = ('stream', 'x-accel', 'x-sendfile')
+
+
+def content_disposition(filename, as_attachment=False):
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+        return '{}; filename="{}"'.format(
+            disposition, filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        return "{}; filename*=utf-8''{}".format(disposition, quote(filename))
+
+
+def internal_uri(path):
+    """The ``FILE_DELIVERY_LOCATIONS`` URI of ``path``, None when no root contains it."""
+    path = os.path.realpath(path)
+    for root, location in settings.FILE_DELIVERY_LOCATIONS.items():
+        root = os.path.realpath(root)
+        if path.startswith(root + os.sep):
+            return location.rstrip('/') + '/' + quote(os.path.relpath(path, root))
+    return None
+
+
+def offload(path, content_type=None):
+    """Response asking the web server to send ``path``.
+
+    None in stream mode or when ``path`` is outside the mapped roots, the
+    caller then streams the file itself. The web server handles Range
+    requests on the redirected file.
+    """
+    mode = settings.FILE_DELIVERY
+    if mode not in MODES:
+        raise ImproperlyConfigured('FILE_DELIVERY must be one of {}'.format(', '.join(MODES)))
+    if mode == 'stream':
+        return None
+
+    if mode == 'x-accel':
+        header, value = 'X-Accel-Redirect', internal_uri(path)
+    else:
+        # Header values are latin-1, a non-ascii path would arrive mangled.
+        header, value = 'X-Sendfile', path if path.isascii() else None
+    if value is None:
+        return None
+    resp = HttpResponse(content_type=content_type or mimetypes.guess_type(path)[0]
+                        or 'application/octet-stream')
+    resp[header] = value
+    return resp
+
+
+def serve_file(request, path, content_type=None, filename=None, as_attachment=False):
+    """Offload ``path`` to the web server, or stream it with ``stream_file``."""
+    resp = offload(path, content_type) or stream_file(request, path, content_type=content_type)
+    if filename:
+        resp['Content-Disposition'] = content_disposition(filename, as_attachment)
+    return resp
@@ -1,15 +1,118 @@
-import datetime
+import logging
+import threading
+import time
 
+import redis
 import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Error codes of a missing, invalid or expired tenant_access_token
+TOKEN_ERROR_CODES = (99991661, 99991663, 99991668)
+
+
+class TokenBucket:
+    """Allow ``rate`` calls per second on average with bursts up to ``capacity``."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RedisTokenBucket:
+    """``TokenBucket`` kept in Redis under ``key``, shared by every process.
+
+    Falls back to a per-process bucket while Redis is unavailable.
+    """
+
+    # Refill by the time elapsed on the Redis clock, take a token or return
+    # the seconds until one is available.
+    take_script = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - updated_at, 0) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, key, rate, capacity=None):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.local = TokenBucket(rate, capacity)
+        self._take = None
+
+    def acquire(self):
+        while True:
+            try:
+                if self._take is None:
+                    self._take = get_redis().register_script(self.take_script)
+                wait = float(self._take(keys=[self.key], args=[self.rate, self.capacity]))
+            except redis.RedisError:
+                logger.warning('Shared rate limiter unavailable, limiting per process', exc_info=True)
+                self.local.acquire()
+                return
+            if wait <= 0:
+                return
+            time.sleep(wait)
 
 
 class Lark:
-    def __init__(self, app_id="", app_secret=""):
+    """Lark open API client.
+
+    Requests share one keep-alive connection pool. The rate limit and the
+    tenant_access_token are kept in Redis for all processes of the app, the
+    token is refreshed by one caller at a time, behind a thread lock and a
+    Redis lock.
+    """
+
+    def __init__(self, app_id="", app_secret="", base_url=None, rate=None,
+                 pool_size=10, timeout=10):
         self.app_id = app_id
         self.app_secret = app_secret
+        self.base_url = (base_url or settings.LARK_BASE_URL).rstrip('/')
+        self.timeout = timeout
         self.tenant_access_token = None
-        self.expire_at = None
+        self.expire_at = 0
+        self.limiter = RedisTokenBucket('lark.ratelimit.' + app_id, rate or settings.LARK_RATE_LIMIT)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._token_key = 'lark.tenant_access_token.' + app_id
 
     def prepare_headers(self, need_tenant_access_token=True) -> dict:
         headers = {"Content-Type": "application/json; charset=utf-8"}
@@ -18,27 +121,123 @@ class Lark:
         return headers
 
     def get_tenant_access_token(self):
-        now = datetime.datetime.now()
-        if self.expire_at and self.expire_at > now:
+        if self.expire_at > time.time():
             return self.tenant_access_token
-        url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
+        with self._lock:
+            if self.expire_at > time.time():
+                return self.tenant_access_token
+            try:
+                client = get_redis()
+                if not self._load_shared_token(client):
+                    with client.lock(self._token_key + '.lock', timeout=30, blocking_timeout=10):
+                        # Another process may have refreshed while we waited.
+                        if not self._load_shared_token(client):
+                            self._refresh_token(client)
+            except redis.RedisError:
+                logger.warning('Lark token cache unavailable', exc_info=True)
+                self._refresh_token()
+        return self.tenant_access_token or ''
+
+    def invalidate_tenant_access_token(self):
+        with self._lock:
+            self.tenant_access_token = None
+            self.expire_at = 0
+            try:
+                get_redis().delete(self._token_key)
+            except redis.RedisError:
+                pass
+
+    def _load_shared_token(self, client):
+        pipe = client.pipeline()
+        pipe.get(self._token_key)
+        pipe.ttl(self._token_key)
+        token, ttl = pipe.execute()
+        if token is None or ttl <= 0:
+            return False
+        self.tenant_access_token = token.decode()
+        self.expire_at = time.time() + ttl
+        return True
+
+    def _refresh_token(self, client=None):
+        url = self.base_url + "/open-apis/auth/v3/tenant_access_token/internal/"
         body = {
             "app_id": self.app_id,
             "app_secret": self.app_secret,
         }
         headers = self.prepare_headers(need_tenant_access_token=False)
-        r = requests.request('POST', url, json=body, headers=headers)
-        if r.json().get('code') != 0:
-            print('get_tenant_access_token error')
-            return ''
-        self.tenant_access_token = r.json()['tenant_access_token']
-        self.expire_at = now + datetime.timedelta(seconds=(r.json()['expire'] - 300))
-        return self.tenant_access_token
+        self.limiter.acquire()
+        data = self.session.post(url, json=body, headers=headers, timeout=self.timeout).json()
+        if data.get('code') != 0:
+            logger.error('get_tenant_access_token error: %s', data)
+            return
+        # Refresh 5 minutes before Lark expires the token.
+        ttl = data['expire'] - 300
+        self.tenant_access_token = data['tenant_access_token']
+        self.expire_at = time.time() + ttl
+        if client is not None:
+            client.set(self._token_key, self.tenant_access_token, ex=ttl)
 
     def request(self, method, url, params=None, json=None):
-        headers = self.prepare_headers()
-        r = requests.request(method, url, headers=headers, params=params, json=json)
-        return r.json()
+        """Call ``url``, a full URL or a path under ``base_url``.
+
+        A token error refreshes the token and retries once.
+        """
+        if url.startswith('/'):
+            url = self.base_url + url
+        for _ in range(2):
+            headers = self.prepare_headers()
+            self.limiter.acquire()
+            data = self.session.request(method, url, headers=headers, params=params,
+                                        json=json, timeout=self.timeout).json()
+            if data.get('code') not in TOKEN_ERROR_CODES:
+                break
+            self.invalidate_tenant_access_token()
+        return data
+
+    def batch_send_message(self, user_ids, msg_type, content, chunk_size=200):
+        """Send one message to many users, ``chunk_size`` users per request."""
+        results = []
+        for i in range(0, len(user_ids), chunk_size):
+            results.append(self.request('POST', '/open-apis/message/v4/batch_send/', json={
+                'user_ids': user_ids[i:i + chunk_size],
+                'msg_type': msg_type,
+                'content': content,
+            }))
+        return results
+
+
+class AsyncLark:
+    """Awaitable facade over a ``Lark`` client, calls run in worker threads."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def request(self, method, url, params=None, json=None):
+        return await sync_to_async(self.client.request, thread_sensitive=False)(
+            method, url, params=params, json=json)
+
+    async def batch_send_message(self, user_ids, msg_type, content, chunk_size=200):
+        return await sync_to_async(self.client.batch_send_message, thread_sensitive=False)(
+            user_ids, msg_type, content, chunk_size=chunk_size)
+
+
+_lark = None
+_lark_lock = threading.Lock()
+
+
+def get_lark():
+    """The client of the configured Lark app, created on first use."""
+    global _lark
+    if _lark is None:
+        with _lark_lock:
+            if _lark is None:
+                _lark = Lark(app_id=settings.LARK_APP_ID, app_secret=settings.LARK_APP_SECRET)
+    return _lark
 
 
-lark = Lark(app_id=settings.LARK_APP_ID, app_secret=settings.LARK_APP_SECRET)
+def __getattr__(name):
+    # ``from utils.lark import lark`` keeps working without building the
+    # client when the module is imported.
+    if name == 'lark':
+        return get_lark()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -1,5 +1,105 @@
-from rest_framework.pagination import PageNumberPagination
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import PageNumberPagination, CursorPagination
+from rest_framework.response import Response
+
+
+def estimate_count(queryset):
+    """Row estimate of the PostgreSQL planner for ``queryset``, None elsewhere."""
+    if not isinstance(queryset, QuerySet):
+        return None
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Use the planner estimate instead of COUNT(*) once results are large."""
+
+    estimated = False
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate >= settings.PAGINATION_ESTIMATE_THRESHOLD:
+            self.estimated = True
+            return estimate
+        return super().count
 
 
 class CustomPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
+    max_page_size = settings.PAGINATION_MAX_PAGE_SIZE
+    django_paginator_class = EstimatedCountPaginator
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.paginator.count),
+            ('estimated', self.page.paginator.estimated),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class CustomCursorPagination(CursorPagination):
+    """Keyset pagination on the ordering the queryset already has.
+
+    The ordering is made unique with a trailing ``-pk``, rows sharing a
+    timestamp are then neither skipped nor repeated across pages.
+    """
+
+    page_size_query_param = 'page_size'
+    max_page_size = settings.PAGINATION_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering or ['-pk'])
+        if not all(isinstance(x, str) for x in ordering):
+            raise ImproperlyConfigured(
+                'Cursor pagination needs field name orderings, %s is ordered by %r'
+                % (view.__class__.__name__, ordering))
+        if not {'pk', '-pk', 'id', '-id'} & set(ordering):
+            ordering.append('-pk')
+        return tuple(ordering)
+
+
+class CursorOptInPagination(CustomPagination):
+    """``CustomPagination`` unless the client asks for ``?pagination=cursor``.
+
+    Cursor pages answer with ``next``/``previous``/``results`` only, no
+    ``count``; their links carry the parameter on.
+    """
+
+    mode_query_param = 'pagination'
+    cursor_class = CustomCursorPagination
+
+    def __init__(self):
+        self.cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor = None
+        if request.query_params.get(self.mode_query_param) == 'cursor':
+            self.cursor = self.cursor_class()
+            return self.cursor.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor is not None:
+            return self.cursor.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor is not None:
+            return self.cursor.to_html()
+        return super().to_html()
@@ -0,0 +1,124 @@
+import json
+import logging
+
+import redis
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.dispatch import Signal
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from .lru import LRUCache
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_VERSION_KEY = 'perm.version'
+USER_VERSION_KEY = 'perm.version.{}'
+
+# Sent after commit with ``user_ids`` whenever users' permissions change.
+user_perms_changed = Signal()
+
+local = LRUCache(maxsize=settings.PERM_CACHE_SIZE, ttl=settings.PERM_CACHE_TTL)
+
+
+def object_content_types():
+    models = [apps.get_model(label) for label in settings.PERM_CACHE_OBJECT_MODELS]
+    return {ct.id for ct in ContentType.objects.get_for_models(*models).values()}
+
+
+def object_perm(perm, content_type_id, pk):
+    return '{}:{}:{}'.format(perm, content_type_id, pk)
+
+
+def compile_perms(user):
+    """Global permissions plus object permissions on the cached models.
+
+    Object permissions are stored as ``app_label.codename:content_type_id:pk``.
+    """
+    perms = set(user.get_all_permissions())
+    ct_ids = object_content_types()
+    fields = ['permission__content_type__app_label', 'permission__codename',
+              'content_type_id', 'object_pk']
+    rows = list(UserObjectPermission.objects.filter(
+        user=user, content_type_id__in=ct_ids).values_list(*fields))
+    rows += GroupObjectPermission.objects.filter(
+        group__user=user, content_type_id__in=ct_ids).values_list(*fields)
+    for app_label, codename, ct_id, pk in rows:
+        perms.add(object_perm('{}.{}'.format(app_label, codename), ct_id, pk))
+    return perms
+
+
+def get_perms(user):
+    """Compiled permission set of ``user``, memoized on the user object.
+
+    The set is cached in Redis and locally under the global and the user's
+    version counter, bumping either one makes the next lookup recompile.
+    """
+    perms = getattr(user, '_compiled_perms', None)
+    if perms is not None:
+        return perms
+    try:
+        client = get_redis()
+        versions = client.mget(GLOBAL_VERSION_KEY, USER_VERSION_KEY.format(user.pk))
+        key = 'perm.set.{}.{}.{}'.format(user.pk, *[int(v or 0) for v in versions])
+        perms = local.get(key)
+        if perms is None:
+            raw = client.get(key)
+            if raw is None:
+                perms = compile_perms(user)
+                client.set(key, json.dumps(sorted(perms)), ex=settings.PERM_CACHE_TTL)
+            else:
+                perms = set(json.loads(raw))
+            local.set(key, perms)
+    except redis.RedisError:
+        logger.warning('Permission cache unavailable', exc_info=True)
+        perms = compile_perms(user)
+    user._compiled_perms = perms
+    return perms
+
+
+def has_perms(user, perm_list, obj=None):
+    """Drop-in for ``user.has_perms`` answered from the compiled set."""
+    if not user.is_authenticated:
+        return user.has_perms(perm_list, obj)
+    if not user.is_active:
+        return False
+    if user.is_superuser:
+        return True
+    if obj is None:
+        perms = get_perms(user)
+        return all(perm in perms for perm in perm_list)
+    ct_id = ContentType.objects.get_for_model(obj).id
+    if ct_id not in object_content_types():
+        return user.has_perms(perm_list, obj)
+    perms = get_perms(user)
+    return all(object_perm(perm, ct_id, obj.pk) in perms for perm in perm_list)
+
+
+def invalidate_user_perms(*users):
+    """Bump the version of ``users`` (instances or ids) once the transaction commits."""
+    user_ids = [getattr(u, 'pk', u) for u in users]
+
+    def on_commit():
+        _bump([USER_VERSION_KEY.format(pk) for pk in user_ids])
+        user_perms_changed.send(sender=None, user_ids=user_ids)
+
+    transaction.on_commit(on_commit)
+
+
+def invalidate_all_perms():
+    transaction.on_commit(lambda: _bump([GLOBAL_VERSION_KEY]))
+
+
+def _bump(keys):
+    if not keys:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        for key in keys:
+            pipe.incr(key)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception('Failed to bump permission versions')
@@ -1,6 +1,9 @@
+from django.http import Http404
 from rest_framework import exceptions
 from rest_framework import permissions
 
+from .perm_cache import has_perms
+
 SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
 
@@ -35,7 +38,7 @@ class ActionModelPermissions(permissions.DjangoModelPermissions):
         except exceptions.MethodNotAllowed:
             perms = self.get_required_permissions(request.method, queryset.model)
 
-        return request.user.has_perms(perms)
+        return has_perms(request.user, perms)
 
 
 class ActionModelWithReadPermissions(ActionModelPermissions):
@@ -76,7 +79,7 @@ class ActionObjectPermissions(ActionModelPermissions):
         except exceptions.MethodNotAllowed:
             perms = self.get_required_permissions(request.method, model_cls)
 
-        if not user.has_perms(perms, obj):
+        if not has_perms(user, perms, obj):
             # If the user does not have permissions we need to determine if
             # they have read permissions to see 403, or not, and simply see
             # a 404 response.
@@ -87,7 +90,7 @@ class ActionObjectPermissions(ActionModelPermissions):
                 raise Http404
 
             read_perms = self.get_required_permissions('GET', model_cls)
-            if not user.has_perms(read_perms, obj):
+            if not has_perms(user, read_perms, obj):
                 raise Http404
 
             # Has read permissions.
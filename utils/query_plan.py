@@ -0,0 +1,96 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+
+
+class QueryPlan:
+    def __init__(self, select, prefetch, only):
+        self.select = select
+        self.prefetch = prefetch
+        self.only = only
+
+    def apply(self, queryset, only=False):
+        if self.select:
+            queryset = queryset.select_related(*self.select)
+        if self.prefetch:
+            queryset = queryset.prefetch_related(*self.prefetch)
+        if only and self.only:
+            queryset = queryset.only(*self.only)
+        return queryset
+
+
+def walk(serializer, model, prefix, select, prefetch, only):
+    """Collect the relations ``serializer`` reads, return False if ``only`` is incomplete.
+
+    ``only`` cannot be known when a field reads something other than a model
+    field, e.g. a SerializerMethodField or a dotted source.
+    """
+    complete = True
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.SerializerMethodField) or '.' in field.source \
+                or field.source == '*':
+            complete = False
+            continue
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            complete = False
+            continue
+        path = prefix + field.source
+
+        if model_field.many_to_many or model_field.one_to_many:
+            prefetch.append(path)
+            child = getattr(field, 'child', None)
+            if isinstance(child, serializers.ModelSerializer):
+                # Relations of the prefetched rows are followed by the same prefetch.
+                nested = []
+                walk(child, model_field.related_model, '', nested, nested, [])
+                prefetch.extend(path + '__' + x for x in nested)
+            continue
+
+        if not model_field.is_relation:
+            only.append(path)
+        elif isinstance(field, serializers.ModelSerializer):
+            select.append(path)
+            only.append(path)
+            complete &= walk(field, model_field.related_model, path + '__',
+                             select, prefetch, only)
+        elif isinstance(field, serializers.PrimaryKeyRelatedField):
+            only.append(prefix + model_field.attname)
+        else:
+            select.append(path)
+            complete = False
+    return complete
+
+
+@lru_cache(maxsize=None)
+def get_query_plan(serializer_class):
+    """Relations to fetch for ``serializer_class``, built once per class."""
+    serializer = serializer_class()
+    select, prefetch, only = [], [], []
+    model = serializer.Meta.model
+    complete = walk(serializer, model, '', select, prefetch, only)
+    if complete:
+        only.insert(0, model._meta.pk.name)
+    return QueryPlan(select, prefetch, only if complete else None)
+
+
+class QueryPlanMixin:
+    """Fetch what the action's serializer reads, in a fixed number of queries.
+
+    ``only()`` is applied to read actions only, and only when every field of
+    the serializer maps to a model field.
+    """
+
+    only_actions = ('list', 'retrieve')
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        serializer_class = self.get_serializer_class()
+        if not issubclass(serializer_class, serializers.ModelSerializer):
+            return queryset
+        plan = get_query_plan(serializer_class)
+        return plan.apply(queryset, only=self.action in self.only_actions)
@@ -0,0 +1,123 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+
+VERSION_KEY = 'response.version.{}'
+
+
+def get_versions(models):
+    """Current version of each model, a missing counter starts at the current time.
+
+    Starting from the clock rather than 1 keeps an evicted counter from
+    coming back to a value that entries already cached were built under.
+    """
+    keys = [VERSION_KEY.format(m._meta.label_lower) for m in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_version(model):
+    """Invalidate the cached responses built from ``model`` once the transaction commits."""
+    key = VERSION_KEY.format(model._meta.label_lower)
+
+    def on_commit():
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout=None)
+
+    transaction.on_commit(on_commit)
+
+
+class CachedListMixin:
+    """Cache ``list`` responses until a row of ``cache_models`` is saved or deleted.
+
+    Entries are keyed on the path, the query string, the negotiated format,
+    ``cache_user_attrs`` of the user and the model versions; ``bump_version``
+    must be connected to the models' post_save and post_delete signals.
+    Responses carry a strong ETag of the rendered body, a matching
+    If-None-Match is answered with 304 from the cache. The browsable API
+    renders per request and gets no ETag. A miss on a key another request
+    is building waits once for ``cache_lock_wait`` seconds, then builds the
+    entry itself.
+    """
+
+    cache_models = None
+    cache_user_attrs = ('is_authenticated', 'is_superuser')
+    cache_timeout = settings.RESPONSE_CACHE_TIMEOUT
+    cache_lock_timeout = settings.RESPONSE_CACHE_LOCK_TIMEOUT
+    cache_lock_wait = settings.RESPONSE_CACHE_LOCK_WAIT
+
+    def list(self, request, *args, **kwargs):
+        key = self.get_cache_key(request)
+        entry = cache.get(key)
+        if entry is None:
+            entry = self.build_cache_entry(key, request, *args, **kwargs)
+            if isinstance(entry, Response):
+                return entry
+
+        etag = entry['etag']
+        headers = {'Cache-Control': 'private, no-cache', 'Vary': 'Accept'}
+        if etag is None:
+            return Response(entry['data'], headers=headers)
+        headers['ETag'] = etag
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = [e[2:] if e.startswith('W/') else e for e in parse_etags(if_none_match)]
+            if '*' in etags or etag in etags:
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(entry['data'], headers=headers)
+
+    def get_cache_key(self, request):
+        models = self.cache_models or [self.get_queryset().model]
+        user = request.user
+        parts = [
+            request.path,
+            urlencode(sorted(request.query_params.lists()), doseq=True),
+            request.accepted_renderer.format,
+            ','.join('{}={}'.format(a, getattr(user, a, None)) for a in self.cache_user_attrs),
+            ','.join(str(v) for v in get_versions(models)),
+        ]
+        digest = hashlib.md5('\n'.join(parts).encode()).hexdigest()
+        return 'response.{}'.format(digest)
+
+    def build_cache_entry(self, key, request, *args, **kwargs):
+        """Entry for ``key``, built by one request at a time.
+
+        Returns the uncached response when it is not a 200.
+        """
+        lock = key + '.lock'
+        locked = cache.add(lock, 1, timeout=self.cache_lock_timeout)
+        if not locked:
+            time.sleep(self.cache_lock_wait)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+            # The lock holder is slow or died, build without it.
+        try:
+            response = super().list(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            renderer = request.accepted_renderer
+            etag = None
+            if not isinstance(renderer, BrowsableAPIRenderer):
+                body = renderer.render(response.data, request.accepted_media_type, self.get_renderer_context())
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            entry = {'etag': etag, 'data': response.data}
+            cache.set(key, entry, self.cache_timeout)
+            return entry
+        finally:
+            if locked:
+                cache.delete(lock)
@@ -0,0 +1,98 @@
+import mimetypes
+import os
+
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, StreamingHttpResponse
+
+MIN_BLOCK = 64 * 1024
+MAX_BLOCK = 1024 * 1024
+
+
+class FileStream:
+    """``length`` bytes of a file from ``offset``, in blocks growing from
+    MIN_BLOCK to ``max_block`` so the first bytes go out early and long
+    responses take few iterations.
+
+    A block is read only once the previous one was consumed, so a slow
+    client holds at most one block per stream.
+    """
+
+    def __init__(self, path, offset=0, length=None, max_block=MAX_BLOCK):
+        self.path = path
+        self.offset = offset
+        self.max_block = max_block
+        size = os.path.getsize(path)
+        self.length = max(min(size - offset, size if length is None else length), 0)
+
+    def blocks(self):
+        """(position, size) of every read."""
+        position, end, block = self.offset, self.offset + self.length, MIN_BLOCK
+        while position < end:
+            size = min(block, end - position)
+            yield position, size
+            position += size
+            block = min(block * 2, self.max_block)
+
+    def chunks(self):
+        with open(self.path, 'rb', buffering=0) as f:
+            for position, size in self.blocks():
+                data = os.pread(f.fileno(), size, position)
+                if not data:
+                    return
+                yield data
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """Django's ASGI handler, iterating streaming responses in a thread.
+
+    Django before 4.2 iterates a streaming response on the event loop, so
+    every file read would block all other connections of the worker.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            headers.append((b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': headers,
+        })
+
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=False)
+        while (part := await next_part(parts, None)) is not None:
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def stream_file(request, path, offset=0, length=None, status=200, content_type=None):
+    """Response streaming ``length`` bytes of ``path`` from ``offset``.
+
+    Under ASGI the blocks are read in a thread by ``ASGIHandler``. Under
+    WSGI a whole file goes out as FileResponse, which servers send through
+    ``wsgi.file_wrapper`` (sendfile).
+    """
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    asgi_request = isinstance(getattr(request, '_request', request), ASGIRequest)
+    stream = FileStream(path, offset, length)
+    if not asgi_request and stream.offset == 0 and stream.length == os.path.getsize(path):
+        resp = FileResponse(open(path, 'rb'), status=status, content_type=content_type)
+        resp.block_size = MAX_BLOCK
+    else:
+        resp = StreamingHttpResponse(stream.chunks(), status=status, content_type=content_type)
+    resp['Content-Length'] = str(stream.length)
+    return resp
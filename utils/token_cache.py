@@ -0,0 +1,117 @@
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .lru import LRUCache
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+def make_entry(user, created):
+    """What a token resolves to."""
+    return {'user_id': user.pk, 'is_active': user.is_active, 'created': created}
+
+
+def dump_user(user):
+    """The user's fields but the password as strings, for ``load_user``."""
+    return {field.attname: None if field.value_from_object(user) is None else field.value_to_string(user)
+            for field in get_user_model()._meta.concrete_fields if field.name != 'password'}
+
+
+def load_user(data):
+    """User instance from ``dump_user`` data, the password loads on access."""
+    model = get_user_model()
+    fields = [field for field in model._meta.concrete_fields if field.attname in data]
+    return model.from_db('default', [field.attname for field in fields],
+                         [field.to_python(data[field.attname]) for field in fields])
+
+
+class TokenCache:
+    """Read-through token cache: in-process LRU in front of Redis.
+
+    Entries hold a ``dump_user`` snapshot, dropped by the user and token
+    signal receivers on every change of the row.
+
+    Entries expire together with the token (``TOKEN_EXPIRE_SECONDS``). Local
+    entries are additionally capped at ``TOKEN_CACHE_LOCAL_TTL`` seconds, which
+    bounds how long another process may serve an entry already invalidated
+    in Redis.
+    """
+
+    prefix = 'auth.token.'
+    user_prefix = 'auth.token.user.'
+
+    def __init__(self, maxsize, local_ttl):
+        self.local = LRUCache(maxsize=maxsize, ttl=local_ttl)
+        self.redis_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        try:
+            raw = get_redis().get(self.prefix + key)
+        except redis.RedisError:
+            logger.warning('Token cache read failed', exc_info=True)
+            raw = None
+        if raw is None:
+            self.misses += 1
+            return None
+        self.redis_hits += 1
+        entry = json.loads(raw)
+        self.local.set(key, entry, self.get_ttl(entry))
+        return entry
+
+    def set(self, key, entry):
+        ttl = self.get_ttl(entry)
+        if ttl <= 0:
+            return
+        self.local.set(key, entry, ttl)
+        try:
+            pipe = get_redis().pipeline()
+            pipe.set(self.prefix + key, json.dumps(entry), ex=ttl)
+            pipe.set(self.user_prefix + str(entry['user_id']), key, ex=ttl)
+            pipe.execute()
+        except redis.RedisError:
+            logger.warning('Token cache write failed', exc_info=True)
+
+    def delete(self, key):
+        self.local.delete(key)
+        try:
+            get_redis().delete(self.prefix + key)
+        except redis.RedisError:
+            logger.warning('Token cache delete failed', exc_info=True)
+
+    def delete_user(self, user_id):
+        self.local.delete_where(lambda entry: entry['user_id'] == user_id)
+        try:
+            client = get_redis()
+            key = client.get(self.user_prefix + str(user_id))
+            if key is not None:
+                client.delete(self.prefix + key.decode())
+            client.delete(self.user_prefix + str(user_id))
+        except redis.RedisError:
+            logger.warning('Token cache delete failed', exc_info=True)
+
+    def get_ttl(self, entry):
+        return int(entry['created'] + settings.TOKEN_EXPIRE_SECONDS - time.time())
+
+    def stats(self):
+        local_hits = self.local.hits
+        total = local_hits + self.redis_hits + self.misses
+        return {
+            'size': len(self.local),
+            'local_hits': local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'hit_rate': round((total - self.misses) / total, 4) if total else None,
+        }
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_LOCAL_TTL)
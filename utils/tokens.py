@@ -0,0 +1,133 @@
+import binascii
+import json
+import logging
+import os
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.module_loading import import_string
+from rest_framework.authtoken.models import Token
+
+from .redis_client import get_redis
+from .token_cache import dump_user, make_entry, token_cache
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_token_backend():
+    return import_string(settings.AUTH_TOKEN_BACKEND)()
+
+
+class DatabaseTokenBackend:
+    """``rest_framework.authtoken`` Token rows, read through ``token_cache``.
+
+    Backends return entries built by ``make_entry``, with ``expires`` set to
+    the expiry timestamp or None when the store expires tokens itself. Entries
+    of this backend also carry the ``dump_user`` snapshot under ``user``.
+    """
+
+    def issue(self, user):
+        token, created = Token.objects.get_or_create(user=user)
+        if time.time() - token.created.timestamp() > settings.TOKEN_EXPIRE_SECONDS:
+            token_cache.delete(token.key)
+            Token.objects.filter(user_id=user.id).delete()
+            token, created = Token.objects.get_or_create(user=user)
+        return token.key
+
+    def lookup(self, key):
+        entry = token_cache.get(key)
+        if entry is None:
+            try:
+                token = Token.objects.select_related('user').get(key=key)
+            except Token.DoesNotExist:
+                return None
+            entry = make_entry(token.user, token.created.timestamp())
+            entry['user'] = dump_user(token.user)
+            token_cache.set(key, entry)
+        return dict(entry, expires=entry['created'] + settings.TOKEN_EXPIRE_SECONDS)
+
+    def revoke_user(self, user_id):
+        token_cache.delete_user(user_id)
+        Token.objects.filter(user_id=user_id).delete()
+
+    def invalidate_user(self, user_id):
+        token_cache.delete_user(user_id)
+
+
+class RedisTokenBackend:
+    """Tokens kept in Redis with a native TTL, optionally sliding.
+
+    A token holds the ``make_entry`` fields and the user's generation,
+    bumping the generation revokes all of the user's tokens at once.
+    """
+
+    prefix = 'auth.rtoken.'
+    generation_prefix = 'auth.rtoken.gen.'
+
+    # Fetch the token, drop it if its generation is stale, else slide its TTL.
+    lookup_script = """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then return nil end
+    local entry = cjson.decode(raw)
+    local generation = tonumber(redis.call('GET', ARGV[1] .. entry['user_id']) or '0')
+    if generation ~= entry['generation'] then
+        redis.call('DEL', KEYS[1])
+        return nil
+    end
+    if ARGV[2] ~= '0' then redis.call('EXPIRE', KEYS[1], ARGV[2]) end
+    return raw
+    """
+
+    def __init__(self):
+        self._lookup = None
+
+    def issue(self, user):
+        key = binascii.hexlify(os.urandom(20)).decode()
+        client = get_redis()
+        entry = make_entry(user, time.time())
+        entry['generation'] = int(client.get(self.generation_prefix + str(user.pk)) or 0)
+        client.set(self.prefix + key, json.dumps(entry), ex=settings.TOKEN_EXPIRE_SECONDS)
+        return key
+
+    def lookup(self, key):
+        if self._lookup is None:
+            self._lookup = get_redis().register_script(self.lookup_script)
+        sliding = settings.TOKEN_EXPIRE_SECONDS if settings.TOKEN_SLIDING_EXPIRY else 0
+        raw = self._lookup(keys=[self.prefix + key], args=[self.generation_prefix, sliding])
+        if raw is None:
+            return None
+        return dict(json.loads(raw), expires=None)
+
+    def revoke_user(self, user_id):
+        get_redis().incr(self.generation_prefix + str(user_id))
+
+    def invalidate_user(self, user_id):
+        # The rest of the user is read from the row, only a deactivation
+        # leaves the entries stale.
+        if not get_user_model().objects.filter(pk=user_id, is_active=True).exists():
+            self.revoke_user(user_id)
+
+
+class DualTokenBackend:
+    """Migration mode: issue in Redis, still accept unexpired Token rows."""
+
+    def __init__(self):
+        self.redis = RedisTokenBackend()
+        self.database = DatabaseTokenBackend()
+
+    def issue(self, user):
+        return self.redis.issue(user)
+
+    def lookup(self, key):
+        return self.redis.lookup(key) or self.database.lookup(key)
+
+    def revoke_user(self, user_id):
+        self.redis.revoke_user(user_id)
+        self.database.revoke_user(user_id)
+
+    def invalidate_user(self, user_id):
+        self.redis.invalidate_user(user_id)
+        self.database.invalidate_user(user_id)